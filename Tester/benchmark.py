@@ -0,0 +1,285 @@
+"""
+Benchmark Class for measuring the whole watcher -> producer -> consumer -> DB pipeline.
+A synthetic tree is generated in a temporary directory from a seeded random generator, with a configurable file
+size distribution and duplicate ratio, while a FileHandler like pipeline watches it over the in process transport.
+The results are printed as JSON, to be compared between releases:
+1. events_per_sec - created files decided per second, from the first file written to the last decision.
+2. hash_mb_per_sec - MB hashed per second of hashing time, summed over the consumer workers.
+3. db_ops_per_sec - consumer DB operations per second of DB time.
+4. latency_ms - p50/p95/p99 of the time from a file being written to its duplicate decision,
+   including the debouncer quiet period.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from consumer import Consumer
+from transport import InProcessBroker, InProcessTransport
+from watcher import FileChangeWatcher
+from watchdog.observers import Observer
+
+
+class BenchmarkConsumer(Consumer):
+    """
+    Consumer recording its duplicate decisions, hashing and DB timings.
+    """
+
+    DB_OPERATIONS = ('insert_row', 'insert_row_if_not_exists', 'select_rows', 'delete_value', 'update_table')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        # File path to the (monotonic time, is duplicate) of its first decision
+        self.decisions = {}
+        self.decided = threading.Condition(self.stats_lock)
+        self.hashed_bytes = 0
+        self.hash_time = 0.0
+        self.db_ops = 0
+        self.db_time = 0.0
+        for db in {self.db, self.files_db}:
+            for name in self.DB_OPERATIONS:
+                setattr(db, name, self.timed_db_operation(getattr(db, name)))
+
+    def timed_db_operation(self, operation):
+        """
+        Auxiliary method for wrapping a DB operation with a timer.
+        :param operation: For the bound DB method.
+        :return: The wrapped method.
+        """
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return operation(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.stats_lock:
+                    self.db_ops += 1
+                    self.db_time += elapsed
+        return timed
+
+    def hash_file(self, file):
+        start = time.perf_counter()
+        file_hash = super().hash_file(file)
+        elapsed = time.perf_counter() - start
+        if file_hash is not None:
+            size = self.get_file_size_in_bytes(file) or 0
+            with self.stats_lock:
+                self.hashed_bytes += size
+                self.hash_time += elapsed
+        return file_hash
+
+    def is_duplicate(self, file_name, size, mtime_ns=None):
+        result = super().is_duplicate(file_name, size, mtime_ns)
+        with self.decided:
+            self.decisions.setdefault(file_name, (time.monotonic(), result is not None))
+            self.decided.notify_all()
+        return result
+
+
+class Benchmark:
+
+    FILE_TYPES = ('.txt', '.pdf', '.json', '.jpg', '.docx')
+
+    def __init__(self, files=2000, sizes='4K:60,64K:25,1M:10,8M:5', duplicate_ratio=0.2, dirs=20, seed=1,
+                 workers=None, quiet_period=0.5, hash_algorithm='md5', dedup_mode='full', db_write_behind=False,
+                 timeout=300.0, db_shards=1):
+        """
+        Class Constructor.
+        :param files: For the number of files to create.
+        :param sizes: For the file size distribution, comma separated 'size:weight' pairs, sizes may end with K/M/G.
+        :param duplicate_ratio: For the fraction of files copying the content of an earlier file.
+        :param dirs: For the number of directories the files are spread over.
+        :param seed: For the random generator seed, the same seed generates the same tree.
+        :param workers: For the number of consumer workers, defaults to the number of cores.
+        :param quiet_period: For the watcher debouncer quiet period in seconds.
+        :param hash_algorithm: For the consumer hash algorithm.
+        :param dedup_mode: For the consumer dedup mode.
+        :param db_write_behind: For group committing the consumer DB mutations.
+        :param timeout: For the maximal seconds to wait for the last decision.
+        :param db_shards: For the number of SQLite files the consumer 'Files' table is partitioned across.
+        """
+        self.files = files
+        self.sizes = self.parse_sizes(sizes)
+        self.duplicate_ratio = duplicate_ratio
+        self.dirs = dirs
+        self.seed = seed
+        self.workers = workers
+        self.quiet_period = quiet_period
+        self.hash_algorithm = hash_algorithm
+        self.dedup_mode = dedup_mode
+        self.db_write_behind = db_write_behind
+        self.timeout = timeout
+        self.db_shards = db_shards
+        self.config = {'files': files, 'sizes': sizes, 'duplicate_ratio': duplicate_ratio, 'dirs': dirs,
+                       'seed': seed, 'workers': workers or os.cpu_count(), 'quiet_period': quiet_period,
+                       'hash_algorithm': hash_algorithm, 'dedup_mode': dedup_mode,
+                       'db_write_behind': db_write_behind, 'db_shards': db_shards}
+
+    @staticmethod
+    def parse_sizes(sizes):
+        """
+        Auxiliary method for parsing the file size distribution.
+        :param sizes: For the comma separated 'size:weight' pairs.
+        :return: Tuple of the sizes list and the weights list.
+        """
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        values, weights = [], []
+        for pair in sizes.split(','):
+            size, weight = pair.strip().split(':')
+            size = size.strip().upper()
+            values.append(int(size[:-1]) * units[size[-1]] if size[-1] in units else int(size))
+            weights.append(float(weight))
+        return values, weights
+
+    def generate(self, watched_dir):
+        """
+        Generator writing the synthetic tree, one file per iteration.
+        :param watched_dir: For the watched directory.
+        :return: Generator of (path, size, monotonic time the file was written, is a copy of an earlier content).
+        """
+        rng = random.Random(self.seed)
+        contents = []
+        for index in range(self.files):
+            directory = os.path.join(watched_dir, f'dir_{rng.randrange(self.dirs)}')
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'file_{index}{rng.choice(self.FILE_TYPES)}')
+            duplicate = bool(contents) and rng.random() < self.duplicate_ratio
+            if duplicate:
+                content = rng.choice(contents)
+            else:
+                content = rng.randbytes(rng.choices(*self.sizes)[0])
+                # Every content is unique, the first bytes hold its index
+                content = index.to_bytes(8, 'little') + content[8:]
+                contents.append(content)
+            with open(path, 'wb') as file:
+                file.write(content)
+            yield path, len(content), time.monotonic(), duplicate
+
+    def run(self):
+        """
+        Runs the benchmark in a temporary directory, removed afterwards.
+        :return: The results dict.
+        """
+        cwd = os.getcwd()
+        work_dir = tempfile.mkdtemp(prefix='file-events-benchmark-')
+        try:
+            # The consumer DB, producer spool and log file are all created in the working directory
+            os.chdir(work_dir)
+            watched_dir = os.path.join(work_dir, 'watched')
+            os.makedirs(watched_dir)
+            return self.run_pipeline(watched_dir)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def run_pipeline(self, watched_dir):
+        """
+        Auxiliary method for running the pipeline over the synthetic tree.
+        :param watched_dir: For the watched directory.
+        :return: The results dict.
+        """
+        broker = InProcessBroker()
+        consumer = BenchmarkConsumer(None, workers=self.workers, hash_algorithm=self.hash_algorithm,
+                                     dedup_mode=self.dedup_mode, db_write_behind=self.db_write_behind,
+                                     transport=InProcessTransport(broker), db_shards=self.db_shards)
+        consumer.setup_consumer_db()
+        consumer_thread = threading.Thread(target=consumer.run, daemon=True, name='benchmark-consumer')
+        consumer_thread.start()
+        watcher = FileChangeWatcher(None, self.quiet_period, transport=InProcessTransport(broker))
+        observer = Observer()
+        observer.schedule(watcher, watched_dir, recursive=True)
+        observer.start()
+
+        written, expected_duplicates, total_bytes = {}, 0, 0
+        start = time.monotonic()
+        for path, size, written_time, duplicate in self.generate(watched_dir):
+            written[path] = written_time
+            expected_duplicates += duplicate
+            total_bytes += size
+        with consumer.decided:
+            consumer.decided.wait_for(lambda: written.keys() <= consumer.decisions.keys(),
+                                      timeout=max(0.0, self.timeout - (time.monotonic() - start)))
+            decisions = {path: consumer.decisions[path] for path in written if path in consumer.decisions}
+        end = max((decided_time for decided_time, _ in decisions.values()), default=time.monotonic())
+
+        observer.stop()
+        observer.join()
+        watcher.stop()
+        consumer.close_connection()
+
+        latencies = sorted((decisions[path][0] - written[path]) * 1000 for path in decisions)
+        elapsed = end - start
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': self.config,
+            'files_written': len(written),
+            'bytes_written': total_bytes,
+            'files_decided': len(decisions),
+            'duplicates_expected': expected_duplicates,
+            'duplicates_detected': sum(duplicate for _, duplicate in decisions.values()),
+            'elapsed_sec': round(elapsed, 3),
+            'events_per_sec': round(len(decisions) / elapsed, 1) if elapsed > 0 else None,
+            'hash_mb_per_sec': round(consumer.hashed_bytes / (1024 * 1024) / consumer.hash_time, 1)
+            if consumer.hash_time else None,
+            'db_ops': consumer.db_ops,
+            'db_ops_per_sec': round(consumer.db_ops / consumer.db_time, 1) if consumer.db_time else None,
+            'latency_ms': self.percentiles(latencies),
+        }
+
+    @staticmethod
+    def percentiles(values):
+        """
+        Auxiliary method for summarizing sorted latencies.
+        :param values: For the sorted latencies.
+        :return: Dict of the p50, p95, p99 and max latencies, empty if there are none.
+        """
+        if not values:
+            return {}
+        if len(values) == 1:
+            cuts = values * 99
+        else:
+            cuts = statistics.quantiles(values, n=100, method='inclusive')
+        return {'p50': round(cuts[49], 2), 'p95': round(cuts[94], 2), 'p99': round(cuts[98], 2),
+                'max': round(values[-1], 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the file events pipeline on a synthetic tree.')
+    parser.add_argument('--files', type=int, default=2000, help='number of files to create')
+    parser.add_argument('--sizes', default='4K:60,64K:25,1M:10,8M:5', help="size distribution, 'size:weight,...'")
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2, help='fraction of duplicate files')
+    parser.add_argument('--dirs', type=int, default=20, help='number of directories')
+    parser.add_argument('--seed', type=int, default=1, help='random generator seed')
+    parser.add_argument('--workers', type=int, default=None, help='number of consumer workers')
+    parser.add_argument('--quiet-period', type=float, default=0.5, help='debouncer quiet period in seconds')
+    parser.add_argument('--hash-algorithm', default='md5', help='consumer hash algorithm')
+    parser.add_argument('--dedup-mode', default='full', help="consumer dedup mode, 'full' or 'tiered'")
+    parser.add_argument('--db-write-behind', action='store_true', help='group commit the consumer DB')
+    parser.add_argument('--db-shards', type=int, default=1, help='number of consumer DB Files shards')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds to wait for the last decision')
+    parser.add_argument('--output', help='file to write the JSON results to, printed otherwise')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    results = Benchmark(args.files, args.sizes, args.duplicate_ratio, args.dirs, args.seed, args.workers,
+                        args.quiet_period, args.hash_algorithm, args.dedup_mode, args.db_write_behind,
+                        args.timeout, args.db_shards).run()
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
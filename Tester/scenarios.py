@@ -0,0 +1,179 @@
+"""
+Scenarios Class for checking the consumer DB stays consistent when file events interleave.
+Every scenario writes a small tree in a temporary directory and drives Consumer.process_file_event with the events
+the watcher would publish, in a given order, then checks the files on disk and the 'Files' and 'Duplicates' rows:
+1. rename_between_shards - a rename between paths of different shards is a 'deleted' and a 'created' event,
+   processed in both orders, the renamed file must not be handled as a duplicate of its own source.
+2. rename_over_stored_path - a file saved by renaming another file over it, the overwritten content is forgotten.
+3. rename_promoted_duplicate - a renamed duplicate replacing its deleted original is renamed again.
+Usage: python Tester/scenarios.py [--dedup-mode {full,tiered}] [SCENARIO ...], exits with 1 if a scenario failed.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from consumer import Consumer
+from messages import FileEvent, event_from_stat
+from transport import InProcessBroker, InProcessTransport
+
+
+class ScenarioFailure(Exception):
+    """
+    Raised when a scenario check does not hold.
+    """
+
+
+class Scenarios:
+
+    def __init__(self, dedup_mode='full'):
+        """
+        Class Constructor.
+        :param dedup_mode: For the consumer dedup mode, 'full' or 'tiered'.
+        """
+        self.dedup_mode = dedup_mode
+        self.consumer = None
+        self.root = None
+
+    def run(self, name):
+        """
+        Runs a scenario on a fresh consumer DB, in a temporary directory removed afterwards.
+        :param name: For the scenario name, a 'scenario_{name}' method.
+        :return: None if the scenario passed, the failure message otherwise.
+        """
+        cwd = os.getcwd()
+        work_dir = tempfile.mkdtemp(prefix='file-events-scenario-')
+        try:
+            # The consumer DB and log file are created in the working directory
+            os.chdir(work_dir)
+            self.root = os.path.join(work_dir, 'watched')
+            os.makedirs(self.root)
+            self.consumer = Consumer(None, workers=1, dedup_mode=self.dedup_mode,
+                                     transport=InProcessTransport(InProcessBroker()))
+            self.consumer.setup_consumer_db()
+            try:
+                getattr(self, f"scenario_{name}")()
+            except ScenarioFailure as err:
+                return str(err)
+            finally:
+                self.consumer.close_connection()
+            return None
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def path(self, name):
+        """
+        :param name: For a file name in the watched directory.
+        :return: The file absolute path.
+        """
+        return os.path.join(self.root, name)
+
+    def write(self, name, content):
+        """
+        Writes a file and processes its 'created' event.
+        :param name: For the file name.
+        :param content: For the file bytes.
+        """
+        with open(self.path(name), 'wb') as file:
+            file.write(content)
+        self.process(event_from_stat('created', self.path(name)))
+
+    def process(self, *events):
+        """
+        Processes events in the given order.
+        :param events: For the FileEvents.
+        """
+        for event in events:
+            self.consumer.process_file_event(event)
+
+    def files(self):
+        """
+        :return: Sorted list of the (file name, size) of the 'Files' rows.
+        """
+        return sorted((os.path.basename(name), size) for name, size in
+                      self.consumer.files_db.stream_rows('Files', 'File_Name, File_Size'))
+
+    def duplicates(self):
+        """
+        :return: Sorted list of the (file name, original name) of the 'Duplicates' rows.
+        """
+        return sorted((os.path.basename(name), os.path.basename(original)) for name, original in
+                      self.consumer.db.stream_rows('Duplicates', 'File_Name, Original'))
+
+    def expect(self, files=None, duplicates=None, on_disk=None):
+        """
+        Checks the stored rows and the files on disk.
+        :param files: For the expected (file name, size) rows of 'Files'.
+        :param duplicates: For the expected (file name, original name) rows of 'Duplicates'.
+        :param on_disk: For the expected sorted file names of the watched directory.
+        """
+        checks = (('Files rows', files, self.files), ('Duplicates rows', duplicates, self.duplicates),
+                  ('files on disk', on_disk, lambda: sorted(os.listdir(self.root))))
+        for what, expected, current in checks:
+            if expected is not None and sorted(expected) != current():
+                raise ScenarioFailure(f"{what} are {current()}, expected {sorted(expected)}.")
+
+    def scenario_rename_between_shards(self):
+        for create_first in (True, False):
+            self.write('a.pdf', b'a' * 3000)
+            os.rename(self.path('a.pdf'), self.path('b.pdf'))
+            # The watcher splits moves between shards, see FileChangeWatcher.publish_file_events
+            deleted, created = FileEvent('deleted', self.path('a.pdf')), event_from_stat('created', self.path('b.pdf'))
+            self.process(*((created, deleted) if create_first else (deleted, created)))
+            self.expect(files=[('b.pdf', 3000)], duplicates=[], on_disk=['b.pdf'])
+            os.remove(self.path('b.pdf'))
+            self.process(FileEvent('deleted', self.path('b.pdf')))
+
+    def scenario_rename_over_stored_path(self):
+        self.write('a.pdf', b'a' * 3000)
+        self.write('b.pdf', b'b' * 4000)
+        os.rename(self.path('a.pdf'), self.path('b.pdf'))
+        self.process(event_from_stat('moved', self.path('a.pdf'), self.path('b.pdf')))
+        self.expect(files=[('b.pdf', 3000)], duplicates=[], on_disk=['b.pdf'])
+        # The overwritten content is not stored anymore, a new file with it is not a duplicate
+        self.write('c.pdf', b'b' * 4000)
+        self.expect(files=[('b.pdf', 3000), ('c.pdf', 4000)], duplicates=[], on_disk=['b.pdf', 'c.pdf'])
+
+    def scenario_rename_promoted_duplicate(self):
+        self.write('a.pdf', b'a' * 3000)
+        self.write('b.pdf', b'a' * 3000)
+        self.expect(files=[('a.pdf', 3000)], duplicates=[('b.pdf_dup_1', 'a.pdf')], on_disk=['a.pdf', 'b.pdf_dup_1'])
+        os.remove(self.path('a.pdf'))
+        self.process(FileEvent('deleted', self.path('a.pdf')))
+        self.expect(files=[('b.pdf_dup_1', 3000)], duplicates=[])
+        os.rename(self.path('b.pdf_dup_1'), self.path('q.pdf'))
+        self.process(event_from_stat('moved', self.path('b.pdf_dup_1'), self.path('q.pdf')))
+        self.expect(files=[('q.pdf', 3000)], duplicates=[], on_disk=['q.pdf'])
+
+
+SCENARIOS = ('rename_between_shards', 'rename_over_stored_path', 'rename_promoted_duplicate')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks the consumer DB consistency on interleaved file events.')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f"one of {', '.join(SCENARIOS)}, all by default")
+    parser.add_argument('--dedup-mode', choices=('full', 'tiered'), default=None,
+                        help='consumer dedup mode, both by default')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    failed = 0
+    for dedup_mode in (args.dedup_mode,) if args.dedup_mode else ('full', 'tiered'):
+        for name in args.scenarios or SCENARIOS:
+            failure = Scenarios(dedup_mode).run(name)
+            if failure is None:
+                print(f"[+] Scenario '{name}' ({dedup_mode}) passed.", file=sys.stderr)
+            else:
+                failed += 1
+                print(f"[!] Scenario '{name}' ({dedup_mode}) failed: {failure}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
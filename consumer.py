@@ -3,136 +3,582 @@ Consumer Class for running the main project logic, see readme for more details.
 """
 import pathlib
 import time
-import hashlib
 import os
-import pika
-import pika.exceptions
 import enum
-from threading import Thread
+import struct
+import functools
+from threading import Thread, Lock
 from logger import Logger
 from database import DB
+from sharded_db import ShardedDB
+from hasher import Hasher
+from duplicate_handler import DuplicateHandler, DuplicateActions
+from io_governor import IOGovernor
+from hash_cache import HashCache
+from hash_index import HashIndex
+from messages import FileEvent, decode_events
+from transport import RabbitMQTransport, TransportError
+from scheduler import SizeScheduler
+from sharding import ShardRing
+from metrics import REGISTRY, CONSUMER_MESSAGES, CONSUMER_EVENTS, CONSUMER_QUEUE_WAIT_SECONDS
 
 
 class Consumer(Thread):
-    def __init__(self, host, queue="file-box"):
+    def __init__(self, host, queue="file-box", workers=None, prefetch_count=None, hash_algorithm='md5',
+                 dedup_mode='full', hash_cache_size=100000, db_write_behind=False,
+                 hash_index_capacity=10000000, transport=None, large_workers=None, shards=1, shard_ids=None,
+                 io_limit_mb=None, fadvise=False, tree_threshold=None, tree_segment_size=64 * 1024 * 1024,
+                 duplicate_action='rename', quarantine_dir=None, db_shards=1):
         """
         Class Constructor.
         :param host: For the IP Address to configure.
         :param queue: For the RabbitMQ queue name.
+        :param workers: For the number of worker threads hashing files, defaults to the number of cores.
+        :param prefetch_count: For the RabbitMQ unacked deliveries window, defaults to twice the workers.
+        :param hash_algorithm: For the file digest algorithm, see Hasher.ALGORITHMS.
+        :param dedup_mode: For the duplicates detection mode, 'full' hashes every created file,
+                           'tiered' compares sizes first, then head/tail samples and only then full hashes.
+        :param hash_cache_size: For the number of file digests cached in memory, 0 disables the hash cache.
+        :param db_write_behind: For group committing the consumer DB mutations, see DB.
+        :param hash_index_capacity: For the number of digests the in memory hash index is sized for,
+                                    0 disables the hash index.
+        :param transport: For the Transport to consume from, RabbitMQ on the given host by default.
+        :param large_workers: For the number of workers which may hash files of 1 GB and above at once,
+                              half of the workers by default.
+        :param shards: For the number of shard queues the producer routes events to, see ShardRing.
+        :param shard_ids: For the shards this consumer consumes from, all of them by default.
+                          Consumers on several nodes share the shards by consuming disjoint subsets.
+        :param io_limit_mb: For the base file reads bandwidth in MB per second, see IOGovernor, unlimited if None.
+                            It grows up to 4 times while events are piling up, and shrinks while the disk is busy.
+        :param fadvise: For hinting the kernel to drop hashed files pages, so hashing does not evict hot page cache.
+        :param tree_threshold: For the file size in bytes from which files are tree hashed in parallel, see Hasher,
+                               never if None. All the nodes must use the same threshold and segment size.
+        :param tree_segment_size: For the tree hashing segment size in bytes, segment digests are stored in the
+                                  'Segments' table for partial verification.
+        :param duplicate_action: For the action applied to duplicates, 'rename', 'hardlink', 'reflink' or
+                                 'quarantine', see DuplicateActions.
+        :param quarantine_dir: For the directory duplicates are moved to by the 'quarantine' action.
+        :param db_shards: For the number of SQLite files the 'Files' table is partitioned across by digest prefix,
+                          each with its own writer thread, see ShardedDB. Requires the 'full' dedup mode.
         """
         super(Consumer).__init__()
         self.host = host
         self.queue = queue
-        self.connection = None
-        self.channel = None
+        self.ring = ShardRing(queue, shards)
+        self.shard_ids = list(range(shards)) if shard_ids is None else list(shard_ids)
+        self.queues = [self.ring.queue_name(shard) for shard in self.shard_ids]
+        self.transport = transport or RabbitMQTransport(host)
         self.SOURCE_DIR = f'/home/user/Downloads'
         self.file_types = [".ppt", ".pptx", ".pdf", ".txt", ".html", ".mp4",
                            ".jpg", ".png", ".xls", ".xlsx", ".xml", ".vsd", ".py",
                            ".doc", ".docx", ".json"]
-        self.chunk_size = 1024
+        self.chunk_size = 1024 * 1024
+        self.MMAP_THRESHOLD = 64 * 1024 * 1024
+        self.SAMPLE_SIZE = 64 * 1024
+        # Unique key of the 'Files' table, a digest is only comparable with digests of the same algorithm
+        self.HASH_KEY = 'File_Hash, Hash_Algorithm'
+        if dedup_mode not in DedupModes.ALL:
+            raise ValueError(f"Unsupported dedup mode '{dedup_mode}'.")
+        if db_shards > 1 and dedup_mode != DedupModes.FULL:
+            raise ValueError("A sharded consumer DB requires the 'full' dedup mode, files are routed by digest.")
+        self.dedup_mode = dedup_mode
+        # Stored files without a digest of the configured algorithm, see has_stale_hashes
+        self.stale_hashes = False
+        # Striped by file size, tiered decisions on files of the same size must not interleave
+        self.size_locks = [Lock() for _ in range(64)]
+        # Striped by digest, the hash index check and the insert of the same digest must not interleave
+        self.hash_locks = [Lock() for _ in range(64)]
         self.RECONNECTING_BUFFER = 10
-        self.DEFAULT_PROCESSING_TIME = 1
-        self.hash = hashlib.md5()
-        self.connect()
+        # Files from this SizeUnits band on are scheduled in the large files lane
+        self.LARGE_FILE_BAND = SizeUnits.TB.value
+        self.workers = workers or os.cpu_count() or 1
+        self.prefetch_count = prefetch_count or self.workers * 2
+        self.scheduler = SizeScheduler(self.workers, self.LARGE_FILE_BAND, large_workers)
+        # Delivery tag to the number of its events not processed yet
+        self.pending_deliveries = {}
+        self.deliveries_lock = Lock()
+        self.io_governor = IOGovernor(io_limit_mb, backlog=lambda: self.scheduler.unfinished) \
+            if io_limit_mb else None
+        self.hasher = Hasher(hash_algorithm, buffer_size=self.chunk_size, mmap_threshold=self.MMAP_THRESHOLD,
+                             governor=self.io_governor, fadvise=fadvise, tree_threshold=tree_threshold,
+                             segment_size=tree_segment_size, tree_workers=self.workers,
+                             on_segments=self.store_segments)
+        self.duplicate_handler = DuplicateHandler(duplicate_action, quarantine_dir, self.io_governor,
+                                                  self.chunk_size)
         self.class_logger = Logger('Consumer')
-        self.db = DB()
+        self.connect()
+        self.db = DB(write_behind=db_write_behind)
+        # The 'Files' table, in the consumer DB itself unless it is sharded
+        self.files_db = ShardedDB(db_shards, write_behind=db_write_behind) if db_shards > 1 else self.db
+        self.hash_cache = HashCache(self.db, hash_cache_size) if hash_cache_size else None
+        self.hash_index = HashIndex(self.files_db, hash_index_capacity) if hash_index_capacity else None
 
     def connect(self):
         """
         Establish connection to RabbitMQ Server.
         """
         try:
-            self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
-            self.channel = self.connection.channel()
-            self.channel.queue_declare(self.queue)
-            print(f"[+] Consumer connected successfully to RabbitMQ queue '{self.queue}'.")
-        except pika.exceptions.AMQPConnectionError as err:
+            self.transport.connect()
+            for queue_name in self.queues:
+                self.transport.declare(queue_name)
+            # Limits the unacked deliveries so the broker will not flood the worker pool
+            self.transport.qos(self.prefetch_count)
+            print(f"[+] Consumer connected successfully to RabbitMQ queues '{', '.join(self.queues)}'.")
+        except TransportError as err:
             print(f"[!] Unable to connect to RabbitMQ Server.")
             self.class_logger.logger.error(f"Unable to Connect to RabbitMQ Server, Error: {err}")
 
     def close_connection(self):
         """
-        Closes connection to rabbitMQ Server.
+        Closes connection to rabbitMQ Server, waits for the running workers and closes the consumer DB.
         """
-        self.connection.close()
+        self.scheduler.shutdown(wait=True)
+        if self.files_db is not self.db and self.files_db.conn is not None:
+            self.files_db.close_db()
+        if self.db.conn is not None:
+            self.db.close_db()
+        self.transport.close()
         print(f"[+] Consumer connection has been closed.")
 
     def setup_consumer_db(self):
         """
-        Method For setting up the consumer database.
+        Method For setting up the consumer database, does nothing if it has already been set up.
         """
-        if self.db.setup_db('Consumer_DB'):
-            self.db.create_table('Files', 'File_Name, File_Hash')
+        if self.db.conn is not None:
+            return
+        if self.db.setup_db('Consumer_DB') and (self.files_db is self.db or self.files_db.setup_db('Consumer_DB')):
+            self.files_db.create_table('Files', 'File_Name TEXT, File_Hash TEXT, Hash_Algorithm TEXT, '
+                                          'File_Size INTEGER, Sample_Hash TEXT, Mtime_Ns INTEGER')
+            self.files_db.add_column_if_not_exists('Files', 'Hash_Algorithm TEXT')
+            self.files_db.add_column_if_not_exists('Files', 'File_Size INTEGER')
+            self.files_db.add_column_if_not_exists('Files', 'Sample_Hash TEXT')
+            self.files_db.add_column_if_not_exists('Files', 'Mtime_Ns INTEGER')
+            # Hash lookups and upserts, path lookups and tiered mode size lookups are all indexed
+            # Digests are only comparable within an algorithm, the pair is unique, see Hasher.digest_name
+            self.files_db.drop_index('Files_File_Hash')
+            self.files_db.create_index('Files_File_Hash_Algorithm', 'Files', self.HASH_KEY, unique=True)
+            self.files_db.create_index('Files_File_Name', 'Files', 'File_Name')
+            self.files_db.create_index('Files_File_Size', 'Files', 'File_Size')
+            # Duplicates are not stored in Files, their File_Hash is not unique, they are tracked for the reports
+            self.db.create_table('Duplicates', 'File_Name TEXT NOT NULL, Original TEXT NOT NULL, '
+                                               'File_Size INTEGER, Action TEXT')
+            self.db.create_index('Duplicates_File_Name', 'Duplicates', 'File_Name', unique=True)
+            self.db.create_index('Duplicates_Original', 'Duplicates', 'Original, File_Name')
+            self.db.create_table('Segments', 'File_Hash TEXT NOT NULL, Segment INTEGER NOT NULL, '
+                                             'Segment_Hash TEXT NOT NULL, PRIMARY KEY (File_Hash, Segment)')
+            if self.hash_cache is not None:
+                self.hash_cache.setup()
+            if self.hash_index is not None:
+                self.hash_index.load()
+            self.stale_hashes = self.dedup_mode == DedupModes.FULL and self.has_stale_hashes()
         else:
             print("[!] Error creating consumer database.")
 
-    def on_notification_receive(self, channel, method, properties, body):
+    def on_notification_receive(self, body, delivery_tag):
+        """
+        Hands the received events to the scheduler, the delivery is acked once all of its events are done.
+        Created files are scheduled by size band, smaller files first, events of the same path keep their order.
+        :param body: For received event message.
+        :param delivery_tag: For the transport delivery tag.
+        """
+        try:
+            events = decode_events(body)
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError) as err:
+            self.class_logger.logger.error(f"[!] Unable to decode event message, Error: {err}")
+            events = []
+        if REGISTRY.enabled:
+            CONSUMER_MESSAGES.inc()
+            for event in events:
+                CONSUMER_EVENTS.inc(1, event.event_type)
+        if not events:
+            self.ack(delivery_tag)
+            return
+        queued_at = time.perf_counter() if REGISTRY.enabled else None
+        with self.deliveries_lock:
+            self.pending_deliveries[delivery_tag] = len(events)
+        for event in events:
+            band = self.get_file_size_band(event.size) if event.event_type == EventTypes.CREATED else SizeUnits.KB.value
+            keys = (event.src_path, event.dest_path) if event.dest_path else (event.src_path,)
+            try:
+                self.scheduler.submit(functools.partial(self.process_file_event, event, queued_at), band, keys,
+                                      functools.partial(self.on_event_processed, delivery_tag))
+            except RuntimeError as err:
+                # The scheduler has been shut down, the unacked delivery is redelivered by the broker
+                self.class_logger.logger.error(f"Consumer is closing, delivery '{delivery_tag}' dropped, Error: {err}")
+                return
+
+    def on_event_processed(self, delivery_tag, error):
+        """
+        Scheduler callback, acks the delivery once the last of its events is done.
+        :param delivery_tag: For the transport delivery tag.
+        :param error: For the event processing error, None on success.
+        """
+        if error is not None:
+            self.class_logger.logger.error(f"Unable to process event, Error: {error}")
+        with self.deliveries_lock:
+            self.pending_deliveries[delivery_tag] -= 1
+            if self.pending_deliveries[delivery_tag]:
+                return
+            del self.pending_deliveries[delivery_tag]
+        self.ack(delivery_tag)
+
+    def ack(self, delivery_tag):
+        """
+        Acks a delivery through the transport.
+        :param delivery_tag: For the transport delivery tag to ack.
+        """
+        try:
+            self.transport.ack(delivery_tag)
+        except TransportError as err:
+            self.class_logger.logger.error(f"Unable to ack delivery '{delivery_tag}', Error: {err}")
+
+    def process_file_event(self, event, queued_at=None):
         """
         This method will do the following on the received events:
         1. if 'created':
-          - generate file md5 hash,
-          - if file hash already in db the consumer will change file name and add the appropriate suffix,
-          - otherwise stores the hash into consumer db.
+          - check if the file content already exists in db, see is_duplicate,
+          - if it does the consumer will apply the duplicate action, see DuplicateHandler,
+          - otherwise stores the file into consumer db.
         2. if 'deleted':
-          - delete file from db.
-        3. if 'moved' or 'modified':
+          - delete file from db, by its path, without reading it, see delete_file.
+        3. if 'moved':
+          - rewrite the stored file path, see move_file.
+        4. if 'modified':
           - save to log file.
-        :param channel: For RabbitMQ channel.
-        :param method: For RabbitMQ delivery method.
-        :param properties: For RabbitMQ properties.
-        :param body: For received event message.
+        :param event: For the decoded FileEvent.
+        :param queued_at: For the perf_counter time the event was scheduled, recorded as its queue wait.
         """
-        global file_hash, file_name
-        self.channel.basic_ack(delivery_tag=method.delivery_tag)
-        decoded_msg = body.decode().split()
-
-        # Getting file path and hash
-        try:
-            file_name = decoded_msg[1]
-            file_hash = self.hash_file(file_name)
-        except FileNotFoundError as err:
-            self.class_logger.logger.error(f"[!] Unable to get file path or hash, Error: {err}")
+        if queued_at is not None:
+            CONSUMER_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued_at)
+        file_name = event.src_path
 
         # Validating file type
         file_type = self.validate_file_type(file_name)
 
+        if event.event_type == EventTypes.MOVED and event.dest_path:
+            self.move_file(event)
+            return
+        # Renamed duplicates have no supported type, their deletes are handled too
+        if event.event_type == EventTypes.DELETED:
+            self.delete_file(file_name)
+            return
+
         # Main method logic
         if file_type:
             # For create event
-            if EventTypes.CREATED in decoded_msg:
-                # Getting file size to calculate consumer processing time
-                size = self.get_file_size_in_bytes(file_name)
-                processing_time = self.get_file_process_time(size)
-                print(f"[+] Received created event, processing time will be {processing_time} seconds.")
-                # Insert hash value only if it does not exist in db
-                if self.db.insert_if_not_exists('Files', 'File_Hash', file_hash):
-                    self.db.update_table('Files', 'File_Name', file_name, 'File_Hash', file_hash)
-                # If md5 hash already exists in db, change file name
-                else:
-                    try:
-                        new_name = f"{file_name}{'_dup_#'}"
-                        os.rename(file_name, new_name)
-                        self.class_logger.logger.info(f"Changed {file_name} to {new_name}")
-                    except FileNotFoundError as err:
-                        self.class_logger.logger.error(f"Unable to rename {file_name}, Error: {err}")
-                time.sleep(processing_time)
-            # For delete event
-            elif EventTypes.DELETED in decoded_msg:
-                # Getting file size to calculate consumer processing time
-                size = self.get_file_size_in_bytes(file_name)
-                processing_time = self.get_file_process_time(size)
-                print(f"[+] Received deleted event, processing time will be {processing_time} seconds.")
-                try:
-                    # file_hash = self.db.select_value('Files', 'File_Hash')
-                    self.db.delete_value('Files', 'File_Name', file_name)
-                    self.db.delete_value('Files', 'File_Name', file_hash)
-                    time.sleep(processing_time)
-                except TypeError as err:
-                    self.class_logger.logger.error(f"Unable to delete '{file_hash}' from db, Error: {err}.")
-            # For moved or modified event
-            elif EventTypes.MOVED in decoded_msg or EventTypes.MODIFIED in decoded_msg:
-                print(f"[+] Received modified or moved event, processing time will be {self.DEFAULT_PROCESSING_TIME} seconds.")
-                self.class_logger.logger.info(f"Received '{decoded_msg}'.")
+            if event.event_type == EventTypes.CREATED:
+                # The watcher sends the file size, stat the file only for messages without it
+                size = event.size if event.size >= 0 else self.get_file_size_in_bytes(file_name)
+                print(f"[+] Received created event of '{file_name}'.")
+                if size is None:
+                    return
+                mtime_ns = event.mtime_ns if event.mtime_ns >= 0 else None
+                # If the file content already exists in db, apply the duplicate action
+                original = self.is_duplicate(file_name, size, mtime_ns)
+                if original is not None and not os.path.lexists(original):
+                    # The original is gone, e.g. it has been moved here from a path of another shard
+                    if self.take_over(original, file_name, mtime_ns):
+                        return
+                    original = self.is_duplicate(file_name, size, mtime_ns)
+                if original is not None:
+                    handled = self.duplicate_handler.handle(file_name, original, size)
+                    if handled is not None:
+                        self.db.insert_row_if_not_exists('Duplicates', 'File_Name, Original, File_Size, Action',
+                                                         (handled[0], original, size, handled[1]), 'File_Name')
+            # For modified event
+            elif event.event_type in (EventTypes.MOVED, EventTypes.MODIFIED):
+                print(f"[+] Received {event.event_type} event of '{file_name}'.")
+                self.class_logger.logger.info("Received '%s' event of '%s'%s.", event.event_type, file_name,
+                                              f" to '{event.dest_path}'" if event.dest_path else '')
+
+    def delete_file(self, file_name):
+        """
+        Deletes a file from db, by its path, without reading it.
+        The duplicates of a deleted original point to the first of them still existing, which takes its place.
+        :param file_name: For the deleted file path.
+        """
+        print(f"[+] Received deleted event of '{file_name}'.")
+        self.forget_file(file_name)
+
+    def forget_file(self, file_name):
+        """
+        Auxiliary method for deleting the rows of a path whose content is gone, deleted or overwritten by a move.
+        :param file_name: For the file path.
+        """
+        # The rows are found through the File_Name indexes, the file is not read
+        self.db.delete_value('Duplicates', 'File_Name', file_name)
+        for stored_hash, algorithm in self.files_db.delete_returning('Files', 'File_Name', file_name,
+                                                                     'File_Hash, Hash_Algorithm'):
+            self.discard_hash(stored_hash)
+            self.promote_duplicate(file_name, stored_hash, algorithm)
+
+    def discard_hash(self, file_hash):
+        """
+        Auxiliary method for dropping a digest no longer stored from the hash index and the segments table.
+        :param file_hash: For the removed row digest, None if it was never computed.
+        """
+        if file_hash is None:
+            return
+        if self.hash_index is not None:
+            self.hash_index.discard(file_hash)
+        if self.hasher.tree_threshold is not None:
+            self.db.delete_value('Segments', 'File_Hash', file_hash)
+
+    def refresh_stored_file(self, file_name, size, mtime_ns):
+        """
+        Auxiliary method for a created event of an already stored path, e.g. a repeated or a rewritten file.
+        An unchanged file is kept as is, the row of a changed one is dropped so the file is stored again, every
+        path has a single row.
+        :param file_name: For the created file path.
+        :param size: For the created file size in bytes.
+        :param mtime_ns: For the created file mtime, None if unknown.
+        :return: True if the path is stored with the same size and mtime, False otherwise.
+        """
+        stored = self.files_db.select_rows('Files', 'File_Size, Mtime_Ns', 'File_Name', file_name)
+        if not stored:
+            return False
+        if mtime_ns is not None and stored[0] == (size, mtime_ns):
+            return True
+        for stored_hash, in self.files_db.delete_returning('Files', 'File_Name', file_name, 'File_Hash'):
+            self.discard_hash(stored_hash)
+        return False
+
+    def take_over(self, original, file_name, mtime_ns):
+        """
+        Rewrites the stored row of a vanished original to a file with the same content, instead of handling the file
+        as its duplicate. A move between shards is a delete and a create, which may be processed in any order.
+        :param original: For the stored original path, which does not exist anymore.
+        :param file_name: For the created file path.
+        :param mtime_ns: For the created file mtime, None if unknown.
+        :return: True if the row has been rewritten, False if it has been deleted meanwhile.
+        """
+        if not self.files_db.update_table('Files', 'File_Name', file_name, 'File_Name', original):
+            return False
+        if mtime_ns is not None:
+            self.files_db.update_table('Files', 'Mtime_Ns', mtime_ns, 'File_Name', file_name)
+        self.db.update_table('Duplicates', 'Original', file_name, 'Original', original)
+        self.class_logger.logger.info("File '%s' took over the row of vanished original '%s'.", file_name, original)
+        return True
+
+    def promote_duplicate(self, original, file_hash, algorithm):
+        """
+        Replaces a deleted original by one of its duplicates still existing, the other duplicates are re-pointed to it.
+        Duplicates keeping a supported name are preferred, quarantined duplicates never replace an original.
+        :param original: For the deleted original path.
+        :param file_hash: For the original digest.
+        :param algorithm: For the original digest algorithm.
+        """
+        duplicates = self.db.select_rows('Duplicates', 'File_Name, File_Size, Action', 'Original', original)
+        if not duplicates:
+            return
+        candidates = sorted((row for row in duplicates if row[2] != DuplicateActions.QUARANTINE),
+                            key=lambda row: pathlib.Path(row[0]).suffix not in self.file_types)
+        for file_name, size, _ in candidates:
+            try:
+                mtime_ns = os.stat(file_name).st_mtime_ns
+            except OSError:
+                continue
+            self.db.delete_value('Duplicates', 'File_Name', file_name)
+            self.files_db.insert_row('Files', 'File_Name, File_Hash, Hash_Algorithm, File_Size, Mtime_Ns',
+                                     (file_name, file_hash, algorithm, size, mtime_ns))
+            self.index_hash(file_hash)
+            self.db.update_table('Duplicates', 'Original', file_name, 'Original', original)
+            self.class_logger.logger.info("Duplicate '%s' replaced deleted original '%s'.", file_name, original)
+            return
+        self.db.delete_value('Duplicates', 'Original', original)
+
+    def move_file(self, event):
+        """
+        Rewrites the stored path of a moved file, its content is not read again.
+        Stored paths may have no supported type, e.g. renamed duplicates, promoted ones included, see
+        promote_duplicate, their rows are rewritten too.
+        A moved file stored in neither table, e.g. a finished download moved to a supported type, or a file whose
+        created event failed, is processed as created.
+        :param event: For the 'moved' FileEvent.
+        """
+        print(f"[+] Received moved event of '{event.src_path}' to '{event.dest_path}'.")
+        if event.dest_path != event.src_path:
+            # A file saved by renaming a temporary file over it, its previous content is gone
+            self.forget_file(event.dest_path)
+        if self.files_db.update_table('Files', 'File_Name', event.dest_path, 'File_Name', event.src_path):
+            self.class_logger.logger.info("Moved '%s' to '%s'.", event.src_path, event.dest_path)
+            self.db.update_table('Duplicates', 'Original', event.dest_path, 'Original', event.src_path)
+            return
+        if self.db.update_table('Duplicates', 'File_Name', event.dest_path, 'File_Name', event.src_path):
+            return
+        if self.validate_file_type(event.dest_path):
+            self.process_file_event(FileEvent(EventTypes.CREATED, event.dest_path))
+
+    def is_duplicate(self, file_name, size, mtime_ns=None):
+        """
+        Checks if a created file content already exists in db, storing it otherwise.
+        :param file_name: For the created file path.
+        :param size: For the created file size in bytes.
+        :param mtime_ns: For the created file mtime, stored for the startup reconciliation.
+        :return: The stored file path with the same content if the file is a duplicate, None otherwise.
+        """
+        if self.refresh_stored_file(file_name, size, mtime_ns):
+            self.class_logger.logger.info("File '%s' is already stored, skipping hash.", file_name)
+            return None
+        if self.dedup_mode == DedupModes.TIERED:
+            with self.size_locks[size % len(self.size_locks)]:
+                return self.is_duplicate_tiered(file_name, size, mtime_ns)
+        if self.stale_hashes:
+            with self.size_locks[size % len(self.size_locks)]:
+                self.rehash_stale_files(size)
+        file_hash = self.hash_file(file_name)
+        if file_hash is None:
+            return None
+        columns = 'File_Name, File_Hash, Hash_Algorithm, File_Size, Mtime_Ns'
+        values = (file_name, file_hash, self.hasher.digest_name(size), size, mtime_ns)
+        if self.hash_index is None:
+            # Insert the file only if its hash does not exist in db, a failed insert is not a duplicate
+            inserted = self.files_db.insert_row_if_not_exists('Files', columns, values, self.HASH_KEY)
+        else:
+            with self.hash_locks[hash(file_hash) % len(self.hash_locks)]:
+                if not self.hash_index.might_contain(file_hash):
+                    # Definitely new, no need to look the hash up in db
+                    self.files_db.insert_row('Files', columns, values)
+                    self.hash_index.add(file_hash)
+                    return None
+                inserted = self.files_db.insert_row_if_not_exists('Files', columns, values, self.HASH_KEY)
+                if inserted:
+                    self.hash_index.add(file_hash)
+        if inserted is not False:
+            return None
+        originals = [row for row in self.files_db.select_rows('Files', 'File_Name, Hash_Algorithm', 'File_Hash',
+                                                              file_hash) if row[1] == values[2]]
+        if not originals:
+            # The stored row has been deleted meanwhile, e.g. by the delete of a moved file source
+            if self.files_db.insert_row_if_not_exists('Files', columns, values, self.HASH_KEY):
+                self.index_hash(file_hash)
+            return None
+        # A file recreated on its own stored path is not a duplicate
+        if originals[0][0] == file_name:
+            return None
+        return originals[0][0]
+
+    def has_stale_hashes(self):
+        """
+        Auxiliary method for checking if stored files have no digest of the configured algorithm, e.g. after the
+        algorithm or the dedup mode changed. Files without a size can not be compared and are not counted.
+        :return: True if at least one stored file has to be hashed again, False otherwise.
+        """
+        if self.hasher.tree_threshold is None:
+            expected, parameters = '?', (self.hasher.algorithm,)
+        else:
+            expected = 'CASE WHEN File_Size >= ? THEN ? ELSE ? END'
+            parameters = (self.hasher.tree_threshold, self.hasher.digest_name(self.hasher.tree_threshold),
+                          self.hasher.algorithm)
+        stale = self.files_db.stream_rows('Files', 'File_Name', f"File_Size IS NOT NULL AND "
+                                          f"(File_Hash IS NULL OR Hash_Algorithm IS NOT {expected})",
+                                          chunk_size=1, parameters=parameters)
+        if next(stale, None) is None:
+            return False
+        print("[+] Stored files hashed with another algorithm are hashed again on their first size collision.")
+        return True
+
+    def rehash_stale_files(self, size):
+        """
+        Hashes again the stored files of a given size without a digest of the configured algorithm, so they are
+        compared with a created file of the same size. Stale files turning out duplicates of each other are recorded
+        in the Duplicates table, without any action applied.
+        :param size: For the created file size in bytes.
+        """
+        digest_name = self.hasher.digest_name(size)
+        columns = 'File_Name, File_Hash, Hash_Algorithm, File_Size, Mtime_Ns'
+        for file_name, file_hash, algorithm, _, mtime_ns in self.files_db.select_rows('Files', columns,
+                                                                                      'File_Size', size):
+            if file_hash is not None and algorithm == digest_name:
+                continue
+            new_hash = self.hash_file(file_name)
+            if new_hash is None:
+                continue
+            # The digest routes the row of a sharded DB, the row is stored again instead of updated
+            self.files_db.delete_value('Files', 'File_Name', file_name)
+            self.discard_hash(file_hash)
+            with self.hash_locks[hash(new_hash) % len(self.hash_locks)]:
+                inserted = self.files_db.insert_row_if_not_exists('Files', columns, (file_name, new_hash, digest_name,
+                                                                                     size, mtime_ns), self.HASH_KEY)
+                if inserted:
+                    self.index_hash(new_hash)
+            if inserted is False:
+                originals = [row[0] for row in self.files_db.select_rows('Files', 'File_Name, Hash_Algorithm',
+                                                                         'File_Hash', new_hash)
+                             if row[1] == digest_name]
+                if originals:
+                    self.db.insert_row_if_not_exists('Duplicates', 'File_Name, Original, File_Size, Action',
+                                                     (file_name, originals[0], size, None), 'File_Name')
+
+    def is_duplicate_tiered(self, file_name, size, mtime_ns=None):
+        """
+        Tiered duplicates check, every tier reads more of the file only if the previous one collided:
+        1. a unique file size can not be a duplicate, the file is not read at all.
+        2. a head/tail sample hash is compared against the same size files.
+        3. the full content hash is compared against the same sample files.
+        Sample and full hashes of stored files are computed lazily, the first time another file collides with them,
+        and computed again for files stored with another algorithm.
+        :param file_name: For the created file path.
+        :param size: For the created file size in bytes.
+        :param mtime_ns: For the created file mtime, stored for the startup reconciliation.
+        :return: The stored file path with the same content if the file is a duplicate, None otherwise.
+        """
+        # The path own row has been dropped by refresh_stored_file, every same size row is another file
+        candidates = self.files_db.select_rows('Files', 'File_Name, Sample_Hash, File_Hash, Hash_Algorithm',
+                                               'File_Size', size)
+        digest_name = self.hasher.digest_name(size)
+        if not candidates:
+            self.class_logger.logger.info("File '%s' size is unique, skipping hash.", file_name)
+            self.files_db.insert_row('Files', 'File_Name, File_Size, Mtime_Ns, Hash_Algorithm',
+                                     (file_name, size, mtime_ns, digest_name))
+            return None
+
+        sample_hash = self.hash_sample(file_name)
+        if sample_hash is None:
+            return None
+        matching = []
+        for candidate_name, candidate_sample, candidate_hash, candidate_algorithm in candidates:
+            if candidate_algorithm != digest_name:
+                # Hashes of another algorithm are not comparable, they are dropped and computed again
+                self.files_db.update_table('Files', 'File_Hash', None, 'File_Name', candidate_name)
+                self.files_db.update_table('Files', 'Hash_Algorithm', digest_name, 'File_Name', candidate_name)
+                self.discard_hash(candidate_hash)
+                candidate_sample = candidate_hash = None
+            if candidate_sample is None:
+                candidate_sample = self.hash_sample(candidate_name)
+                self.files_db.update_table('Files', 'Sample_Hash', candidate_sample, 'File_Name', candidate_name)
+            if candidate_sample == sample_hash:
+                matching.append((candidate_name, candidate_hash))
+        if not matching:
+            self.files_db.insert_row('Files', 'File_Name, File_Size, Mtime_Ns, Sample_Hash, Hash_Algorithm',
+                                     (file_name, size, mtime_ns, sample_hash, digest_name))
+            return None
+        # The sample already covers the whole file
+        if size <= self.SAMPLE_SIZE * 2:
+            return matching[0][0]
+
+        file_hash = self.hash_file(file_name)
+        if file_hash is None:
+            return None
+        for candidate_name, candidate_hash in matching:
+            if candidate_hash is None:
+                candidate_hash = self.hash_file(candidate_name)
+                self.files_db.update_table('Files', 'File_Hash', candidate_hash, 'File_Name', candidate_name)
+                self.index_hash(candidate_hash)
+            if candidate_hash == file_hash:
+                return candidate_name
+        self.files_db.insert_row('Files', 'File_Name, File_Size, Mtime_Ns, Sample_Hash, File_Hash, Hash_Algorithm',
+                                 (file_name, size, mtime_ns, sample_hash, file_hash, digest_name))
+        self.index_hash(file_hash)
+        return None
+
+    def index_hash(self, file_hash):
+        """
+        Auxiliary method for adding a stored digest to the hash index, keeping it in sync in tiered mode too.
+        :param file_hash: For the stored digest.
+        """
+        if self.hash_index is not None and file_hash is not None:
+            self.hash_index.add(file_hash)
 
     def run(self):
         """
@@ -140,11 +586,11 @@ class Consumer(Thread):
         """
         self.setup_consumer_db()
         try:
-            self.channel.basic_consume(queue=self.queue, on_message_callback=self.on_notification_receive)
-            print(f"[+] Consumer is now listening to RabbitMQ queue '{self.queue}'...")
-            self.channel.start_consuming()
-        except (pika.exceptions.ConnectionClosedByBroker, pika.exceptions.ConnectionClosed,
-                pika.exceptions.AMQPConnectionError) as err:
+            for queue_name in self.queues:
+                self.transport.consume(queue_name, self.on_notification_receive)
+            print(f"[+] Consumer is now listening to RabbitMQ queues '{', '.join(self.queues)}'...")
+            self.transport.run()
+        except TransportError as err:
             print(f"[!] Connection closed due to {err}, Trying to reconnect...")
             self.class_logger.logger.error(f"Connection to RabbitMQ Server forcibly closed, Error: {err}")
             time.sleep(self.RECONNECTING_BUFFER)
@@ -152,28 +598,39 @@ class Consumer(Thread):
 
     def hash_file(self, file):
         """
-        Generating md5 hash for a given file.
+        Generating the configured digest for a given file.
         :param file: For the file to hash.
-        :return: The given file md5 hash code.
+        :return: The given file hash code.
         """
         try:
-            file_to_hash = open(file, 'rb')
-            # For file first block
-            chunk = file_to_hash.read(self.chunk_size)
-            # Read until EOF
-            while chunk:
-                self.hash.update(chunk)
-                chunk = file_to_hash.read(self.chunk_size)
-        except (FileNotFoundError, FileExistsError) as err:
+            if self.hash_cache is not None:
+                hash_result = self.hash_cache.hash_file(self.hasher, file)
+            else:
+                hash_result = self.hasher.hash_file(file)
+            self.class_logger.logger.info("File '%s' %s hash is: '%s'.", file, self.hasher.algorithm, hash_result)
+            return hash_result
+        except (FileNotFoundError, FileExistsError, OSError) as err:
             self.class_logger.logger.error(f"Unable to read '{file}', Error: {err}")
 
+    def store_segments(self, file_hash, segment_hashes):
+        """
+        Hasher callback, stores the segment digests of a tree hashed file, runs on the hashing worker.
+        :param file_hash: For the file root digest.
+        :param segment_hashes: For the hex segment digests, in file order.
+        """
+        self.db.insert_rows('Segments', 'File_Hash, Segment, Segment_Hash',
+                            [(file_hash, index, segment_hash) for index, segment_hash in enumerate(segment_hashes)])
+
+    def hash_sample(self, file):
+        """
+        Generating a head/tail sample hash for a given file.
+        :param file: For the file to hash.
+        :return: The given file sample hash code.
+        """
         try:
-            # Returns the file hash
-            hash_result = self.hash.hexdigest()
-            self.class_logger.logger.info(f"File '{file}' md5 hash is: '{hash_result}'.")
-            return hash_result
-        except FileNotFoundError as err:
-            self.class_logger.logger.error(f"Unable to generate md5 hash for '{file}', Error: {err}")
+            return self.hasher.hash_sample(file, self.SAMPLE_SIZE)
+        except OSError as err:
+            self.class_logger.logger.error(f"Unable to read sample of '{file}', Error: {err}")
 
     def validate_file_type(self, file):
         """
@@ -183,7 +640,7 @@ class Consumer(Thread):
         """
         file_type = pathlib.Path(file).suffix
         if file_type in self.file_types:
-            self.class_logger.logger.info(f"File type '{file_type}' is supported.")
+            self.class_logger.logger.info("File type '%s' is supported.", file_type)
             return True
         else:
             self.class_logger.logger.error(f"File type '{file_type}' is NOT supported.")
@@ -197,26 +654,25 @@ class Consumer(Thread):
         """
         try:
             file_size = os.path.getsize(file)
-            self.class_logger.logger.info(f"File '{file}' size is: {file_size}")
+            self.class_logger.logger.info("File '%s' size is: %s", file, file_size)
             return file_size
         except FileNotFoundError as err:
             self.class_logger.logger.error(f"Unable to get file '{file}' size, Error: {err}")
 
     @staticmethod
-    def get_file_process_time(size_in_bytes):
+    def get_file_size_band(size_in_bytes):
         """
-        Auxiliary method for converting size of bytes to units representation.
-        :param size_in_bytes: For the size of bytes to calculate.
-        :return: The processing time according to the unit size.
+        Auxiliary method for converting size of bytes to units representation, used as the scheduling band.
+        :param size_in_bytes: For the size of bytes to calculate, negative if unknown.
+        :return: The SizeUnits value of the unit size, KB for unknown sizes.
         """
-        if size_in_bytes in SizeUnits.KB_RANGE.value:
+        if size_in_bytes < 0 or size_in_bytes in SizeUnits.KB_RANGE.value:
             return SizeUnits.KB.value
         elif size_in_bytes in SizeUnits.MB_RANGE.value:
             return SizeUnits.MB.value
         elif size_in_bytes in SizeUnits.GB_RANGE.value:
             return SizeUnits.GB.value
-        elif size_in_bytes in SizeUnits.TB_RANGE.value:
-            return SizeUnits.TB.value
+        return SizeUnits.TB.value
 
 
 """
@@ -231,6 +687,17 @@ class EventTypes:
     MODIFIED = 'modified'
 
 
+"""
+Auxiliary class for duplicates detection modes.
+"""
+
+
+class DedupModes:
+    FULL = 'full'
+    TIERED = 'tiered'
+    ALL = (FULL, TIERED)
+
+
 """
 Auxiliary class for file size units and ranges.
 """
@@ -1,20 +1,39 @@
 """
 DB class for creating and customize the Consumer needed SQLite tables.
 DB is written with SQL parameterized queries to prevent SQL Injection.
+In write behind mode the database runs in WAL mode and mutations are group committed,
+every commit_every operations or commit_interval seconds, whichever comes first.
 """
 import sqlite3
+import threading
+from contextlib import contextmanager
 from logger import Logger
+from metrics import REGISTRY, DB_SECONDS
 
 
 class DB:
 
-    def __init__(self):
+    def __init__(self, write_behind=False, commit_every=1000, commit_interval=0.05):
         """
         Class Constructor.
         Initializes the connection and cursor elements to None.
+        The connection is shared by the consumer workers, so every statement runs under the lock.
+        :param write_behind: For group committing mutations instead of committing each one,
+                             mutations of the last commit_interval seconds may be lost on a crash.
+        :param commit_every: For the number of mutations committed at once in write behind mode.
+        :param commit_interval: For the maximal seconds a mutation stays uncommitted in write behind mode.
         """
         self.conn = None
         self.cursor = None
+        self.lock = threading.RLock()
+        self.write_behind = write_behind
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        # Depth of the nested batch blocks, mutations are committed when the outermost one exits
+        self.batching = 0
+        self.flusher = None
+        self.stopped = threading.Event()
         self.class_logger = Logger('DB')
 
     def setup_db(self, name):
@@ -23,28 +42,87 @@ class DB:
         :param name: For the name of the database to setup.
         """
         try:
-            self.conn = sqlite3.connect(name)
+            self.conn = sqlite3.connect(name, check_same_thread=False)
             self.cursor = self.conn.cursor()
+            if self.write_behind:
+                # WAL with synchronous NORMAL syncs the log on checkpoints only, not on every commit
+                self.cursor.execute("PRAGMA journal_mode=WAL")
+                self.cursor.execute("PRAGMA synchronous=NORMAL")
+                self.flusher = threading.Thread(target=self.run_flusher, daemon=True, name='db-flusher')
+                self.flusher.start()
             self.class_logger.logger.info(f"Connected to Database '{name}' successfully.")
             return True
         except sqlite3.Error as err:
             self.class_logger.logger.error(f"Error connecting to database, Error {err}.")
             return False
 
+    def commit(self):
+        """
+        Commits a mutation, in write behind mode or in a batch block only every commit_every mutations,
+        see run_flusher and batch.
+        """
+        with self.lock:
+            if not self.write_behind and not self.batching:
+                self.conn.commit()
+                return
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.flush()
+
+    @REGISTRY.timed(DB_SECONDS, 'flush')
+    def flush(self):
+        """
+        Commits the pending write behind mutations.
+        """
+        with self.lock:
+            if self.uncommitted:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    @contextmanager
+    def batch(self):
+        """
+        Groups the mutations of a block in a single commit, made when the block exits, the lock is held meanwhile.
+        In write behind mode the mutations are left to the flusher.
+        """
+        with self.lock:
+            self.batching += 1
+            try:
+                yield self
+            finally:
+                self.batching -= 1
+                if not self.batching and not self.write_behind:
+                    self.flush()
+
+    def run_flusher(self):
+        """
+        Write behind flusher thread loop, commits the pending mutations every commit_interval seconds.
+        """
+        while not self.stopped.wait(self.commit_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as err:
+                self.class_logger.logger.error(f"Error committing pending mutations, Error: {err}")
+
     def close_db(self):
         """
-        Closes database elements and save the data.
+        Closes database elements and save the data, including the pending write behind mutations.
         """
-        try:
-            self.conn.commit()
-            self.class_logger.logger.info(f"Saved all database data successfully.")
-            self.cursor.close()
-            self.class_logger.logger.info(f"Closed '{self.cursor}' successfully.")
-            self.conn.close()
-            self.class_logger.logger.info(f"Closed '{self.conn}' successfully.")
-        except sqlite3.Error as err:
-            print("[!] Unable to close database.")
-            self.class_logger.logger.error(f"Error closing database, Error: {err}")
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        with self.lock:
+            try:
+                self.conn.commit()
+                self.uncommitted = 0
+                self.class_logger.logger.info(f"Saved all database data successfully.")
+                self.cursor.close()
+                self.class_logger.logger.info(f"Closed '{self.cursor}' successfully.")
+                self.conn.close()
+                self.class_logger.logger.info(f"Closed '{self.conn}' successfully.")
+            except sqlite3.Error as err:
+                print("[!] Unable to close database.")
+                self.class_logger.logger.error(f"Error closing database, Error: {err}")
 
     def create_table(self, table_name, columns):
         """
@@ -52,14 +130,65 @@ class DB:
         :param table_name: For the table name.
         :param columns: For the table columns.
         """
-        try:
-            self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})")
-            self.conn.commit()
-            self.class_logger.logger.info(f"Created Table '{table_name}' successfully.")
-        except sqlite3.Error as err:
-            print(f"[!] Unable to create table '{table_name}'.")
-            self.class_logger.logger.error(f"Error creating table {err}.")
+        with self.lock:
+            try:
+                self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})")
+                self.conn.commit()
+                self.class_logger.logger.info(f"Created Table '{table_name}' successfully.")
+            except sqlite3.Error as err:
+                print(f"[!] Unable to create table '{table_name}'.")
+                self.class_logger.logger.error(f"Error creating table {err}.")
 
+    def create_index(self, index_name, table_name, columns, unique=False):
+        """
+        Creates an index on a given table if it doesn't already exists.
+        :param index_name: For the index name.
+        :param table_name: For the indexed table.
+        :param columns: For the comma separated indexed columns.
+        :param unique: For creating a UNIQUE index.
+        """
+        with self.lock:
+            try:
+                self.cursor.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index_name} "
+                                    f"ON {table_name} ({columns})")
+                self.conn.commit()
+                self.class_logger.logger.info(f"Created index '{index_name}' on '{table_name}' successfully.")
+            except sqlite3.Error as err:
+                print(f"[!] Unable to create index '{index_name}' on '{table_name}'.")
+                self.class_logger.logger.error(f"Error creating index {err}.")
+
+    def drop_index(self, index_name):
+        """
+        Drops an index if it exists, used for replacing indexes of databases created by older versions.
+        :param index_name: For the index name.
+        """
+        with self.lock:
+            try:
+                self.cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+                self.conn.commit()
+            except sqlite3.Error as err:
+                print(f"[!] Unable to drop index '{index_name}'.")
+                self.class_logger.logger.error(f"Error dropping index {err}.")
+
+    def add_column_if_not_exists(self, table_name, column):
+        """
+        Adds a column to an existing table, used for upgrading databases created by older versions.
+        :param table_name: For the existing table.
+        :param column: For the column definition to add.
+        """
+        with self.lock:
+            try:
+                self.cursor.execute(f"PRAGMA table_info({table_name})")
+                existing_columns = [row[1] for row in self.cursor.fetchall()]
+                if column.split()[0] not in existing_columns:
+                    self.cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column}")
+                    self.conn.commit()
+                    self.class_logger.logger.info(f"Added column '{column}' to '{table_name}' successfully.")
+            except sqlite3.Error as err:
+                print(f"[!] Unable to add column '{column}' to '{table_name}'.")
+                self.class_logger.logger.error(f"Error adding column to table {err}.")
+
+    @REGISTRY.timed(DB_SECONDS, 'insert_value')
     def insert_value(self, table_name, table_column, value):
         """
         Inserting a new value to a given database table.
@@ -67,36 +196,91 @@ class DB:
         :param table_column: For the column to insert values to.
         :param value: For the value to insert.
         """
-        try:
-            self.cursor.execute(f"INSERT INTO {table_name} ({table_column}) VALUES(?)", (value,))
-            self.conn.commit()
-            self.class_logger.logger.info(f"Inserted '{value}' to '{table_name}' successfully.")
-        except sqlite3.Error as err:
-            print(f"[!] Unable to insert '{value}' to '{table_name}'.")
-            self.class_logger.logger.error(f"Error inserting '{value}' to table {err}.")
+        with self.lock:
+            try:
+                self.cursor.execute(f"INSERT INTO {table_name} ({table_column}) VALUES(?)", (value,))
+                self.commit()
+                self.class_logger.logger.info("Inserted '%s' to '%s' successfully.", value, table_name)
+            except sqlite3.Error as err:
+                print(f"[!] Unable to insert '{value}' to '{table_name}'.")
+                self.class_logger.logger.error(f"Error inserting '{value}' to table {err}.")
+
+    @REGISTRY.timed(DB_SECONDS, 'insert_row')
+    def insert_row(self, table_name, table_columns, values):
+        """
+        Inserting a new row to a given database table.
+        :param table_name: For the table to insert the row to.
+        :param table_columns: For the comma separated columns to insert values to.
+        :param values: For the values to insert, ordered as the columns.
+        """
+        with self.lock:
+            try:
+                placeholders = ', '.join('?' * len(values))
+                self.cursor.execute(f"INSERT INTO {table_name} ({table_columns}) VALUES({placeholders})", tuple(values))
+                self.commit()
+                self.class_logger.logger.info("Inserted '%s' to '%s' successfully.", values, table_name)
+            except sqlite3.Error as err:
+                print(f"[!] Unable to insert '{values}' to '{table_name}'.")
+                self.class_logger.logger.error(f"Error inserting '{values}' to table {err}.")
 
     def insert_if_not_exists(self, table_name, table_column, value):
         """
         Inserting a new value to a given database table only if it doesn't already exists.
+        The column must have a UNIQUE index, see insert_row_if_not_exists.
         :param table_name: For the table to insert values to.
         :param table_column: For the column to insert values to.
         :param value: For the value to insert.
-        :return: True if the value has been inserted successfully, False otherwise.
+        :return: True if the value has been inserted successfully, False if it exists, None on error.
         """
-        try:
-            self.cursor.execute(f"SELECT * FROM {table_name} WHERE {table_column}=?", (value,))
-            result = self.cursor.fetchone()
-            if result is None:
-                # Value does not exist and has been inserted successfully
-                self.insert_value(table_name, table_column, value)
-                return True
-            else:
-                self.class_logger.logger.info(f"'{value}' Exists in '{table_name}'")
+        return self.insert_row_if_not_exists(table_name, table_column, (value,), table_column)
+
+    @REGISTRY.timed(DB_SECONDS, 'insert_rows')
+    def insert_rows(self, table_name, table_columns, rows):
+        """
+        Inserting many rows to a given database table with a single statement, rows conflicting with a unique
+        index are skipped.
+        :param table_name: For the table to insert the rows to.
+        :param table_columns: For the comma separated columns to insert values to.
+        :param rows: For the value tuples to insert, ordered as the columns.
+        """
+        with self.lock:
+            try:
+                placeholders = ', '.join('?' * len(table_columns.split(',')))
+                self.cursor.executemany(f"INSERT OR IGNORE INTO {table_name} ({table_columns}) VALUES({placeholders})",
+                                        rows)
+                self.commit()
+                self.class_logger.logger.info("Inserted %s rows to '%s' successfully.", len(rows), table_name)
+            except sqlite3.Error as err:
+                print(f"[!] Unable to insert rows to '{table_name}'.")
+                self.class_logger.logger.error(f"Error inserting rows to '{table_name}' {err}.")
+
+    @REGISTRY.timed(DB_SECONDS, 'insert_row_if_not_exists')
+    def insert_row_if_not_exists(self, table_name, table_columns, values, unique_column):
+        """
+        Inserting a new row to a given database table only if its unique column value doesn't already exists.
+        The check and the insert are a single atomic 'INSERT ... ON CONFLICT DO NOTHING' statement.
+        :param table_name: For the table to insert the row to.
+        :param table_columns: For the comma separated columns to insert values to.
+        :param values: For the values to insert, ordered as the columns.
+        :param unique_column: For the column with the UNIQUE index to check.
+        :return: True if the row has been inserted successfully, False if it exists, None on error.
+        """
+        with self.lock:
+            try:
+                placeholders = ', '.join('?' * len(values))
+                self.cursor.execute(f"INSERT INTO {table_name} ({table_columns}) VALUES({placeholders}) "
+                                    f"ON CONFLICT({unique_column}) DO NOTHING", tuple(values))
+                self.commit()
+                if self.cursor.rowcount == 1:
+                    self.class_logger.logger.info("Inserted '%s' to '%s' successfully.", values, table_name)
+                    return True
+                self.class_logger.logger.info("'%s' of '%s' Exists in '%s'", unique_column, values, table_name)
                 return False
-        except sqlite3.Error as err:
-            print(f"[!] Unable to insert '{value}' to '{table_name}'.")
-            self.class_logger.logger.error(f"Error inserting '{value}' from '{table_name}' {err}.")
+            except sqlite3.Error as err:
+                print(f"[!] Unable to insert '{values}' to '{table_name}'.")
+                self.class_logger.logger.error(f"Error inserting '{values}' to '{table_name}' {err}.")
 
+    @REGISTRY.timed(DB_SECONDS, 'update_table')
     def update_table(self, table_name, column_to_update, value, current_table_column, existing_value):
         """
         Updates an existing table with a given value.
@@ -105,15 +289,22 @@ class DB:
         :param value: For the new value to add.
         :param current_table_column: For the existing table column.
         :param existing_value: For the existing table value.
+        :return: The number of updated rows, None on error.
         """
-        try:
-            self.cursor.execute(f"UPDATE {table_name} SET {column_to_update} = ? WHERE {current_table_column} = ?", (value, existing_value))
-            self.conn.commit()
-            self.class_logger.logger.info(f"Inserted '{value}' to '{column_to_update}' in '{table_name}' successfully.")
-        except (TypeError, sqlite3.Error) as err:
-            print(f"[!] Unable to update '{value}' in '{table_name}'")
-            self.class_logger.logger.error(f"Error updating table {err}.")
+        with self.lock:
+            try:
+                self.cursor.execute(f"UPDATE {table_name} SET {column_to_update} = ? WHERE {current_table_column} = ?", (value, existing_value))
+                updated = self.cursor.rowcount
+                self.commit()
+                self.class_logger.logger.info("Inserted '%s' to '%s' in '%s' successfully.", value, column_to_update,
+                                              table_name)
+            except (TypeError, sqlite3.Error) as err:
+                print(f"[!] Unable to update '{value}' in '{table_name}'")
+                self.class_logger.logger.error(f"Error updating table {err}.")
+                return None
+            return updated
 
+    @REGISTRY.timed(DB_SECONDS, 'delete_value')
     def delete_value(self, table_name, table_column, value_to_delete):
         """
         Deleting a given value from a given table.
@@ -121,14 +312,40 @@ class DB:
         :param table_column: For the table column to delete from.
         :param value_to_delete: For the value to delete.
         """
-        try:
-            self.cursor.execute(f"DELETE FROM {table_name} WHERE {table_column} = ?", (value_to_delete,))
-            self.conn.commit()
-            self.class_logger.logger.info(f"Deleted '{value_to_delete}' from '{table_name}' successfully.")
-        except sqlite3.Error as err:
-            print(f"[!] Unable to delete '{value_to_delete}' from '{table_name}'.")
-            self.class_logger.logger.error(f"Error deleting values from '{table_name}' {err}.")
+        with self.lock:
+            try:
+                self.cursor.execute(f"DELETE FROM {table_name} WHERE {table_column} = ?", (value_to_delete,))
+                self.commit()
+                self.class_logger.logger.info("Deleted '%s' from '%s' successfully.", value_to_delete, table_name)
+            except sqlite3.Error as err:
+                print(f"[!] Unable to delete '{value_to_delete}' from '{table_name}'.")
+                self.class_logger.logger.error(f"Error deleting values from '{table_name}' {err}.")
 
+    @REGISTRY.timed(DB_SECONDS, 'delete_returning')
+    def delete_returning(self, table_name, table_column, value_to_delete, returning_columns):
+        """
+        Deleting the rows matching a given value, returning some of their columns, in a single statement.
+        :param table_name: For the table to delete the rows from.
+        :param table_column: For the table column to match, should be indexed.
+        :param value_to_delete: For the value to delete.
+        :param returning_columns: For the comma separated columns of the deleted rows to return.
+        :return: List of the deleted rows, empty on error.
+        """
+        with self.lock:
+            try:
+                self.cursor.execute(f"DELETE FROM {table_name} WHERE {table_column} = ? RETURNING {returning_columns}",
+                                    (value_to_delete,))
+                rows = self.cursor.fetchall()
+                self.commit()
+                self.class_logger.logger.info("Deleted %s rows of '%s' from '%s' successfully.", len(rows),
+                                              value_to_delete, table_name)
+                return rows
+            except sqlite3.Error as err:
+                print(f"[!] Unable to delete '{value_to_delete}' from '{table_name}'.")
+                self.class_logger.logger.error(f"Error deleting values from '{table_name}' {err}.")
+                return []
+
+    @REGISTRY.timed(DB_SECONDS, 'select_value')
     def select_value(self, table_name, table_column):
         """
         Selects a specific table value and return it.
@@ -136,13 +353,61 @@ class DB:
         :param table_column: For the table column to select from.
         :return: The table value after unpacking.
         """
+        with self.lock:
+            try:
+                self.cursor.execute(f"SELECT {table_column} FROM {table_name}")
+                value = self.cursor.fetchone()[0]
+                return value
+            except sqlite3.Error as err:
+                print(f"[!] Unable to retrieve value from '{table_name}'")
+                self.class_logger.logger.error(f"Error retrieving value from '{table_name}' {err}.")
+
+    @REGISTRY.timed(DB_SECONDS, 'select_rows')
+    def select_rows(self, table_name, table_columns, condition_column, value):
+        """
+        Selects all rows matching a given value.
+        :param table_name: For the table to select from.
+        :param table_columns: For the comma separated columns to select.
+        :param condition_column: For the column to match.
+        :param value: For the value to match.
+        :return: List of the matching rows, empty on error.
+        """
+        with self.lock:
+            try:
+                self.cursor.execute(f"SELECT {table_columns} FROM {table_name} WHERE {condition_column} = ?", (value,))
+                return self.cursor.fetchall()
+            except sqlite3.Error as err:
+                print(f"[!] Unable to retrieve rows from '{table_name}'")
+                self.class_logger.logger.error(f"Error retrieving rows from '{table_name}' {err}.")
+                return []
+
+    def stream_rows(self, table_name, table_columns, condition=None, chunk_size=10000, parameters=()):
+        """
+        Streams the rows of a table in chunks, the lock is not held for the whole scan.
+        :param table_name: For the table to read.
+        :param table_columns: For the comma separated columns to select.
+        :param condition: For an optional WHERE clause, with '?' placeholders for the parameters.
+        :param chunk_size: For the number of rows read at once.
+        :param parameters: For the WHERE clause parameters.
+        :return: Generator of the rows, stopping on error.
+        """
+        where = f" WHERE {condition}" if condition else ''
         try:
-            self.cursor.execute(f"SELECT {table_column} FROM {table_name}")
-            value = self.cursor.fetchone()[0]
-            return value
+            with self.lock:
+                # A dedicated cursor, the shared one is used by the other statements meanwhile
+                cursor = self.conn.execute(f"SELECT {table_columns} FROM {table_name}{where}", tuple(parameters))
+            try:
+                while True:
+                    with self.lock:
+                        rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
         except sqlite3.Error as err:
-            print(f"[!] Unable to retrieve value from '{table_name}'")
-            self.class_logger.logger.error(f"Error retrieving value from '{table_name}' {err}.")
+            print(f"[!] Unable to read rows from '{table_name}'")
+            self.class_logger.logger.error(f"Error reading rows from '{table_name}' {err}.")
 
     def print_all_database(self, table_name):
         """
@@ -150,11 +415,11 @@ class DB:
         :param table_name: For the wanted table to print out.
         """
         counter = 0
-        self.cursor.execute(f"SELECT * FROM {table_name} ")
-        columns = [description[0] for description in self.cursor.description]
-        rows = self.cursor.fetchall()
+        # A dedicated cursor, rows are streamed instead of loaded at once
+        cursor = self.conn.execute(f"SELECT * FROM {table_name} ")
+        columns = [description[0] for description in cursor.description]
         print(f"{'=' * 12} {table_name.upper()} TABLE: {'=' * 12}")
-        for row in rows:
+        for row in cursor:
             counter += 1
             print(f"File #{counter}: ")
             for col, val in zip(columns, row):
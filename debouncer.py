@@ -0,0 +1,172 @@
+"""
+EventDebouncer Class for coalescing bursts of file events before they are published.
+A single download produces a 'created' event followed by many 'modified' events, the debouncer merges
+them per path and emits one event only after the file size and mtime have been stable for a quiet period.
+"""
+import os
+import time
+from threading import Thread, Lock, Event
+from logger import Logger
+
+
+class PendingEvent:
+
+    def __init__(self, event_type, now):
+        """
+        Class Constructor.
+        :param event_type: For the coalesced event type.
+        :param now: For the monotonic time the event was seen.
+        """
+        self.event_type = event_type
+        self.last_event_time = now
+        self.last_stat = None
+        self.stable_since = now
+
+
+class EventDebouncer(Thread):
+
+    # Opens and closes do not change the file content, the consumer own reads produce them too
+    ACCESS_EVENTS = ('opened', 'closed', 'closed_no_write')
+
+    def __init__(self, emit, quiet_period=2.0, batch_size=256):
+        """
+        Class Constructor.
+        :param emit: For the callback publishing events, called with a list of (event_type, src_path, dest_path).
+        :param quiet_period: For the number of seconds a file must stay unchanged before its event is emitted.
+        :param batch_size: For the maximal number of events emitted at once.
+        """
+        super().__init__(daemon=True, name='event-debouncer')
+        self.emit = emit
+        self.quiet_period = quiet_period
+        self.batch_size = batch_size
+        self.poll_interval = min(quiet_period / 4, 0.25)
+        self.pending = {}
+        self.ready = []
+        self.lock = Lock()
+        self.stopped = Event()
+        self.class_logger = Logger('Debouncer')
+
+    def add(self, event_type, src_path, dest_path=None):
+        """
+        Merges a raw file event into the pending events, called from the observer thread, see add_events.
+        :param event_type: For the raw event type.
+        :param src_path: For the event source path.
+        :param dest_path: For the event destination path, for 'moved' events.
+        """
+        self.add_events([(event_type, src_path, dest_path)])
+
+    def add_events(self, events):
+        """
+        Merges a batch of raw file events into the pending events, in order, taking the lock once.
+        1. 'created' or 'modified' followed by 'modified' events is kept as the first event.
+        2. 'created' followed by 'deleted' cancels out and nothing is emitted.
+        3. 'modified' followed by 'deleted' is emitted as 'deleted'.
+        4. 'moved' of a pending 'created' file is tracked as 'created' on the destination path.
+        5. 'opened', 'closed' and 'closed_no_write' are folded into the pending event of the path, or dropped.
+        :param events: For the (event_type, src_path, dest_path) tuples.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for event_type, src_path, dest_path in events:
+                self.merge(event_type, src_path, dest_path, now)
+
+    def merge(self, event_type, src_path, dest_path, now):
+        """
+        Auxiliary method for merging a single raw event, the lock must be held.
+        :param event_type: For the raw event type.
+        :param src_path: For the event source path.
+        :param dest_path: For the event destination path, for 'moved' events.
+        :param now: For the monotonic time the event was seen.
+        """
+        pending = self.pending.get(src_path)
+        if event_type == 'deleted':
+            if pending is not None and pending.event_type == 'created':
+                del self.pending[src_path]
+                self.class_logger.logger.info("Dropped created and deleted events of '%s'.", src_path)
+            else:
+                self.pending.pop(src_path, None)
+                self.ready.append(('deleted', src_path, None))
+        elif event_type in ('created', 'modified'):
+            if pending is None:
+                self.pending[src_path] = PendingEvent(event_type, now)
+            else:
+                pending.last_event_time = now
+        elif event_type in self.ACCESS_EVENTS:
+            # The content changes of a written file are already reported by its pending event
+            return
+        elif event_type == 'moved':
+            if pending is not None and pending.event_type == 'created':
+                del self.pending[src_path]
+                self.pending[dest_path] = PendingEvent('created', now)
+            else:
+                if pending is not None:
+                    del self.pending[src_path]
+                    self.ready.append((pending.event_type, src_path, None))
+                self.ready.append(('moved', src_path, dest_path))
+        else:
+            self.ready.append((event_type, src_path, dest_path))
+
+    def collect(self):
+        """
+        Auxiliary method for collecting the events that are ready to be emitted.
+        :return: List of (event_type, src_path, dest_path) tuples.
+        """
+        now = time.monotonic()
+        with self.lock:
+            ready, self.ready = self.ready, []
+            quiet = [(path, pending) for path, pending in self.pending.items()
+                     if now - pending.last_event_time >= self.quiet_period]
+        for path, pending in quiet:
+            try:
+                file_stat = os.stat(path)
+                current = (file_stat.st_size, file_stat.st_mtime_ns)
+            except OSError:
+                # File is gone, its 'deleted' event will follow
+                current = None
+            with self.lock:
+                if self.pending.get(path) is not pending:
+                    continue
+                if current is None:
+                    del self.pending[path]
+                    continue
+                if current != pending.last_stat:
+                    pending.last_stat = current
+                    pending.stable_since = now
+                # The file mtime tells how long it has been unchanged before the first stat
+                mtime_age = time.time() - current[1] / 1e9
+                if now - pending.stable_since >= self.quiet_period or mtime_age >= self.quiet_period:
+                    del self.pending[path]
+                    ready.append((pending.event_type, path, None))
+        return ready
+
+    def run(self):
+        """
+        Emits events once they are ready, until stopped.
+        """
+        while not self.stopped.wait(self.poll_interval):
+            self.emit_all(self.collect())
+
+    def emit_all(self, events):
+        """
+        Auxiliary method for emitting events in batches, errors are logged so the debouncer keeps running.
+        :param events: For the (event_type, src_path, dest_path) tuples to emit.
+        """
+        for start in range(0, len(events), self.batch_size):
+            batch = events[start:start + self.batch_size]
+            try:
+                self.emit(batch)
+            except Exception as err:
+                self.class_logger.logger.error(f"Unable to emit {len(batch)} events, Error: {err}")
+
+    def stop(self):
+        """
+        Stops the debouncer, emitting all the pending events.
+        """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        with self.lock:
+            ready, self.ready = self.ready, []
+            ready.extend((pending.event_type, path, None) for path, pending in self.pending.items())
+            self.pending.clear()
+        self.emit_all(ready)
@@ -0,0 +1,217 @@
+"""
+DuplicateHandler Class for acting on the duplicate files found by the Consumer.
+1. rename - the duplicate is renamed to '{file_name}_dup_{counter}', never overwriting an earlier duplicate.
+2. hardlink - the duplicate is replaced with a hardlink to the original file, its space is reclaimed,
+   but changing either file changes both.
+3. reflink - the duplicate is replaced with a copy on write clone of the original (FICLONE), its space is reclaimed
+   and the files stay independent, on filesystems supporting it (btrfs, XFS, ...).
+4. quarantine - the duplicate is moved to a quarantine directory.
+Linking actions first compare the files byte for byte, and fall back to renaming if they differ or can not be linked.
+Replacements are atomic, a temporary link is renamed over the duplicate.
+"""
+import errno
+import os
+import shutil
+import threading
+import time
+from logger import Logger
+from metrics import REGISTRY, DUPLICATES, RECLAIMED_BYTES
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+class DuplicateHandler:
+
+    TEMP_SUFFIX = '.dedup-tmp'
+
+    def __init__(self, action='rename', quarantine_dir=None, governor=None, buffer_size=1024 * 1024):
+        """
+        Class Constructor.
+        :param action: For the duplicate action, see DuplicateActions.
+        :param quarantine_dir: For the directory duplicates are moved to, required by the 'quarantine' action.
+        :param governor: For the IOGovernor limiting the verification reads bandwidth.
+        :param buffer_size: For the size in bytes of the verification read buffers.
+        """
+        if action not in DuplicateActions.ALL:
+            raise ValueError(f"Unsupported duplicate action '{action}'.")
+        if action == DuplicateActions.QUARANTINE and not quarantine_dir:
+            raise ValueError("The 'quarantine' duplicate action requires a quarantine directory.")
+        self.action = action
+        self.quarantine_dir = quarantine_dir
+        self.governor = governor
+        self.buffer_size = buffer_size
+        # (device, inode) of the files replaced by links, their own events must not be handled again
+        self.linked = set()
+        self.lock = threading.Lock()
+        self.class_logger = Logger('Duplicates')
+
+    def handle(self, file_name, original, size):
+        """
+        Acts on a duplicate file.
+        :param file_name: For the duplicate file path.
+        :param original: For the stored file path with the same digest.
+        :param size: For the duplicate size in bytes.
+        :return: Tuple of the duplicate path after the action and the applied action, None if the action failed.
+        """
+        if self.action == DuplicateActions.QUARANTINE:
+            path, action = self.quarantine(file_name), DuplicateActions.QUARANTINE
+        elif self.action in (DuplicateActions.HARDLINK, DuplicateActions.REFLINK) and \
+                self.link(file_name, original, size):
+            path, action = file_name, self.action
+        else:
+            path, action = self.rename(file_name), DuplicateActions.RENAME
+        if path is None:
+            return None
+        if REGISTRY.enabled:
+            DUPLICATES.inc(1, action)
+        return path, action
+
+    @staticmethod
+    def unique_path(path):
+        """
+        Auxiliary method for finding a path not in use, adding a counter.
+        :param path: For the path prefix.
+        :return: The first of '{path}_1', '{path}_2', ... which does not exist.
+        """
+        counter = 1
+        while os.path.lexists(f"{path}_{counter}"):
+            counter += 1
+        return f"{path}_{counter}"
+
+    def rename(self, file_name):
+        """
+        Renames a duplicate to '{file_name}_dup_{counter}'.
+        :param file_name: For the duplicate file path.
+        :return: The new path, None on error.
+        """
+        new_name = self.unique_path(f"{file_name}_dup")
+        try:
+            os.rename(file_name, new_name)
+            self.class_logger.logger.info("Changed %s to %s", file_name, new_name)
+            return new_name
+        except OSError as err:
+            self.class_logger.logger.error(f"Unable to rename {file_name}, Error: {err}")
+
+    def quarantine(self, file_name):
+        """
+        Moves a duplicate to the quarantine directory.
+        :param file_name: For the duplicate file path.
+        :return: The quarantined path, None on error.
+        """
+        try:
+            os.makedirs(self.quarantine_dir, exist_ok=True)
+            destination = os.path.join(self.quarantine_dir, os.path.basename(file_name))
+            if os.path.lexists(destination):
+                destination = self.unique_path(destination)
+            shutil.move(file_name, destination)
+            self.class_logger.logger.info("Moved %s to quarantine as %s", file_name, destination)
+            return destination
+        except (OSError, shutil.Error) as err:
+            self.class_logger.logger.error(f"Unable to quarantine {file_name}, Error: {err}")
+
+    def link(self, file_name, original, size):
+        """
+        Replaces a duplicate with a hardlink or a reflink of the original, once verified byte for byte.
+        :param file_name: For the duplicate file path.
+        :param original: For the original file path.
+        :param size: For the duplicate size in bytes.
+        :return: True if the duplicate has been replaced or already was, False if it should be renamed instead.
+        """
+        try:
+            file_stat = os.stat(file_name)
+            if os.path.samestat(file_stat, os.stat(original)):
+                return True
+            with self.lock:
+                # The event of a link this handler made itself
+                if (file_stat.st_dev, file_stat.st_ino) in self.linked:
+                    self.linked.discard((file_stat.st_dev, file_stat.st_ino))
+                    return True
+            if not self.same_content(file_name, original):
+                self.class_logger.logger.error(f"'{file_name}' and '{original}' digests match but their content "
+                                               f"differs, not linking them.")
+                return False
+            temp_name = self.unique_path(os.path.join(os.path.dirname(file_name),
+                                                      f".{os.path.basename(file_name)}{self.TEMP_SUFFIX}"))
+            if self.action == DuplicateActions.HARDLINK:
+                os.link(original, temp_name)
+            elif not self.reflink(original, temp_name, file_name):
+                return False
+            linked_stat = os.stat(temp_name)
+            with self.lock:
+                self.linked.add((linked_stat.st_dev, linked_stat.st_ino))
+            os.replace(temp_name, file_name)
+        except OSError as err:
+            self.class_logger.logger.error(f"Unable to {self.action} '{file_name}' to '{original}', Error: {err}")
+            return False
+        self.class_logger.logger.info("Replaced %s with a %s to %s, reclaimed %s bytes.", file_name, self.action,
+                                      original, size)
+        if REGISTRY.enabled:
+            RECLAIMED_BYTES.inc(size)
+        return True
+
+    def reflink(self, original, temp_name, file_name):
+        """
+        Auxiliary method for cloning the original to a temporary file, keeping the duplicate permissions and times.
+        :param original: For the original file path.
+        :param temp_name: For the temporary clone path.
+        :param file_name: For the duplicate file path.
+        :return: True if cloned, False if the filesystem does not support reflinks.
+        """
+        if fcntl is None:
+            return False
+        with open(original, 'rb') as source, open(temp_name, 'xb') as clone:
+            try:
+                fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+            except OSError as err:
+                clone.close()
+                os.unlink(temp_name)
+                if err.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                    self.class_logger.logger.error(f"Reflinks are not supported for '{file_name}', Error: {err}")
+                    return False
+                raise
+        shutil.copystat(file_name, temp_name)
+        return True
+
+    def same_content(self, first, second):
+        """
+        Auxiliary method for comparing two files byte for byte.
+        :param first: For the first file path.
+        :param second: For the second file path.
+        :return: True if the files have the same content.
+        """
+        if os.path.getsize(first) != os.path.getsize(second):
+            return False
+        first_buffer, second_buffer = bytearray(self.buffer_size), bytearray(self.buffer_size)
+        with open(first, 'rb', buffering=0) as first_file, open(second, 'rb', buffering=0) as second_file:
+            while True:
+                if self.governor is not None:
+                    self.governor.acquire(self.buffer_size * 2)
+                    read_start = time.perf_counter()
+                read = first_file.readinto(first_buffer)
+                if second_file.readinto(second_buffer) != read:
+                    return False
+                if self.governor is not None:
+                    self.governor.record((time.perf_counter() - read_start) / 2)
+                if not read:
+                    return True
+                if first_buffer[:read] != second_buffer[:read]:
+                    return False
+
+
+"""
+Auxiliary class for the duplicate actions.
+"""
+
+
+class DuplicateActions:
+    RENAME = 'rename'
+    HARDLINK = 'hardlink'
+    REFLINK = 'reflink'
+    QUARANTINE = 'quarantine'
+    ALL = (RENAME, HARDLINK, REFLINK, QUARANTINE)
@@ -2,26 +2,64 @@
 FileHandler Class for handling the entire project in a MessageBus Architecture.
 """
 import time
-from threading import Thread
+from threading import Thread, Lock
 from consumer import Consumer
 from watchdog.observers import Observer
 from watcher import FileChangeWatcher
-from logger import Logger
+from inotify_observer import InotifyObserver
+from logger import Logger, configure_logging
+from reconciler import Reconciler
+from metrics import start_metrics_server
+from transport import create_transport
 
 
 class FileHandler(Thread):
 
-    def __init__(self, host):
+    def __init__(self, host, quiet_period=2.0, backpressure='block', db_write_behind=False, transport='rabbitmq',
+                 shards=1, reconcile=True, metrics_port=None,
+                 json_logs=False, io_limit_mb=None, db_shards=1, observer='watchdog'):
         """
         Class Constructor.
+        :param host: For the RabbitMQ host.
+        :param quiet_period: For the seconds a file must stay unchanged before its event is published.
+        :param backpressure: For the producer full queue policy, 'block', 'drop_oldest' or 'spill'.
+        :param db_write_behind: For group committing the consumer DB mutations.
+        :param transport: For the events transport, 'rabbitmq' or 'inprocess' to skip the broker on a single box.
+        :param shards: For the number of shard queues events are routed to by file path, this handler consumer
+                       consumes from all of them.
+        :param reconcile: For publishing the files created, changed or deleted while the handler was down on startup.
+        :param metrics_port: For serving the per stage metrics on http://127.0.0.1:{metrics_port}/metrics,
+                             metrics are not recorded if None.
+        :param json_logs: For writing the log file as JSON lines.
+        :param io_limit_mb: For the consumer file reads bandwidth in MB per second, see IOGovernor, unlimited if None.
+        :param db_shards: For the number of SQLite files the consumer 'Files' table is split across, see ShardedDB.
+        :param observer: For the file system observer, 'watchdog' or 'inotify' for the Linux batched observer,
+                         see InotifyObserver. Directories whose inotify events were lost are reconciled again.
         """
         super().__init__()
+        if json_logs:
+            configure_logging(json_lines=True)
         self.host = host
         self.threads = []
         self.class_logger = Logger('FileHandler')
-        self.observer = Observer()
+        if observer not in ('watchdog', 'inotify'):
+            raise ValueError(f"Unsupported observer '{observer}'.")
+        self.observer = InotifyObserver(rescan=self.rescan) if observer == 'inotify' else Observer()
+        # Directories waiting to be reconciled again, by a single rescan thread at a time
+        self.rescan_paths = {}
+        self.rescan_thread = None
+        self.rescan_lock = Lock()
         self.SOURCE_DIR = f'/home/user/Downloads'
-        self.consumer = Consumer(self.host)
+        self.quiet_period = quiet_period
+        self.backpressure = backpressure
+        self.event_handler = None
+        self.transport = transport
+        self.shards = shards
+        self.reconcile = reconcile
+        self.metrics_server = start_metrics_server(metrics_port) if metrics_port is not None else None
+        self.consumer = Consumer(self.host, db_write_behind=db_write_behind,
+                                 transport=create_transport(transport, self.host), shards=shards,
+                                 io_limit_mb=io_limit_mb, fadvise=io_limit_mb is not None, db_shards=db_shards)
 
     def start_observer(self):
         """
@@ -36,20 +74,59 @@ class FileHandler(Thread):
         Stopes watcher.
         """
         self.observer.stop()
+        if self.event_handler is not None:
+            self.event_handler.stop()
         self.consumer.close_connection()
         print("[+] Stopped File Handler.")
 
+    def rescan(self, path):
+        """
+        Schedules a directory to be reconciled with the consumer DB, once the observer lost some of its events.
+        :param path: For the directory to reconcile, it may not exist anymore.
+        """
+        with self.rescan_lock:
+            self.rescan_paths[path] = None
+            if self.rescan_thread is None:
+                self.rescan_thread = Thread(target=self.run_rescans, daemon=True, name='rescan')
+                self.rescan_thread.start()
+
+    def run_rescans(self):
+        """
+        Rescan thread loop, reconciles the scheduled directories one at a time until none is left.
+        """
+        while True:
+            with self.rescan_lock:
+                if not self.rescan_paths:
+                    self.rescan_thread = None
+                    return
+                path = next(iter(self.rescan_paths))
+                del self.rescan_paths[path]
+            try:
+                Reconciler(self.consumer.files_db, path, self.event_handler.publish_file_events,
+                           self.consumer.file_types, duplicates_db=self.consumer.db).run()
+            except Exception as err:
+                self.class_logger.logger.error(f"Unable to rescan '{path}', Error: {err}")
+
     def run(self):
         """
         FileHandler run method to enable project logic using threads.
         """
-        event_handler = FileChangeWatcher(self.host)
-        self.observer.schedule(event_handler, self.SOURCE_DIR, recursive=True)
+        self.event_handler = FileChangeWatcher(self.host, self.quiet_period, self.backpressure,
+                                               create_transport(self.transport, self.host), self.shards)
+        self.observer.schedule(self.event_handler, self.SOURCE_DIR, recursive=True)
         self.threads.append(self.observer)
         self.start_observer()
+        # The reconciler reads the stored files, the database is set up before the consumer thread starts
+        self.consumer.setup_consumer_db()
         consumer_thread = Thread(target=self.consumer.run)
         self.threads.append(consumer_thread)
         consumer_thread.start()
+        if self.reconcile:
+            # The observer is already running, changes made while reconciling are not missed
+            reconciler = Reconciler(self.consumer.files_db, self.SOURCE_DIR, self.event_handler.publish_file_events,
+                                    self.consumer.file_types, duplicates_db=self.consumer.db)
+            reconciler_thread = Thread(target=reconciler.run, daemon=True, name='reconciler')
+            reconciler_thread.start()
         try:
             while True:
                 time.sleep(1)
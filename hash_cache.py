@@ -0,0 +1,152 @@
+"""
+HashCache Class for caching file digests by file identity, so unchanged files are never hashed twice.
+Entries are keyed by (st_dev, st_ino) and validated against (st_size, st_mtime_ns, algorithm),
+any change of those fields invalidates the entry.
+A bounded LRU in memory layer is kept in front of the 'Hash_Cache' table of the consumer database.
+"""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from logger import Logger
+
+
+class HashCache:
+
+    def __init__(self, db, capacity=100000, table_name='Hash_Cache'):
+        """
+        Class Constructor.
+        :param db: For the DB instance holding the cache table.
+        :param capacity: For the maximal number of entries kept in memory.
+        :param table_name: For the cache table name.
+        """
+        self.db = db
+        self.capacity = capacity
+        self.table_name = table_name
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.class_logger = Logger('HashCache')
+
+    def setup(self):
+        """
+        Creates the cache table, must be called after the database has been set up.
+        """
+        self.db.create_table(self.table_name, 'Device INTEGER NOT NULL, Inode INTEGER NOT NULL, '
+                                              'File_Size INTEGER NOT NULL, Mtime_Ns INTEGER NOT NULL, '
+                                              'Hash_Algorithm TEXT NOT NULL, File_Hash TEXT NOT NULL, '
+                                              'PRIMARY KEY (Device, Inode)')
+
+    @staticmethod
+    def stat_key(file_stat):
+        """
+        Auxiliary method for splitting a stat result into the cache key and validator.
+        :param file_stat: For the os.stat result.
+        :return: Tuple of (device, inode) key and (size, mtime_ns) validator.
+        """
+        return (file_stat.st_dev, file_stat.st_ino), (file_stat.st_size, file_stat.st_mtime_ns)
+
+    def get(self, file_stat, algorithm):
+        """
+        Looks up the cached digest of a file.
+        :param file_stat: For the file os.stat result.
+        :param algorithm: For the wanted digest algorithm.
+        :return: The cached digest, None if missing or stale.
+        """
+        key, validator = self.stat_key(file_stat)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None:
+            entry = self.load(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] != validator or entry[1] != algorithm:
+            self.invalidate(key)
+            self.misses += 1
+            return None
+        self.remember(key, entry)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, file_stat, algorithm, file_hash):
+        """
+        Stores a file digest, replacing any older entry of the same file.
+        :param file_stat: For the file os.stat result taken before hashing.
+        :param algorithm: For the digest algorithm.
+        :param file_hash: For the file digest.
+        """
+        key, validator = self.stat_key(file_stat)
+        self.remember(key, (validator, algorithm, file_hash))
+        with self.db.lock:
+            try:
+                self.db.cursor.execute(f"INSERT OR REPLACE INTO {self.table_name} "
+                                       f"(Device, Inode, File_Size, Mtime_Ns, Hash_Algorithm, File_Hash) "
+                                       f"VALUES(?, ?, ?, ?, ?, ?)", (*key, *validator, algorithm, file_hash))
+                self.db.commit()
+            except sqlite3.Error as err:
+                self.class_logger.logger.error(f"Error caching hash of inode {key}, Error: {err}.")
+
+    def remember(self, key, entry):
+        """
+        Auxiliary method for adding an entry to the in memory layer, evicting the least recently used ones.
+        :param key: For the (device, inode) key.
+        :param entry: For the (validator, algorithm, digest) entry.
+        """
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def load(self, key):
+        """
+        Auxiliary method for loading an entry from the cache table.
+        :param key: For the (device, inode) key.
+        :return: The (validator, algorithm, digest) entry, None if missing.
+        """
+        with self.db.lock:
+            try:
+                self.db.cursor.execute(f"SELECT File_Size, Mtime_Ns, Hash_Algorithm, File_Hash FROM {self.table_name} "
+                                       f"WHERE Device = ? AND Inode = ?", key)
+                row = self.db.cursor.fetchone()
+            except sqlite3.Error as err:
+                self.class_logger.logger.error(f"Error loading cached hash of inode {key}, Error: {err}.")
+                return None
+        if row is None:
+            return None
+        return (row[0], row[1]), row[2], row[3]
+
+    def invalidate(self, key):
+        """
+        Drops a stale entry from both cache layers.
+        :param key: For the (device, inode) key.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+        with self.db.lock:
+            try:
+                self.db.cursor.execute(f"DELETE FROM {self.table_name} WHERE Device = ? AND Inode = ?", key)
+                self.db.commit()
+            except sqlite3.Error as err:
+                self.class_logger.logger.error(f"Error invalidating cached hash of inode {key}, Error: {err}.")
+
+    def hash_file(self, hasher, file):
+        """
+        Returns a file digest from the cache, hashing and caching it on a miss.
+        :param hasher: For the Hasher to use on a miss.
+        :param file: For the file to hash.
+        :return: The given file digest.
+        """
+        file_stat = os.stat(file)
+        digest_name = hasher.digest_name(file_stat.st_size)
+        file_hash = self.get(file_stat, digest_name)
+        if file_hash is None:
+            file_hash = hasher.hash_file(file)
+            self.put(file_stat, digest_name, file_hash)
+        else:
+            self.class_logger.logger.info("File '%s' hash found in cache.", file)
+        return file_hash
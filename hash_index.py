@@ -0,0 +1,145 @@
+"""
+HashIndex Class for answering 'definitely new' digest lookups in memory, in front of the consumer database.
+The index is a Bloom filter over the stored digests, sized once for a given capacity and error rate,
+so its memory footprint is fixed, about 1.2 bytes per digest for a 1% error rate.
+A negative answer is always right, a positive answer may be wrong and must be checked against the database.
+Bloom filters can not forget, deleted digests are only counted, and the filter is rebuilt from the database
+in the background once too many of its digests have been deleted.
+"""
+import hashlib
+import math
+import threading
+from logger import Logger
+
+
+class HashIndex:
+
+    def __init__(self, db, capacity=10000000, error_rate=0.01, rebuild_ratio=0.25, table_name='Files',
+                 column='File_Hash'):
+        """
+        Class Constructor.
+        :param db: For the DB or ShardedDB instance holding the digests table.
+        :param capacity: For the number of digests the index is sized for.
+        :param error_rate: For the false positive rate at full capacity.
+        :param rebuild_ratio: For the fraction of deleted digests triggering a rebuild.
+        :param table_name: For the digests table name.
+        :param column: For the digests column name.
+        """
+        self.db = db
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_ratio = rebuild_ratio
+        self.table_name = table_name
+        self.column = column
+        self.size_in_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size_in_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.size_in_bits + 7) // 8)
+        self.count = 0
+        self.deleted = 0
+        self.lock = threading.Lock()
+        # Digests added while rebuilding, replayed on the rebuilt filter
+        self.rebuild_log = None
+        self.class_logger = Logger('HashIndex')
+
+    @property
+    def memory_bytes(self):
+        """
+        :return: The index memory footprint in bytes.
+        """
+        return len(self.bits)
+
+    def positions(self, digest):
+        """
+        Auxiliary method for getting the filter bits of a digest, using double hashing.
+        :param digest: For the file digest.
+        :return: List of the bit positions.
+        """
+        key = hashlib.blake2b(digest.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(key[:8], 'little'), int.from_bytes(key[8:], 'little') | 1
+        return [(first + i * second) % self.size_in_bits for i in range(self.hash_count)]
+
+    @staticmethod
+    def set_bits(bits, positions):
+        """
+        Auxiliary method for setting bit positions in a filter.
+        :param bits: For the filter bytearray.
+        :param positions: For the bit positions.
+        """
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, digest):
+        """
+        Checks if a digest may have been stored.
+        :param digest: For the file digest.
+        :return: False if the digest is definitely new, True if it may exist.
+        """
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(digest))
+
+    def add(self, digest):
+        """
+        Adds a stored digest to the index.
+        :param digest: For the file digest.
+        """
+        positions = self.positions(digest)
+        with self.lock:
+            self.set_bits(self.bits, positions)
+            self.count += 1
+            if self.rebuild_log is not None:
+                self.rebuild_log.append(positions)
+            if self.count == self.capacity + 1:
+                self.class_logger.logger.error(f"Hash index is over its capacity of {self.capacity} digests, "
+                                               f"its false positive rate will grow.")
+
+    def discard(self, digest):
+        """
+        Records the deletion of a stored digest, rebuilding the index once too many have been deleted.
+        :param digest: For the file digest.
+        """
+        with self.lock:
+            self.deleted += 1
+            if self.rebuild_log is not None or self.deleted < max(1, self.count * self.rebuild_ratio):
+                return
+            self.rebuild_log = []
+        threading.Thread(target=self.rebuild, daemon=True, name='hash-index-rebuild').start()
+
+    def load(self):
+        """
+        Loads the stored digests, must be called after the database has been set up.
+        """
+        bits, count = self.scan()
+        with self.lock:
+            self.bits = bits
+            self.count = count
+            self.deleted = 0
+        self.class_logger.logger.info(f"Hash index loaded {count} digests, "
+                                      f"using {self.memory_bytes / (1024 * 1024):.1f} MB.")
+
+    def rebuild(self):
+        """
+        Rebuilds the index from the database, without the deleted digests.
+        """
+        bits, count = self.scan()
+        with self.lock:
+            for positions in self.rebuild_log:
+                self.set_bits(bits, positions)
+            self.bits = bits
+            self.count = count + len(self.rebuild_log)
+            self.deleted = 0
+            self.rebuild_log = None
+        self.class_logger.logger.info(f"Hash index rebuilt with {self.count} digests.")
+
+    def scan(self, chunk_size=10000):
+        """
+        Auxiliary method for building a filter from the stored digests, the table is read in chunks
+        so the database lock is not held for the whole scan.
+        :param chunk_size: For the number of rows read at once.
+        :return: Tuple of the filter bytearray and the number of digests.
+        """
+        bits = bytearray(len(self.bits))
+        count = 0
+        for digest, in self.db.stream_rows(self.table_name, self.column, f"{self.column} IS NOT NULL", chunk_size):
+            self.set_bits(bits, self.positions(digest))
+            count += 1
+        return bits, count
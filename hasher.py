@@ -0,0 +1,247 @@
+"""
+Hasher Class for generating file content digests for the Consumer.
+Every file gets a fresh hash object, data is read with readinto into a large reusable buffer,
+or mapped into memory for big files, to keep the number of Python level reads and syscalls low.
+With an IOGovernor the reads bandwidth is limited, and with fadvise the kernel is told files are read once,
+sequentially, and their pages are dropped once hashed, so hashing does not evict the hot page cache.
+Files from the tree threshold on are split into fixed size segments, hashed in parallel with os.pread,
+and their digest is the root of a Merkle tree over the segment digests:
+1. leaf = H(0x00 || segment bytes).
+2. node = H(0x01 || left || right), an odd last node is promoted to the next level as is.
+The root only depends on the algorithm and the segment size, both part of the digest name, see digest_name.
+"""
+import hashlib
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY, HASH_SECONDS, HASHED_BYTES
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class Hasher:
+
+    # Digests decide duplicates on their own, only algorithms of 64 bits and more are supported
+    ALGORITHMS = {
+        'md5': hashlib.md5,
+        'sha1': hashlib.sha1,
+        'blake2b': hashlib.blake2b,
+    }
+    if xxhash is not None:
+        ALGORITHMS['xxh64'] = xxhash.xxh64
+        ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+
+    def __init__(self, algorithm='md5', buffer_size=1024 * 1024, mmap_threshold=64 * 1024 * 1024, governor=None,
+                 fadvise=False, tree_threshold=None, segment_size=64 * 1024 * 1024, tree_workers=4,
+                 on_segments=None):
+        """
+        Class Constructor.
+        :param algorithm: For the digest algorithm, one of md5, sha1, blake2b (or xxh64/xxh3_128 with xxhash).
+        :param buffer_size: For the size in bytes of the reusable read buffer.
+        :param mmap_threshold: For the file size in bytes from which files are memory mapped instead of read.
+        :param governor: For the IOGovernor limiting the reads bandwidth, files are never memory mapped with it.
+        :param fadvise: For giving the kernel posix_fadvise hints, where supported.
+        :param tree_threshold: For the file size in bytes from which files are tree hashed, never if None.
+        :param segment_size: For the tree hashing segment size in bytes.
+        :param tree_workers: For the number of threads hashing the segments of a file.
+        :param on_segments: For a callback called with the digest and the hex segment digests of tree hashed files.
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm '{algorithm}', "
+                             f"supported algorithms are: {', '.join(self.ALGORITHMS)}.")
+        self.algorithm = algorithm
+        self.buffer_size = buffer_size
+        self.mmap_threshold = mmap_threshold
+        self.governor = governor
+        self.fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self.tree_threshold = tree_threshold
+        self.segment_size = segment_size
+        self.tree_workers = tree_workers
+        self.on_segments = on_segments
+        self.tree_pool = None
+        self.tree_pool_lock = threading.Lock()
+        # One preallocated buffer per worker thread
+        self.local = threading.local()
+
+    def new(self):
+        """
+        Creates a fresh hash object for the configured algorithm.
+        :return: The new hash object.
+        """
+        return self.ALGORITHMS[self.algorithm]()
+
+    def digest_name(self, size):
+        """
+        Returns the name of the digest a file of a given size gets, stored next to its digest.
+        Tree digests are only comparable with tree digests of the same algorithm and segment size.
+        :param size: For the file size in bytes.
+        :return: The algorithm name, with the tree segment size for tree hashed files.
+        """
+        if self.tree_threshold is not None and size >= self.tree_threshold:
+            return f"{self.algorithm}-tree-{self.segment_size}"
+        return self.algorithm
+
+    def get_buffer(self):
+        """
+        Auxiliary method for getting the calling thread read buffer, allocated on first use.
+        :return: Tuple of the buffer and its memoryview.
+        """
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            buffer = bytearray(self.buffer_size)
+            self.local.buffer = buffer
+            self.local.view = memoryview(buffer)
+        return buffer, self.local.view
+
+    def advise(self, fd, advice):
+        """
+        Auxiliary method for giving the kernel a posix_fadvise hint on a whole file, hints are best effort.
+        :param fd: For the file descriptor.
+        :param advice: For the os.POSIX_FADV_* advice.
+        """
+        if self.fadvise:
+            try:
+                os.posix_fadvise(fd, 0, 0, advice)
+            except OSError:
+                pass
+
+    def hash_file(self, file):
+        """
+        Generating a digest for a given file.
+        :param file: For the file to hash.
+        :return: The given file hex digest.
+        """
+        start = time.perf_counter() if REGISTRY.enabled else None
+        file_hash = self.new()
+        with open(file, 'rb', buffering=0) as file_to_hash:
+            fd = file_to_hash.fileno()
+            size = os.fstat(fd).st_size
+            if self.fadvise:
+                self.advise(fd, os.POSIX_FADV_SEQUENTIAL)
+            if self.tree_threshold is not None and size >= self.tree_threshold:
+                digest = self.hash_tree(fd, size)
+                if self.fadvise:
+                    self.advise(fd, os.POSIX_FADV_DONTNEED)
+                if start is not None:
+                    HASH_SECONDS.observe(time.perf_counter() - start)
+                    HASHED_BYTES.inc(size)
+                return digest
+            # Mapped files are read by page faults, which the governor can not meter
+            if size >= self.mmap_threshold and self.governor is None:
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+                    file_hash.update(mapped)
+            else:
+                self.update_from_stream(file_hash, file_to_hash)
+            if self.fadvise:
+                self.advise(fd, os.POSIX_FADV_DONTNEED)
+        if start is not None:
+            HASH_SECONDS.observe(time.perf_counter() - start)
+            HASHED_BYTES.inc(size)
+        return file_hash.hexdigest()
+
+    def update_from_stream(self, file_hash, stream, length=None):
+        """
+        Feeds an open binary stream into a hash object through the reusable buffer.
+        :param file_hash: For the hash object to update.
+        :param stream: For the unbuffered binary stream to read from.
+        :param length: For the maximal number of bytes to read, until EOF if None.
+        """
+        buffer, view = self.get_buffer()
+        remaining = length
+        while remaining is None or remaining > 0:
+            if remaining is not None and remaining < len(buffer):
+                chunk = view[:remaining]
+            else:
+                chunk = buffer
+            if self.governor is None:
+                read = stream.readinto(chunk)
+            else:
+                self.governor.acquire(len(chunk))
+                read_start = time.perf_counter()
+                read = stream.readinto(chunk)
+                self.governor.record(time.perf_counter() - read_start)
+            if not read:
+                break
+            file_hash.update(view[:read])
+            if remaining is not None:
+                remaining -= read
+
+    def hash_tree(self, fd, size):
+        """
+        Generating the Merkle root digest of an open file, its segments are hashed in parallel.
+        :param fd: For the file descriptor.
+        :param size: For the file size in bytes.
+        :return: The root hex digest.
+        """
+        with self.tree_pool_lock:
+            if self.tree_pool is None:
+                self.tree_pool = ThreadPoolExecutor(max_workers=self.tree_workers, thread_name_prefix='tree-hasher')
+        offsets = range(0, size, self.segment_size)
+        leaves = list(self.tree_pool.map(lambda offset: self.hash_segment(fd, offset, size), offsets))
+        nodes = leaves
+        while len(nodes) > 1:
+            level = []
+            for index in range(0, len(nodes) - 1, 2):
+                node = self.new()
+                node.update(b'\x01' + nodes[index] + nodes[index + 1])
+                level.append(node.digest())
+            if len(nodes) % 2:
+                level.append(nodes[-1])
+            nodes = level
+        digest = nodes[0].hex()
+        if self.on_segments is not None:
+            self.on_segments(digest, [leaf.hex() for leaf in leaves])
+        return digest
+
+    def hash_segment(self, fd, offset, size):
+        """
+        Auxiliary method for hashing a single segment with positional reads, runs on the tree hashing threads.
+        :param fd: For the file descriptor.
+        :param offset: For the segment offset.
+        :param size: For the file size in bytes.
+        :return: The leaf digest bytes.
+        """
+        buffer, view = self.get_buffer()
+        segment_hash = self.new()
+        segment_hash.update(b'\x00')
+        end = min(offset + self.segment_size, size)
+        while offset < end:
+            chunk = view[:min(len(buffer), end - offset)]
+            if self.governor is not None:
+                self.governor.acquire(len(chunk))
+                read_start = time.perf_counter()
+            read = os.preadv(fd, [chunk], offset)
+            if self.governor is not None:
+                self.governor.record(time.perf_counter() - read_start)
+            if not read:
+                raise OSError(f"File truncated while hashing, expected {size} bytes.")
+            segment_hash.update(view[:read])
+            offset += read
+        return segment_hash.digest()
+
+    def hash_sample(self, file, sample_size):
+        """
+        Generating a digest of a given file size, first and last sample_size bytes.
+        Files up to twice the sample size are hashed entirely.
+        :param file: For the file to hash.
+        :param sample_size: For the number of bytes to read from each end of the file.
+        :return: The given file sample hex digest.
+        """
+        file_hash = self.new()
+        with open(file, 'rb', buffering=0) as file_to_hash:
+            size = os.fstat(file_to_hash.fileno()).st_size
+            file_hash.update(size.to_bytes(8, 'little'))
+            if size <= sample_size * 2:
+                self.update_from_stream(file_hash, file_to_hash)
+            else:
+                self.update_from_stream(file_hash, file_to_hash, sample_size)
+                file_to_hash.seek(size - sample_size)
+                self.update_from_stream(file_hash, file_to_hash, sample_size)
+            if self.fadvise:
+                self.advise(file_to_hash.fileno(), os.POSIX_FADV_DONTNEED)
+        return file_hash.hexdigest()
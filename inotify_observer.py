@@ -0,0 +1,330 @@
+"""
+InotifyObserver Class for watching large trees on Linux with a single inotify file descriptor, in place of the
+watchdog Observer, which dispatches every event on its own.
+1. startup - the tree watches are registered in parallel, each directory is watched before it is listed,
+   so none of its sub directories is missed.
+2. events - the descriptor is drained in large reads once it is readable, and the whole batch is parsed and handed to
+   the handler at once as (event_type, src_path, dest_path) tuples, see FileChangeWatcher.on_events.
+   Moves within the tree are paired by cookie, files moved out are 'deleted' and files moved in are 'created'.
+   Files are reported when written and closed (IN_CLOSE_WRITE), not on every write.
+3. new directories are watched as they appear, their files already written are reported as 'created'.
+4. lost events - on IN_Q_OVERFLOW the watches of the tree are registered again and the tree is handed to the
+   rescan callback, as is a directory moved out of the tree, whose stored files are gone.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from logger import Logger
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (OSError, AttributeError):
+    libc = None
+
+# struct inotify_event header: wd, mask, cookie, name length, see inotify(7)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyObserver(threading.Thread):
+
+    def __init__(self, rescan=None, workers=None, buffer_size=1024 * 1024, max_reads=16, batch_delay=0.01):
+        """
+        Class Constructor.
+        :param rescan: For the callback reconciling a directory whose events have been lost, called with its path.
+        :param workers: For the number of watch registering threads, defaults to the number of cores.
+        :param buffer_size: For the size in bytes of a single read.
+        :param max_reads: For the maximal number of reads of a batch, later events are read in the next batch.
+        :param batch_delay: For the seconds waited once the descriptor is readable, so more events are read at once.
+        """
+        if libc is None:
+            raise OSError("The inotify observer requires Linux.")
+        super().__init__(daemon=True, name='inotify-observer')
+        self.rescan = rescan
+        self.workers = workers or os.cpu_count() or 1
+        self.buffer_size = buffer_size
+        self.max_reads = max_reads
+        self.batch_delay = batch_delay
+        # (handler, path) of the scheduled trees
+        self.schedules = []
+        self.fd = None
+        self.wake_read, self.wake_write = None, None
+        self.pool = None
+        # Watch descriptor to its directory path
+        self.watches = {}
+        self.lock = threading.Lock()
+        # Move cookie to the (path, is directory) of a 'moved from' event waiting for its 'moved to' event
+        self.moves = {}
+        self.stopped = threading.Event()
+        self.class_logger = Logger('InotifyObserver')
+
+    def schedule(self, handler, path, recursive=True):
+        """
+        Schedules a tree to watch, before the observer is started.
+        :param handler: For the handler, its on_events method is called with every batch.
+        :param path: For the tree root directory.
+        :param recursive: For watchdog Observer compatibility, trees are always watched recursively.
+        """
+        self.schedules.append((handler, os.path.abspath(path)))
+
+    def start(self):
+        """
+        Opens the inotify descriptor, registers the scheduled trees watches and starts reading events.
+        """
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"Unable to initialize inotify, {os.strerror(err)}")
+        self.wake_read, self.wake_write = os.pipe()
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='inotify-watch')
+        start = time.monotonic()
+        for _, path in self.schedules:
+            self.add_tree(path)
+        self.class_logger.logger.info(f"Registered {len(self.watches)} watches in "
+                                      f"{time.monotonic() - start:.1f} seconds.")
+        super().start()
+
+    def stop(self):
+        """
+        Stops reading events, the descriptor is closed by the observer thread.
+        """
+        self.stopped.set()
+        if self.wake_write is not None:
+            os.write(self.wake_write, b'\0')
+
+    def add_dir(self, path, with_files):
+        """
+        Watches a single directory and lists it, runs on the registering threads.
+        :param path: For the directory path.
+        :param with_files: For listing the directory files too.
+        :return: Tuple of the sub directories list and the files list.
+        """
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), InotifyMasks.WATCH)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                self.class_logger.logger.error(f"Unable to watch '{path}', the watches limit has been reached, "
+                                               f"see /proc/sys/fs/inotify/max_user_watches.")
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                self.class_logger.logger.error(f"Unable to watch '{path}', Error: {os.strerror(err)}")
+            return [], []
+        with self.lock:
+            self.watches[wd] = path
+        sub_dirs, files = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.path)
+                        elif with_files and entry.is_file(follow_symlinks=False):
+                            files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError as err:
+            self.class_logger.logger.error(f"Unable to list '{path}', Error: {err}")
+        return sub_dirs, files
+
+    def add_tree(self, root, with_files=False):
+        """
+        Watches a directory tree, registering the directories in parallel.
+        :param root: For the tree root directory.
+        :param with_files: For listing the tree files too.
+        :return: List of the tree files, empty without with_files.
+        """
+        files = []
+        pending = {self.pool.submit(self.add_dir, root, with_files)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                sub_dirs, dir_files = future.result()
+                files.extend(dir_files)
+                pending.update(self.pool.submit(self.add_dir, sub_dir, with_files) for sub_dir in sub_dirs)
+        return files
+
+    def remove_tree(self, root):
+        """
+        Stops watching a directory tree.
+        :param root: For the tree root directory.
+        """
+        prefix = os.path.join(root, '')
+        with self.lock:
+            removed = [wd for wd, path in self.watches.items() if path == root or path.startswith(prefix)]
+            for wd in removed:
+                del self.watches[wd]
+        for wd in removed:
+            libc.inotify_rm_watch(self.fd, wd)
+
+    def move_tree(self, src_root, dest_root):
+        """
+        Rewrites the paths of a directory tree moved within the watched tree, its watches stay valid.
+        :param src_root: For the tree former root directory.
+        :param dest_root: For the tree root directory.
+        :return: The number of rewritten watches, 0 if the tree was not watched yet.
+        """
+        prefix = os.path.join(src_root, '')
+        moved = 0
+        with self.lock:
+            for wd, path in self.watches.items():
+                if path == src_root or path.startswith(prefix):
+                    self.watches[wd] = dest_root + path[len(src_root):]
+                    moved += 1
+        return moved
+
+    def run(self):
+        """
+        Observer thread loop, reads and dispatches event batches until stopped.
+        """
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        poller.register(self.wake_read, select.POLLIN)
+        try:
+            while not self.stopped.is_set():
+                poller.poll()
+                if self.stopped.is_set():
+                    break
+                # Events keep coming during a burst, waiting a little reads many more of them at once
+                self.stopped.wait(self.batch_delay)
+                self.dispatch(*self.read_events())
+        finally:
+            self.pool.shutdown(wait=True)
+            os.close(self.fd)
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+            self.wake_write = None
+
+    def read_events(self):
+        """
+        Auxiliary method for draining the descriptor, up to max_reads reads.
+        :return: Tuple of the raw events list of (wd, mask, cookie, name) and whether the descriptor is drained.
+        """
+        raw_events = []
+        for _ in range(self.max_reads):
+            try:
+                data = os.read(self.fd, self.buffer_size)
+            except BlockingIOError:
+                return raw_events, True
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                raw_events.append((wd, mask, cookie, os.fsdecode(name)))
+        return raw_events, False
+
+    def dispatch(self, raw_events, drained):
+        """
+        Auxiliary method for turning a batch of raw events into file events, handed to the handlers at once.
+        :param raw_events: For the (wd, mask, cookie, name) raw events.
+        :param drained: For the descriptor being drained, a 'moved from' event still unpaired then left the tree.
+        """
+        events, rescans, overflow = [], [], False
+        for wd, mask, cookie, name in raw_events:
+            if mask & InotifyMasks.Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & InotifyMasks.IGNORED:
+                with self.lock:
+                    self.watches.pop(wd, None)
+                continue
+            with self.lock:
+                directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            is_dir = bool(mask & InotifyMasks.ISDIR)
+            if mask & InotifyMasks.MOVED_FROM:
+                self.moves[cookie] = (path, is_dir)
+            elif mask & InotifyMasks.MOVED_TO:
+                source = self.moves.pop(cookie, None)
+                if source is None:
+                    # Moved in from outside the watched tree
+                    if is_dir:
+                        events.extend(('created', file, None) for file in self.add_tree(path, with_files=True))
+                    else:
+                        events.append(('created', path, None))
+                elif is_dir:
+                    if self.move_tree(source[0], path):
+                        events.extend(self.moved_files(source[0], path))
+                    else:
+                        # Created and moved within the batch, it was gone before it could be watched
+                        events.extend(('created', file, None) for file in self.add_tree(path, with_files=True))
+                else:
+                    events.append(('moved', source[0], path))
+            elif mask & InotifyMasks.CREATE:
+                if is_dir:
+                    # Files may have been written before the directory was watched
+                    events.extend(('created', file, None) for file in self.add_tree(path, with_files=True))
+                else:
+                    events.append(('created', path, None))
+            elif mask & InotifyMasks.CLOSE_WRITE:
+                events.append(('modified', path, None))
+            elif mask & InotifyMasks.DELETE and not is_dir:
+                events.append(('deleted', path, None))
+        if drained:
+            # Moved out of the watched tree
+            for path, is_dir in self.moves.values():
+                if is_dir:
+                    self.remove_tree(path)
+                    rescans.append(path)
+                else:
+                    events.append(('deleted', path, None))
+            self.moves.clear()
+        if overflow:
+            self.class_logger.logger.error("Inotify events queue overflowed, rescanning the watched trees.")
+            for _, root in self.schedules:
+                self.add_tree(root)
+                rescans.append(root)
+        if events:
+            for handler, _ in self.schedules:
+                try:
+                    handler.on_events(events)
+                except Exception as err:
+                    self.class_logger.logger.error(f"Unable to handle {len(events)} events, Error: {err}")
+        if self.rescan is not None:
+            for path in rescans:
+                self.rescan(path)
+
+    @staticmethod
+    def moved_files(src_root, dest_root):
+        """
+        Auxiliary method for listing the files of a directory moved within the watched tree.
+        :param src_root: For the directory former path.
+        :param dest_root: For the directory path.
+        :return: List of the ('moved', src_path, dest_path) events of its files.
+        """
+        events = []
+        for dir_path, _, file_names in os.walk(dest_root):
+            for file_name in file_names:
+                dest_path = os.path.join(dir_path, file_name)
+                events.append(('moved', src_root + dest_path[len(dest_root):], dest_path))
+        return events
+
+
+"""
+Auxiliary class for the inotify event masks, see inotify(7).
+"""
+
+
+class InotifyMasks:
+    CLOSE_WRITE = 0x00000008
+    MOVED_FROM = 0x00000040
+    MOVED_TO = 0x00000080
+    CREATE = 0x00000100
+    DELETE = 0x00000200
+    Q_OVERFLOW = 0x00004000
+    IGNORED = 0x00008000
+    ONLYDIR = 0x01000000
+    DONT_FOLLOW = 0x02000000
+    EXCL_UNLINK = 0x04000000
+    ISDIR = 0x40000000
+    WATCH = CLOSE_WRITE | MOVED_FROM | MOVED_TO | CREATE | DELETE | ONLYDIR | DONT_FOLLOW | EXCL_UNLINK
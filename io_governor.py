@@ -0,0 +1,101 @@
+"""
+IOGovernor Class for limiting the consumer file reads bandwidth, so hashing a large dump of files does not starve
+the other services using the same volume.
+Reads take tokens from a bucket refilled at the current rate, a read larger than the available tokens runs into debt
+and the next reads wait for it to be paid back. The rate adapts every adjust interval:
+1. the disk is busy, the mean read latency is above the latency target - the rate is halved, down to the minimum.
+2. the consumer backlog is at or above its high watermark - the rate grows, up to the ceiling.
+3. otherwise the rate returns to its base.
+"""
+import threading
+import time
+from logger import Logger
+from metrics import REGISTRY, IO_RATE, IO_THROTTLED_SECONDS
+
+MB = 1024 * 1024
+
+
+class IOGovernor:
+
+    def __init__(self, mb_per_sec, max_mb_per_sec=None, min_mb_per_sec=None, backlog=None, backlog_high=64,
+                 latency_target=0.02, adjust_interval=0.5, burst_seconds=0.1):
+        """
+        Class Constructor.
+        :param mb_per_sec: For the base reads bandwidth in MB per second.
+        :param max_mb_per_sec: For the bandwidth ceiling in MB per second, four times the base by default.
+        :param min_mb_per_sec: For the bandwidth floor in MB per second, a quarter of the base by default.
+        :param backlog: For a callable returning the number of waiting jobs, the rate grows while it is high.
+        :param backlog_high: For the backlog from which the rate grows.
+        :param latency_target: For the mean seconds per read above which the disk is considered busy.
+        :param adjust_interval: For the seconds between rate adjustments.
+        :param burst_seconds: For the seconds of reads the bucket holds when idle.
+        """
+        self.base_rate = mb_per_sec * MB
+        self.max_rate = (max_mb_per_sec or mb_per_sec * 4) * MB
+        self.min_rate = (min_mb_per_sec or mb_per_sec / 4) * MB
+        self.rate = self.base_rate
+        self.backlog = backlog
+        self.backlog_high = backlog_high
+        self.latency_target = latency_target
+        self.adjust_interval = adjust_interval
+        self.burst_seconds = burst_seconds
+        self.tokens = self.rate * burst_seconds
+        self.last_refill = time.monotonic()
+        self.last_adjust = self.last_refill
+        self.reads = 0
+        self.read_time = 0.0
+        self.lock = threading.Lock()
+        self.class_logger = Logger('IOGovernor')
+
+    def acquire(self, size):
+        """
+        Waits until a read of a given size is allowed, safe to call from any thread.
+        :param size: For the number of bytes about to be read.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_adjust >= self.adjust_interval:
+                self.adjust(now)
+            self.tokens = min(self.rate * self.burst_seconds, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            if REGISTRY.enabled:
+                IO_THROTTLED_SECONDS.inc(wait)
+            time.sleep(wait)
+
+    def record(self, seconds):
+        """
+        Records the latency of a read, safe to call from any thread.
+        :param seconds: For the read duration.
+        """
+        with self.lock:
+            self.reads += 1
+            self.read_time += seconds
+
+    def adjust(self, now):
+        """
+        Auxiliary method for adapting the rate to the disk latency and the backlog, the lock must be held.
+        :param now: For the current monotonic time.
+        """
+        latency = self.read_time / self.reads if self.reads else 0.0
+        backlog = self.backlog() if self.backlog is not None else 0
+        rate = self.rate
+        if latency > self.latency_target:
+            rate = max(self.min_rate, rate / 2)
+        elif backlog >= self.backlog_high:
+            rate = min(self.max_rate, rate * 1.5)
+        elif rate < self.base_rate:
+            rate = min(self.base_rate, rate * 1.5)
+        elif rate > self.base_rate:
+            rate = max(self.base_rate, rate / 1.5)
+        if rate != self.rate:
+            self.class_logger.logger.info("Reads rate set to %.1f MB/s, mean read latency %.1f ms, backlog %s.",
+                                          rate / MB, latency * 1000, backlog)
+            self.rate = rate
+        if REGISTRY.enabled:
+            IO_RATE.set(self.rate)
+        self.reads = 0
+        self.read_time = 0.0
+        self.last_adjust = now
@@ -1,7 +1,150 @@
 """
 Custom logger class based on python logging library.
+Logging is configured once per process, see configure_logging, by default records are handed to a queue and
+formatted and written to the log file by a listener thread, so log I/O is not part of the events latency.
+Hot path messages should use lazy '%s' arguments, they are only formatted by the listener, and INFO messages
+are rate limited per logger, suppressed messages are counted on the next written one.
 """
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FILE = 'file_event_handler_logs.txt'
+LOG_FORMAT = '[%(asctime)s] - [%(name)-12s] - [%(levelname)s] --- %(message)s'
+DATE_FORMAT = '%d/%m/%y %H:%M:%S'
+
+_lock = threading.RLock()
+_handlers = []
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, rate=100, burst=200, level=logging.INFO):
+        """
+        Class Constructor.
+        A token bucket per logger name, records above the given level are never limited.
+        :param rate: For the number of records per second allowed per logger.
+        :param burst: For the number of records allowed at once per logger.
+        :param level: For the highest limited level.
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.level = level
+        # Logger name to its [tokens, last refill time, suppressed records]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(record.name)
+            if bucket is None:
+                bucket = self.buckets[record.name] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class PlainFormatter(logging.Formatter):
+
+    def format(self, record):
+        message = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{message} ({suppressed} similar messages suppressed)" if suppressed else message
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record, DATE_FORMAT), 'logger': record.name, 'level': record.levelname,
+                 'thread': record.threadName, 'message': record.getMessage()}
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # Unlike QueueHandler, the message is not formatted on the logging thread, the listener formats it
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def configure_logging(log_file=LOG_FILE, file_mode='w', level=logging.INFO, async_mode=True, json_lines=False,
+                      info_rate=100, info_burst=200):
+    """
+    Configures the process logging, replacing the previous configuration.
+    :param log_file: For the log file path.
+    :param file_mode: For the log file open mode.
+    :param level: For the root log level.
+    :param async_mode: For writing the log file from a listener thread instead of the logging threads.
+    :param json_lines: For writing one JSON object per line instead of the plain text format.
+    :param info_rate: For the INFO records per second allowed per logger, None disables rate limiting.
+    :param info_burst: For the INFO records allowed at once per logger.
+    """
+    global _listener
+    with _lock:
+        root = logging.getLogger()
+        _stop()
+        file_handler = logging.FileHandler(log_file, mode=file_mode)
+        file_handler.setFormatter(JsonFormatter() if json_lines else PlainFormatter(LOG_FORMAT, DATE_FORMAT))
+        if async_mode:
+            handler = LazyQueueHandler(queue.SimpleQueue())
+            _listener = logging.handlers.QueueListener(handler.queue, file_handler)
+            _listener.start()
+        else:
+            handler = file_handler
+        if info_rate is not None:
+            handler.addFilter(RateLimitFilter(info_rate, info_burst))
+        root.addHandler(handler)
+        root.setLevel(level)
+        _handlers.extend({handler, file_handler})
+
+
+def _stop():
+    """
+    Auxiliary function for stopping the listener, writing the queued records, and removing the handlers.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    root = logging.getLogger()
+    while _handlers:
+        handler = _handlers.pop()
+        root.removeHandler(handler)
+        handler.close()
+
+
+def shutdown_logging():
+    """
+    Writes the queued records and closes the log file.
+    """
+    with _lock:
+        _stop()
+
+
+atexit.register(shutdown_logging)
 
 
 class Logger:
@@ -13,17 +156,18 @@ class Logger:
         1. log file name, path and mode.
         2. log level.
         3. log date and time format.
+        The process logging is configured with the defaults on the first Logger, see configure_logging.
         :param logger_name: For the logger name to be shown in the log file.
         """
         # Create logger
         self.logger = logging.getLogger(logger_name)
-        self.log_file = 'file_event_handler_logs.txt'
+        self.log_file = LOG_FILE
         self.log_file_mode = 'w'
         # Set level and format
         self.log_level = logging.INFO
         self.logger.setLevel(self.log_level)
-        self.log_format = '[%(asctime)s] - [%(name)-12s] - [%(levelname)s] --- %(message)s'
-        self.date_format = '%d/%m/%y %H:%M:%S'
-        logging.basicConfig(filename=self.log_file, filemode=self.log_file_mode, level=self.log_level,
-                            format=self.log_format, datefmt=self.date_format)
-
+        self.log_format = LOG_FORMAT
+        self.date_format = DATE_FORMAT
+        with _lock:
+            if not _handlers:
+                configure_logging(self.log_file, self.log_file_mode, self.log_level)
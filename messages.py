@@ -0,0 +1,92 @@
+"""
+Event messages wire format between the Watcher and the Consumer.
+A message holds one or more events, packed with struct as a message header followed by the events:
+  message header: magic (1 byte), version (1 byte), events count (2 bytes).
+  event: type (1 byte), size (8 bytes), mtime_ns (8 bytes), inode (8 bytes),
+         src path length (2 bytes), dest path length (2 bytes), src path, dest path.
+Paths are encoded with os.fsencode, metadata which is not known, e.g. of deleted files, is sent as -1.
+Messages of the older 'event_type src_path' text format are still decoded.
+"""
+import os
+import struct
+from collections import namedtuple
+
+MAGIC = 0xFE
+VERSION = 1
+MESSAGE_HEADER = struct.Struct('<BBH')
+EVENT_HEADER = struct.Struct('<BqqqHH')
+MAX_EVENTS = 0xFFFF
+EVENT_TYPES = ('created', 'deleted', 'moved', 'modified', 'closed', 'closed_no_write', 'opened')
+EVENT_CODES = {event_type: code for code, event_type in enumerate(EVENT_TYPES)}
+
+FileEvent = namedtuple('FileEvent', 'event_type src_path dest_path size mtime_ns inode', defaults=(None, -1, -1, -1))
+
+
+def event_from_stat(event_type, src_path, dest_path=None):
+    """
+    Creates an event with the metadata of its file, the destination file for 'moved' events.
+    :param event_type: For the event type.
+    :param src_path: For the event file path.
+    :param dest_path: For the event destination path, for 'moved' events.
+    :return: The FileEvent, with -1 metadata if the file is gone.
+    """
+    try:
+        file_stat = os.stat(dest_path or src_path)
+    except OSError:
+        return FileEvent(event_type, src_path, dest_path)
+    return FileEvent(event_type, src_path, dest_path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+
+
+def encode_events(events):
+    """
+    Packs events into a single message.
+    :param events: For the FileEvent list, up to MAX_EVENTS events.
+    :return: The message bytes.
+    """
+    if len(events) > MAX_EVENTS:
+        raise ValueError(f"A message holds up to {MAX_EVENTS} events, got {len(events)}.")
+    parts = [MESSAGE_HEADER.pack(MAGIC, VERSION, len(events))]
+    for event in events:
+        src = os.fsencode(event.src_path)
+        dest = os.fsencode(event.dest_path) if event.dest_path else b''
+        parts.append(EVENT_HEADER.pack(EVENT_CODES[event.event_type], event.size, event.mtime_ns, event.inode,
+                                       len(src), len(dest)))
+        parts.append(src)
+        parts.append(dest)
+    return b''.join(parts)
+
+
+def decode_events(body):
+    """
+    Unpacks the events of a message.
+    :param body: For the message bytes.
+    :return: List of FileEvent.
+    """
+    if not body or body[0] != MAGIC:
+        return decode_text_event(body)
+    magic, version, count = MESSAGE_HEADER.unpack_from(body)
+    if version != VERSION:
+        raise ValueError(f"Unsupported message version {version}.")
+    events = []
+    offset = MESSAGE_HEADER.size
+    for _ in range(count):
+        code, size, mtime_ns, inode, src_length, dest_length = EVENT_HEADER.unpack_from(body, offset)
+        offset += EVENT_HEADER.size
+        src_path = os.fsdecode(body[offset:offset + src_length])
+        offset += src_length
+        dest_path = os.fsdecode(body[offset:offset + dest_length]) if dest_length else None
+        offset += dest_length
+        events.append(FileEvent(EVENT_TYPES[code], src_path, dest_path, size, mtime_ns, inode))
+    return events
+
+
+def decode_text_event(body):
+    """
+    Auxiliary method for decoding an 'event_type src_path' text message.
+    :param body: For the message bytes.
+    :return: List of the single FileEvent, without metadata.
+    """
+    event_type, _, src_path = body.decode().partition(' ')
+    if not src_path:
+        raise ValueError(f"Unable to get file path from message '{body}'.")
+    return [FileEvent(event_type, src_path)]
@@ -0,0 +1,258 @@
+"""
+Metrics Classes for per stage counters and latency histograms, exposed in the Prometheus text format.
+Metrics are recorded in the process wide REGISTRY, which is disabled by default: every instrumented call then costs
+a single flag check. start_metrics_server enables the registry and serves it on a local HTTP endpoint:
+1. watcher - received events.
+2. producer - queued messages, publish latency and queue depth.
+3. consumer - received messages and events, scheduler queue wait, hash time, bytes hashed and reads throttling.
+4. db - latency of every DB operation.
+"""
+import functools
+import threading
+import time
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger import Logger
+
+
+class Metric(ABC):
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Class Constructor.
+        :param name: For the metric name.
+        :param documentation: For the metric help line.
+        :param labelnames: For the label names, their values are given positionally when recording.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # Label values tuple to the recorded value
+        self.values = {}
+
+    def format_labels(self, label_values, extra=()):
+        """
+        Auxiliary method for formatting a label set.
+        :param label_values: For the label values tuple.
+        :param extra: For additional (name, value) pairs.
+        :return: The '{name="value",...}' string, empty without labels.
+        """
+        pairs = list(zip(self.labelnames, label_values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                   for name, value in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    @abstractmethod
+    def samples(self):
+        """
+        :return: List of the metric sample lines.
+        """
+
+    def render(self):
+        """
+        :return: The metric in the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self.lock:
+            lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        """
+        Increments the counter.
+        :param amount: For the amount to add.
+        :param label_values: For the label values.
+        """
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        return [f"{self.name}{self.format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+
+    TYPE = 'gauge'
+
+    def set(self, value, *label_values):
+        """
+        Sets the gauge value.
+        :param value: For the current value.
+        :param label_values: For the label values.
+        """
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self):
+        return [f"{self.name}{self.format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Histogram(Metric):
+
+    TYPE = 'histogram'
+    LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        Class Constructor.
+        :param name: For the metric name.
+        :param documentation: For the metric help line.
+        :param labelnames: For the label names, their values are given positionally when recording.
+        :param buckets: For the sorted bucket upper bounds.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        """
+        Records an observation.
+        :param value: For the observed value, in seconds for latencies.
+        :param label_values: For the label values.
+        """
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                # Per bucket counts, the observations sum and count
+                state = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        lines = []
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{self.format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self.format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        """
+        Class Constructor.
+        The registry starts disabled, nothing is recorded until it is enabled.
+        """
+        self.enabled = False
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Registers a metric, returning the already registered one with the same name.
+        :param metric: For the metric to register.
+        :return: The registered metric.
+        """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def timed(self, histogram, *label_values):
+        """
+        Decorator recording the latency of every call in a histogram, calls are not timed while disabled.
+        :param histogram: For the latency histogram.
+        :param label_values: For the label values.
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, *label_values)
+            return wrapper
+        return decorator
+
+    def render(self):
+        """
+        :return: All the metrics in the Prometheus text format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+WATCHER_EVENTS = REGISTRY.counter('watcher_events_total', 'File events received by the watcher.', ['event_type'])
+PRODUCER_MESSAGES = REGISTRY.counter('producer_messages_total', 'Event messages queued by the producer.')
+PRODUCER_PUBLISH_SECONDS = REGISTRY.histogram('producer_publish_seconds', 'Broker publish latency, per confirmed batch.')
+PRODUCER_QUEUE_DEPTH = REGISTRY.gauge('producer_queue_depth', 'Messages waiting in the producer queue.')
+CONSUMER_MESSAGES = REGISTRY.counter('consumer_messages_total', 'Event messages received by the consumer.')
+CONSUMER_EVENTS = REGISTRY.counter('consumer_events_total', 'File events received by the consumer.',
+                                   ['event_type'])
+CONSUMER_QUEUE_WAIT_SECONDS = REGISTRY.histogram('consumer_queue_wait_seconds',
+                                                 'Time events wait in the scheduler for a worker.')
+HASH_SECONDS = REGISTRY.histogram('hash_seconds', 'File hashing latency.')
+HASHED_BYTES = REGISTRY.counter('hashed_bytes_total', 'Bytes of hashed files.')
+IO_RATE = REGISTRY.gauge('io_governor_rate_bytes', 'Current file reads bandwidth limit in bytes per second.')
+IO_THROTTLED_SECONDS = REGISTRY.counter('io_governor_throttled_seconds_total',
+                                        'Time file reads waited for the governor.')
+DUPLICATES = REGISTRY.counter('duplicates_total', 'Duplicate files handled.', ['action'])
+RECLAIMED_BYTES = REGISTRY.counter('reclaimed_bytes_total', 'Bytes reclaimed by linking duplicates.')
+DB_SECONDS = REGISTRY.histogram('db_operation_seconds', 'Consumer DB operation latency.', ['operation'])
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        """
+        Serves the registry in the Prometheus text format on /metrics.
+        """
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not logged
+        pass
+
+
+def start_metrics_server(port=9464, host='127.0.0.1'):
+    """
+    Enables the registry and serves it on http://host:port/metrics from a daemon thread.
+    :param port: For the HTTP port, 0 picks a free port.
+    :param host: For the listening address, local only by default.
+    :return: The HTTP server, its server_address holds the bound port and shutdown stops it.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-server').start()
+    REGISTRY.enabled = True
+    Logger('Metrics').logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics.")
+    return server
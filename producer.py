@@ -1,36 +1,276 @@
 """
 Producer Class for publish file changes events to RabbitMQ queue.
+Events are handed to a bounded in memory queue and published by a dedicated publisher thread,
+so the filesystem observer never waits for the broker, nor for reconnections.
+While RabbitMQ is unreachable events are written to a disk spool, replayed once the connection is back.
 """
-import pika
-import pika.exceptions
+import time
+import struct
+import threading
+from queue import Queue, Full, Empty
+from logger import Logger
+from spool import Spool
+from transport import RabbitMQTransport, TransportError
+from sharding import ShardRing
+from messages import decode_events
+from metrics import REGISTRY, PRODUCER_MESSAGES, PRODUCER_PUBLISH_SECONDS, PRODUCER_QUEUE_DEPTH
 
 
 class Producer:
 
-    def __init__(self, host, queue='file-box'):
+    def __init__(self, host, queue='file-box', queue_size=10000, batch_size=500, backpressure='block',
+                 spool_path='producer_spool.bin', transport=None, shards=1, route_by='path'):
         """
         Class Constructor.
         :param host: For the hot ip address.
         :param queue: FOr the RabbitMQ queue name.
+        :param queue_size: For the maximal number of events waiting to be published.
+        :param batch_size: For the maximal number of events published and confirmed at once.
+        :param backpressure: For the full queue policy, see Backpressure.
+        :param spool_path: For the file events are spooled to while RabbitMQ is unreachable or the queue spills.
+        :param transport: For the Transport to publish through, RabbitMQ on the given host by default.
+        :param shards: For the number of shard queues events are routed to, see ShardRing.
+        :param route_by: For the shard routing key, the file 'path' or its parent 'directory'.
         """
+        if backpressure not in Backpressure.ALL:
+            raise ValueError(f"Unsupported backpressure policy '{backpressure}'.")
         self.host = host
         self.queue = queue
-        self.connection = None
-        self.channel = None
+        self.ring = ShardRing(queue, shards, route_by)
+        self.transport = transport or RabbitMQTransport(host)
         self.RECONNECTING_BUFFER = 10
-        self.connect()
+        self.next_connect_time = 0
+        self.batch_size = batch_size
+        self.backpressure = backpressure
+        self.events = Queue(maxsize=queue_size)
+        self.spool = Spool(spool_path)
+        # Published and not yet confirmed events, retried after reconnecting
+        self.unconfirmed = []
+        self.queue_lock = threading.Lock()
+        self.dropped = 0
+        self.stopped = threading.Event()
+        self.class_logger = Logger('Producer')
+        self.publisher = threading.Thread(target=self.run, daemon=True, name='producer-publisher')
+        self.publisher.start()
 
     def connect(self):
         """
-        Establish connection to RabbitMQ Server.
+        Establish connection to RabbitMQ Server, runs on the publisher thread.
         """
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
-        self.channel = self.connection.channel()
-        self.channel.queue_declare(queue=self.queue)
-        print(f"[+] Producer connected successfully to RabbitMQ queue '{self.queue}'.")
+        self.transport.connect()
+        for queue_name in self.ring.queue_names:
+            self.transport.declare(queue_name)
+        print(f"[+] Producer connected successfully to RabbitMQ queues '{', '.join(self.ring.queue_names)}'.")
+
+    def route_message(self, body):
+        """
+        Auxiliary method for getting the shard queue of a message, by its first event path.
+        Used for spooled messages, which are stored without their queue name.
+        :param body: For the event message.
+        :return: The shard queue name.
+        """
+        if self.ring.shards == 1:
+            return self.queue
+        try:
+            return self.ring.route(decode_events(body)[0].src_path)
+        except (ValueError, IndexError, struct.error) as err:
+            self.class_logger.logger.error(f"Unable to route event message, Error: {err}")
+            return self.ring.queue_name(0)
+
+    def publish(self, body, queue_name=None):
+        """
+        Queues an event for publishing without waiting for the broker, safe to call from any thread.
+        Only the 'block' policy may wait, and only while the queue is full.
+        :param body: For the event message.
+        :param queue_name: For the shard queue of the message events, see ShardRing.route, routed by its first
+                           event path if None.
+        :return: True if the event has been queued or spooled, False if an event has been dropped for it.
+        """
+        if REGISTRY.enabled:
+            PRODUCER_MESSAGES.inc()
+        # Keeps events order, nothing may overtake the spooled events
+        if self.spool.pending:
+            self.spool.append(body)
+            return True
+        item = (queue_name or self.route_message(body), body)
+        if self.backpressure == Backpressure.BLOCK:
+            self.events.put(item)
+            return True
+        try:
+            self.events.put_nowait(item)
+            return True
+        except Full:
+            pass
+        if self.backpressure == Backpressure.SPILL:
+            self.spool.append(body)
+            return True
+        with self.queue_lock:
+            while True:
+                try:
+                    self.events.put_nowait(item)
+                    break
+                except Full:
+                    try:
+                        self.events.get_nowait()
+                        self.dropped += 1
+                    except Empty:
+                        pass
+        self.class_logger.logger.error(f"Publish queue is full, dropped the oldest event ({self.dropped} so far).")
+        return False
+
+    def next_batch(self):
+        """
+        Auxiliary method for collecting the next queued events to publish, waits shortly for the first one.
+        :return: List of (queue name, event message) tuples, unconfirmed ones first.
+        """
+        batch, self.unconfirmed = self.unconfirmed, []
+        if REGISTRY.enabled:
+            PRODUCER_QUEUE_DEPTH.set(self.events.qsize())
+        if not batch:
+            try:
+                # Spooled events are replayed right away when nothing is queued
+                batch.append(self.events.get(block=not self.spool.pending, timeout=0.5))
+            except Empty:
+                return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.events.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def publish_batch(self, batch):
+        """
+        Publishes a batch of events, the broker confirms the whole batch at once, see Transport.publish_batch.
+        The events of a batch not confirmed are kept in self.unconfirmed.
+        :param batch: For the (queue name, event message) tuples to publish.
+        """
+        try:
+            if REGISTRY.enabled:
+                start = time.perf_counter()
+                self.transport.publish_batch(batch)
+                PRODUCER_PUBLISH_SECONDS.observe(time.perf_counter() - start)
+            else:
+                self.transport.publish_batch(batch)
+        except TransportError:
+            self.unconfirmed = batch
+            raise
+
+    def drain_spool(self):
+        """
+        Replays the next batch of spooled events, they are consumed from the spool only once confirmed.
+        """
+        bodies, offset = self.spool.read_batch(self.batch_size)
+        try:
+            self.publish_batch([(self.route_message(body), body) for body in bodies])
+        except TransportError:
+            # Still in the spool, replayed from the same offset after reconnecting
+            self.unconfirmed = []
+            raise
+        self.spool.commit(offset)
+
+    def take_queued(self):
+        """
+        Auxiliary method for taking the unconfirmed and queued events, in publishing order.
+        :return: List of (queue name, event message) tuples.
+        """
+        pending, self.unconfirmed = self.unconfirmed, []
+        while True:
+            try:
+                pending.append(self.events.get_nowait())
+            except Empty:
+                break
+        return pending
+
+    def spool_queued(self):
+        """
+        Moves the unconfirmed and queued events to the spool while RabbitMQ is unreachable.
+        Queued events are older than the spooled ones, so once the spool has events they stay queued.
+        """
+        if not self.spool.pending:
+            for _, body in self.take_queued():
+                self.spool.append(body)
+        self.spool.sync()
+
+    def reconnect(self):
+        """
+        Auxiliary method for reconnecting to RabbitMQ, at most once every RECONNECTING_BUFFER seconds.
+        :return: True if connected, False otherwise.
+        """
+        remaining = self.next_connect_time - time.monotonic()
+        if remaining > 0:
+            # Waits on the publisher thread only, new events keep being queued meanwhile
+            self.stopped.wait(min(remaining, 0.5))
+            return False
+        try:
+            self.connect()
+        except TransportError as err:
+            self.on_connection_lost(err)
+            return False
+        if self.spool.pending:
+            print(f"[+] Replaying spooled events from '{self.spool.path}'.")
+        return True
+
+    def on_connection_lost(self, err):
+        """
+        Auxiliary method for scheduling the next reconnection attempt.
+        :param err: For the connection error.
+        """
+        self.transport.close()
+        self.next_connect_time = time.monotonic() + self.RECONNECTING_BUFFER
+        print(f"[!] Unable to send events to RabbitMQ, Error: {err}, Trying to reconnect...")
+        self.class_logger.logger.error(f"Unable to publish events, spooling them to '{self.spool.path}', Error: {err}")
+
+    def run(self):
+        """
+        Publisher thread loop, publishes queued events in batches, then the spooled ones, and reconnects on failures.
+        Stops once all the queued events have been published, or spooled if RabbitMQ is unreachable.
+        """
+        while True:
+            if not self.transport.is_open:
+                self.spool_queued()
+                if self.stopped.is_set():
+                    break
+                if not self.reconnect():
+                    continue
+            try:
+                batch = self.next_batch()
+                if batch:
+                    self.publish_batch(batch)
+                elif self.spool.pending:
+                    self.drain_spool()
+                elif self.stopped.is_set():
+                    break
+            except TransportError as err:
+                self.on_connection_lost(err)
+        self.close_channel()
+
+    def close_channel(self):
+        """
+        Auxiliary method for closing the RabbitMQ connection and the spool, runs on the publisher thread.
+        """
+        self.spool.close([body for _, body in self.take_queued()])
+        self.transport.close()
 
     def close_connection(self):
         """
-        Closes the RabbitMQ connection.
+        Publishes the queued events and closes the RabbitMQ connection.
+        Spooled events which have not been replayed yet are kept for the next run.
         """
-        self.connection.close()
+        self.stopped.set()
+        self.publisher.join()
+
+
+"""
+Auxiliary class for the producer full queue policies.
+"""
+
+
+class Backpressure:
+    # Waits for room in the queue
+    BLOCK = 'block'
+    # Drops the oldest queued event
+    DROP_OLDEST = 'drop_oldest'
+    # Appends the event to the disk spool
+    SPILL = 'spill'
+    ALL = (BLOCK, DROP_OLDEST, SPILL)
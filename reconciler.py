@@ -0,0 +1,164 @@
+"""
+Reconciler Class for bringing the consumer database up to date with the watched directory on startup,
+or with one of its sub trees once the observer lost some of its events.
+Files created, changed or deleted while the service was down never produce watcher events, so the tree is
+walked in parallel with os.scandir and compared against the stored (path, size, mtime) rows:
+1. new files are published as 'created' events.
+2. changed files are published as 'deleted' and 'created' events, so their stored row is replaced.
+3. stored files which are gone are published as 'deleted' events.
+Handled duplicates, e.g. the files replaced by links which keep their names, are known files too, they are only
+published as 'deleted' events once gone.
+Events go through the regular publishing path, in bulk, so the consumer stays the only database writer.
+"""
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from logger import Logger
+from messages import FileEvent
+
+
+class Reconciler:
+
+    def __init__(self, db, source_dir, publish, file_types=None, workers=None, batch_size=256, duplicates_db=None):
+        """
+        Class Constructor.
+        :param db: For the DB or ShardedDB holding the consumer 'Files' table, already set up.
+        :param source_dir: For the watched directory.
+        :param publish: For the callback publishing a list of FileEvent, see FileChangeWatcher.publish_file_events.
+        :param file_types: For the file suffixes to reconcile, all files if None.
+        :param workers: For the number of directory scanning threads, defaults to the number of cores.
+        :param batch_size: For the number of events published at once.
+        :param duplicates_db: For the DB holding the consumer 'Duplicates' table, duplicates are unknown if None.
+        """
+        self.db = db
+        self.duplicates_db = duplicates_db
+        self.source_dir = source_dir
+        self.publish = publish
+        self.file_types = set(file_types) if file_types is not None else None
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.batch = []
+        self.class_logger = Logger('Reconciler')
+
+    def scan_dir(self, path):
+        """
+        Lists a single directory, runs on the scanning threads.
+        :param path: For the directory path.
+        :return: Tuple of the {file path: (size, mtime_ns, inode)} dict and the sub directories list.
+        """
+        files, sub_dirs = {}, []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False) and \
+                                (self.file_types is None or pathlib.Path(entry.name).suffix in self.file_types):
+                            file_stat = entry.stat(follow_symlinks=False)
+                            files[entry.path] = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+                    except OSError as err:
+                        self.class_logger.logger.error(f"Unable to stat '{entry.path}', Error: {err}")
+        except OSError as err:
+            self.class_logger.logger.error(f"Unable to scan '{path}', Error: {err}")
+        return files, sub_dirs
+
+    def scan(self):
+        """
+        Walks the watched directory, every directory is listed by the next free scanning thread.
+        :return: The {file path: (size, mtime_ns, inode)} dict of the whole tree.
+        """
+        files = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='reconciler-scan') as pool:
+            pending = {pool.submit(self.scan_dir, self.source_dir)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_files, sub_dirs = future.result()
+                    files.update(dir_files)
+                    pending.update(pool.submit(self.scan_dir, sub_dir) for sub_dir in sub_dirs)
+        return files
+
+    def stored_files(self, chunk_size=10000):
+        """
+        Streams the stored files under the reconciled directory in chunks, the database lock is not held for the
+        whole scan. The directory is a File_Name index range, '{dir}/' up to '{dir}0', '0' following '/'.
+        :param chunk_size: For the number of rows read at once.
+        :return: Generator of (path, size, mtime_ns) rows.
+        """
+        return self.db.stream_rows('Files', 'File_Name, File_Size, Mtime_Ns', 'File_Name >= ? AND File_Name < ?',
+                                   chunk_size, self.path_range())
+
+    def stored_duplicates(self, chunk_size=10000):
+        """
+        Streams the handled duplicates under the reconciled directory in chunks, see stored_files.
+        :param chunk_size: For the number of rows read at once.
+        :return: Generator of the duplicate paths.
+        """
+        if self.duplicates_db is None:
+            return
+        for path, in self.duplicates_db.stream_rows('Duplicates', 'File_Name', 'File_Name >= ? AND File_Name < ?',
+                                                   chunk_size, self.path_range()):
+            yield path
+
+    def path_range(self):
+        """
+        Auxiliary method for the File_Name index range of the reconciled directory.
+        :return: Tuple of the range lower bound, included, and upper bound, excluded.
+        """
+        prefix = os.path.join(self.source_dir, '')
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+    def add(self, event):
+        """
+        Auxiliary method for adding an event to the current batch, publishing full batches.
+        :param event: For the FileEvent to publish.
+        """
+        self.batch.append(event)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Auxiliary method for publishing the current batch.
+        """
+        if self.batch:
+            self.publish(self.batch)
+            self.batch = []
+
+    def run(self):
+        """
+        Reconciles the watched directory with the stored files.
+        :return: Tuple of the numbers of new, changed and deleted files.
+        """
+        start = time.monotonic()
+        files = self.scan()
+        scan_time = time.monotonic() - start
+        new, changed, deleted = 0, 0, 0
+        for path, stored_size, stored_mtime_ns in self.stored_files():
+            current = files.pop(path, None)
+            if current is None:
+                # Duplicates replacing a deleted original may have no supported type, they are not scanned
+                if not os.path.lexists(path):
+                    self.add(FileEvent('deleted', path))
+                    deleted += 1
+            # Rows stored before mtimes were recorded are compared by size only
+            elif current[0] != stored_size or (stored_mtime_ns is not None and current[1] != stored_mtime_ns):
+                self.add(FileEvent('deleted', path))
+                self.add(FileEvent('created', path, None, *current))
+                changed += 1
+        for path in self.stored_duplicates():
+            # Renamed duplicates have no supported type, they are not scanned but may still exist
+            if files.pop(path, None) is None and not os.path.lexists(path):
+                self.add(FileEvent('deleted', path))
+                deleted += 1
+        for path, current in files.items():
+            self.add(FileEvent('created', path, None, *current))
+            new += 1
+        self.flush()
+        print(f"[+] Reconciled '{self.source_dir}': {new} new, {changed} changed and {deleted} deleted files.")
+        self.class_logger.logger.info(f"Reconciled '{self.source_dir}' in {time.monotonic() - start:.1f} seconds "
+                                      f"(scan {scan_time:.1f} seconds): {new} new, {changed} changed, "
+                                      f"{deleted} deleted files.")
+        return new, changed, deleted
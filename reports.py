@@ -0,0 +1,196 @@
+"""
+Reports Class for querying the duplicates found by the Consumer, straight from the consumer database.
+Rows are streamed from the SQLite cursor and written as they come, so memory use does not depend on the tables size:
+1. groups - every duplicate next to its original, ordered by original, paginated by the last (original, duplicate).
+2. top - the duplicate groups with the most reclaimable bytes, duplicates not replaced by links yet.
+3. dirs - per directory number of duplicates, their bytes and reclaimable bytes.
+The database is opened read only, reports can run next to a running consumer.
+Usage: python reports.py {groups,top,dirs} [--db Consumer_DB] [--db-shards N] [--format {csv,jsonl}] [--limit N] ...
+"""
+import argparse
+import csv
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+from sharded_db import ShardedDB
+
+# Duplicates replaced by links do not take space anymore
+RECLAIMED_ACTIONS = ('hardlink', 'reflink')
+
+
+class Reports:
+
+    def __init__(self, db_name='Consumer_DB', db_shards=1):
+        """
+        Class Constructor.
+        :param db_name: For the consumer database path.
+        :param db_shards: For the number of files the consumer 'Files' table is partitioned across, see ShardedDB.
+        """
+        self.conn = self.connect(db_name)
+        self.conn.create_function('dirname', 1, os.path.dirname, deterministic=True)
+        # Connections holding the 'Files' table
+        self.files = [self.conn] if db_shards == 1 else \
+            [self.connect(ShardedDB.shard_name(db_name, shard)) for shard in range(db_shards)]
+
+    @staticmethod
+    def connect(db_name):
+        """
+        Auxiliary method for opening a read only connection.
+        :param db_name: For the database path.
+        :return: The sqlite3 connection.
+        """
+        if not os.path.exists(db_name):
+            raise FileNotFoundError(f"Consumer database '{db_name}' not found.")
+        return sqlite3.connect(f"{pathlib.Path(db_name).resolve().as_uri()}?mode=ro", uri=True,
+                               check_same_thread=False)
+
+    def close(self):
+        for conn in {self.conn, *self.files}:
+            conn.close()
+
+    def query(self, sql, parameters=()):
+        """
+        Auxiliary method for running a report query.
+        :param sql: For the report SQL.
+        :param parameters: For the SQL parameters.
+        :return: Tuple of the column names and the rows cursor, iterated one row at a time.
+        """
+        cursor = self.conn.execute(sql, parameters)
+        return [description[0] for description in cursor.description], cursor
+
+    def groups(self, limit=None, after=None):
+        """
+        Streams every duplicate with its original, grouped by original.
+        :param limit: For the maximal number of rows, all of them if None.
+        :param after: For the (original, file_name) of the last row of the previous page.
+        :return: Tuple of the column names and the rows cursor.
+        """
+        where, parameters = '', []
+        if after is not None:
+            # Keyset pagination, the page starts right after the last row of the previous one on the index
+            where, parameters = 'WHERE (Original, File_Name) > (?, ?)', list(after)
+        columns, rows = self.query(f"SELECT Original AS original, File_Name AS file_name, File_Size AS file_size, "
+                                   f"Action AS action FROM Duplicates {where} ORDER BY Original, File_Name LIMIT ?",
+                                   (*parameters, -1 if limit is None else limit))
+        return columns[:1] + ['file_hash'] + columns[1:], \
+            ((row[0], self.file_hash(row[0]), *row[1:]) for row in rows)
+
+    def file_hash(self, file_name):
+        """
+        Auxiliary method for looking a stored file digest up, through the 'File_Name' index of every shard.
+        :param file_name: For the stored file path.
+        :return: The file digest, None if not stored.
+        """
+        for conn in self.files:
+            row = conn.execute("SELECT File_Hash FROM Files WHERE File_Name = ?", (file_name,)).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    def top(self, limit=10, offset=0):
+        """
+        Streams the duplicate groups with the most reclaimable bytes.
+        :param limit: For the number of groups.
+        :param offset: For the number of groups to skip.
+        :return: Tuple of the column names and the rows cursor.
+        """
+        return self.query(f"SELECT Original AS original, COUNT(*) AS duplicates, "
+                          f"SUM(File_Size) AS duplicate_bytes, "
+                          f"SUM(CASE WHEN Action IN ({', '.join('?' * len(RECLAIMED_ACTIONS))}) "
+                          f"THEN 0 ELSE File_Size END) AS reclaimable_bytes "
+                          f"FROM Duplicates GROUP BY Original "
+                          f"ORDER BY reclaimable_bytes DESC, original LIMIT ? OFFSET ?",
+                          (*RECLAIMED_ACTIONS, limit, offset))
+
+    def dirs(self, limit=None, offset=0):
+        """
+        Streams the per directory duplicates stats, the directories with the most reclaimable bytes first.
+        :param limit: For the maximal number of directories, all of them if None.
+        :param offset: For the number of directories to skip.
+        :return: Tuple of the column names and the rows cursor.
+        """
+        return self.query(f"SELECT dirname(File_Name) AS directory, COUNT(*) AS duplicates, "
+                          f"SUM(File_Size) AS duplicate_bytes, "
+                          f"SUM(CASE WHEN Action IN ({', '.join('?' * len(RECLAIMED_ACTIONS))}) "
+                          f"THEN 0 ELSE File_Size END) AS reclaimable_bytes "
+                          f"FROM Duplicates GROUP BY directory "
+                          f"ORDER BY reclaimable_bytes DESC, directory LIMIT ? OFFSET ?",
+                          (*RECLAIMED_ACTIONS, -1 if limit is None else limit, offset))
+
+
+def write_csv(columns, rows, output):
+    """
+    Writes report rows as CSV, with a header line.
+    :param columns: For the column names.
+    :param rows: For the rows iterable.
+    :param output: For the text stream to write to.
+    :return: The number of written rows.
+    """
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def write_jsonl(columns, rows, output):
+    """
+    Writes report rows as JSON Lines, one object per row.
+    :param columns: For the column names.
+    :param rows: For the rows iterable.
+    :param output: For the text stream to write to.
+    :return: The number of written rows.
+    """
+    count = 0
+    for row in rows:
+        output.write(json.dumps(dict(zip(columns, row))) + '\n')
+        count += 1
+    return count
+
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streams duplicate reports from the consumer database.')
+    parser.add_argument('report', choices=('groups', 'top', 'dirs'), help='report to run')
+    parser.add_argument('--db', default='Consumer_DB', help='consumer database path')
+    parser.add_argument('--db-shards', type=int, default=1, help='number of consumer DB Files shards')
+    parser.add_argument('--format', choices=tuple(WRITERS), default='csv', help='output format')
+    parser.add_argument('--output', help='file to write the report to, printed otherwise')
+    parser.add_argument('--limit', type=int, default=None, help='maximal number of rows, top defaults to 10')
+    parser.add_argument('--offset', type=int, default=0, help='number of rows to skip, top and dirs reports')
+    parser.add_argument('--after', nargs=2, metavar=('ORIGINAL', 'FILE_NAME'),
+                        help='groups report, last row of the previous page')
+    args = parser.parse_args()
+    try:
+        reports = Reports(args.db, args.db_shards)
+    except (FileNotFoundError, sqlite3.Error) as err:
+        print(f"[!] Unable to open the consumer database, Error: {err}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        if args.report == 'groups':
+            columns, rows = reports.groups(args.limit, args.after)
+        elif args.report == 'top':
+            columns, rows = reports.top(10 if args.limit is None else args.limit, args.offset)
+        else:
+            columns, rows = reports.dirs(args.limit, args.offset)
+        if args.output:
+            with open(args.output, 'w', newline='') as output:
+                count = WRITERS[args.format](columns, rows, output)
+            print(f"[+] Wrote {count} rows to '{args.output}'.", file=sys.stderr)
+        else:
+            WRITERS[args.format](columns, rows, sys.stdout)
+    except sqlite3.Error as err:
+        print(f"[!] Unable to run the '{args.report}' report, Error: {err}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        reports.close()
+
+
+if __name__ == "__main__":
+    main()
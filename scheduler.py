@@ -0,0 +1,162 @@
+"""
+SizeScheduler Class for running the consumer jobs on a worker pool, smallest jobs first.
+Every job has a size band, lower bands run first, and large band jobs run in a lane limited to some of the workers,
+so a few huge files never hold all the workers while small files are waiting.
+Jobs sharing a key, e.g. events of the same file path, still run one after the other in submission order.
+"""
+import heapq
+import itertools
+from collections import deque
+from threading import Thread, Condition
+from logger import Logger
+
+
+class Job:
+
+    def __init__(self, seq, band, keys, fn, callback):
+        """
+        Class Constructor.
+        :param seq: For the job submission sequence number.
+        :param band: For the job size band, lower bands run first.
+        :param keys: For the keys ordering the job after earlier jobs with the same keys.
+        :param fn: For the callable to run.
+        :param callback: For the callable called with the job error, or None, once the job is done.
+        """
+        self.seq = seq
+        self.band = band
+        self.keys = keys
+        self.fn = fn
+        self.callback = callback
+
+
+class SizeScheduler:
+
+    def __init__(self, workers, large_band, large_workers=None, name='consumer-worker'):
+        """
+        Class Constructor.
+        :param workers: For the number of worker threads.
+        :param large_band: For the lowest band running in the large jobs lane.
+        :param large_workers: For the number of workers the large jobs lane may use, half of the workers by default.
+        :param name: For the worker threads name prefix.
+        """
+        self.large_band = large_band
+        self.large_workers = large_workers or max(1, workers // 2)
+        self.small_jobs = []
+        self.large_jobs = []
+        self.large_running = 0
+        # Key to the sequence numbers of its unfinished jobs, the first one is the only one allowed to run
+        self.key_queues = {}
+        self.blocked = {}
+        self.unfinished = 0
+        self.seq = itertools.count()
+        self.stopped = False
+        self.condition = Condition()
+        self.class_logger = Logger('Scheduler')
+        self.threads = [Thread(target=self.run_worker, daemon=True, name=f'{name}_{index}') for index in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, fn, band, keys=(), callback=None):
+        """
+        Schedules a job, safe to call from any thread.
+        :param fn: For the callable to run.
+        :param band: For the job size band, lower bands run first.
+        :param keys: For the keys ordering the job after earlier jobs with the same keys.
+        :param callback: For the callable called with the job error, or None, once the job is done.
+        """
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError("Cannot schedule new jobs after shutdown.")
+            job = Job(next(self.seq), band, tuple(keys), fn, callback)
+            for key in job.keys:
+                self.key_queues.setdefault(key, deque()).append(job.seq)
+            self.unfinished += 1
+            if self.is_first(job):
+                self.push(job)
+            else:
+                self.blocked[job.seq] = job
+
+    def is_first(self, job):
+        """
+        Auxiliary method for checking no earlier unfinished job shares a key with a given job, the lock must be held.
+        :param job: For the job to check.
+        :return: True if the job may run.
+        """
+        return all(self.key_queues[key][0] == job.seq for key in job.keys)
+
+    def push(self, job):
+        """
+        Auxiliary method for making a job ready to run, the lock must be held.
+        :param job: For the job to push.
+        """
+        heapq.heappush(self.large_jobs if job.band >= self.large_band else self.small_jobs, (job.band, job.seq, job))
+        self.condition.notify()
+
+    def next_job(self):
+        """
+        Auxiliary method for taking the next job to run, waits until there is one, the lock must be held.
+        :return: The job, None once the scheduler has been shut down and all the jobs are done.
+        """
+        while True:
+            if self.small_jobs:
+                return heapq.heappop(self.small_jobs)[2]
+            if self.large_jobs and self.large_running < self.large_workers:
+                self.large_running += 1
+                return heapq.heappop(self.large_jobs)[2]
+            if self.stopped and not self.unfinished:
+                return None
+            self.condition.wait()
+
+    def run_worker(self):
+        """
+        Worker thread loop, runs jobs until the scheduler has been shut down.
+        """
+        while True:
+            with self.condition:
+                job = self.next_job()
+            if job is None:
+                return
+            error = None
+            try:
+                job.fn()
+            except Exception as err:
+                error = err
+            if job.callback is not None:
+                try:
+                    job.callback(error)
+                except Exception as err:
+                    self.class_logger.logger.error(f"Job callback failed, Error: {err}")
+            self.finish(job)
+
+    def finish(self, job):
+        """
+        Auxiliary method for releasing the keys of a finished job, unblocking the next jobs of those keys.
+        :param job: For the finished job.
+        """
+        with self.condition:
+            if job.band >= self.large_band:
+                self.large_running -= 1
+            self.unfinished -= 1
+            for key in job.keys:
+                key_queue = self.key_queues[key]
+                key_queue.popleft()
+                if not key_queue:
+                    del self.key_queues[key]
+                    continue
+                waiting = self.blocked.get(key_queue[0])
+                if waiting is not None and self.is_first(waiting):
+                    del self.blocked[waiting.seq]
+                    self.push(waiting)
+            self.condition.notify_all()
+
+    def shutdown(self, wait=True):
+        """
+        Stops accepting jobs, the workers exit once all the scheduled jobs are done.
+        :param wait: For waiting for the workers to exit.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
@@ -0,0 +1,234 @@
+"""
+ShardedDB Class for partitioning the consumer 'Files' table across several SQLite files, so parallel hashing
+workers are not all serialized behind a single SQLite writer.
+Rows are routed by the prefix of their digest, every shard has its own connection and writer thread:
+1. writes of a shard are queued to its writer, which runs everything queued so far in a single commit,
+   and the callers get their results once committed. Writes to different shards run in parallel.
+2. digest lookups go straight to the digest shard, path lookups and path writes fan out to every shard.
+The API is the DB one, so the Consumer, HashIndex and Reconciler use either of them the same way.
+Rows are placed by digest, so the shards count of a database can not change, and rows must have a digest.
+"""
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+from database import DB
+from logger import Logger
+
+
+class ShardedDB:
+
+    ROUTING_COLUMN = 'File_Hash'
+
+    def __init__(self, shards, write_behind=False, batch_size=256):
+        """
+        Class Constructor.
+        :param shards: For the number of shard files.
+        :param write_behind: For group committing every shard mutations in the background, see DB.
+        :param batch_size: For the maximal number of queued writes a writer commits at once.
+        """
+        if shards < 1:
+            raise ValueError("A sharded database needs at least one shard.")
+        self.shards = [DB(write_behind=write_behind) for _ in range(shards)]
+        self.batch_size = batch_size
+        self.jobs = [queue.SimpleQueue() for _ in range(shards)]
+        self.writers = []
+        self.conn = None
+        self.class_logger = Logger('ShardedDB')
+
+    @staticmethod
+    def shard_name(name, shard):
+        """
+        :param name: For the main database name.
+        :param shard: For the shard number.
+        :return: The shard database file name.
+        """
+        return f"{name}_Files_{shard}"
+
+    def shard_of(self, file_hash):
+        """
+        Auxiliary method for routing a digest to its shard, digests are hex strings.
+        :param file_hash: For the file digest.
+        :return: The shard number.
+        """
+        return int(file_hash[:8], 16) % len(self.shards)
+
+    def setup_db(self, name):
+        """
+        Sets up every shard database and starts their writer threads.
+        :param name: For the main database name, the shards are named '{name}_Files_{shard}'.
+        :return: True if every shard has been set up, False otherwise.
+        """
+        if not all([shard.setup_db(self.shard_name(name, index)) for index, shard in enumerate(self.shards)]):
+            return False
+        self.conn = [shard.conn for shard in self.shards]
+        for index in range(len(self.shards)):
+            writer = threading.Thread(target=self.run_writer, args=(index,), daemon=True, name=f'db-writer-{index}')
+            writer.start()
+            self.writers.append(writer)
+        return True
+
+    def close_db(self):
+        """
+        Stops the writer threads once their queued writes are done, and closes every shard.
+        """
+        for jobs in self.jobs:
+            jobs.put(None)
+        for writer in self.writers:
+            writer.join()
+        self.writers = []
+        for shard in self.shards:
+            if shard.conn is not None:
+                shard.close_db()
+        self.conn = None
+
+    def run_writer(self, index):
+        """
+        Writer thread loop of a shard, runs the queued writes in batches, each committed once.
+        :param index: For the shard number.
+        """
+        shard, jobs = self.shards[index], self.jobs[index]
+        stopping = False
+        while not stopping:
+            batch = [jobs.get()]
+            while len(batch) < self.batch_size and not jobs.empty():
+                batch.append(jobs.get())
+            if None in batch:
+                stopping = True
+                batch = [job for job in batch if job is not None]
+            results = []
+            try:
+                with shard.batch():
+                    for future, operation, args in batch:
+                        try:
+                            results.append((future, operation(*args), None))
+                        except Exception as err:
+                            results.append((future, None, err))
+            except Exception as err:
+                # The commit failed, none of the batch writes is known to be stored
+                self.class_logger.logger.error(f"Unable to commit writes of shard {index}, Error: {err}")
+                results = [(future, None, err) for future, _, _ in batch]
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def submit(self, shard, operation, *args):
+        """
+        Queues a write to the writer of a shard.
+        :param shard: For the shard number.
+        :param operation: For the name of the DB method to run.
+        :param args: For the DB method arguments.
+        :return: Future of the DB method result.
+        """
+        future = Future()
+        self.jobs[shard].put((future, getattr(self.shards[shard], operation), args))
+        return future
+
+    def routed_shard(self, table_columns, values):
+        """
+        Auxiliary method for finding the shard of a row to insert.
+        :param table_columns: For the comma separated columns of the row.
+        :param values: For the row values, ordered as the columns.
+        :return: The shard number.
+        """
+        columns = [column.strip() for column in table_columns.split(',')]
+        if self.ROUTING_COLUMN not in columns or values[columns.index(self.ROUTING_COLUMN)] is None:
+            raise ValueError(f"Rows of a sharded database are routed by their '{self.ROUTING_COLUMN}'.")
+        return self.shard_of(values[columns.index(self.ROUTING_COLUMN)])
+
+    def broadcast(self, operation, *args):
+        """
+        Auxiliary method for running a write on every shard, in parallel.
+        :param operation: For the name of the DB method to run.
+        :param args: For the DB method arguments.
+        :return: List of the shards results.
+        """
+        futures = [self.submit(shard, operation, *args) for shard in range(len(self.shards))]
+        return [future.result() for future in futures]
+
+    def create_table(self, table_name, columns):
+        for shard in self.shards:
+            shard.create_table(table_name, columns)
+
+    def create_index(self, index_name, table_name, columns, unique=False):
+        for shard in self.shards:
+            shard.create_index(index_name, table_name, columns, unique)
+
+    def drop_index(self, index_name):
+        for shard in self.shards:
+            shard.drop_index(index_name)
+
+    def add_column_if_not_exists(self, table_name, column):
+        for shard in self.shards:
+            shard.add_column_if_not_exists(table_name, column)
+
+    def insert_row(self, table_name, table_columns, values):
+        """
+        Inserts a row to the shard of its digest, see DB.insert_row.
+        """
+        return self.submit(self.routed_shard(table_columns, values), 'insert_row',
+                           table_name, table_columns, values).result()
+
+    def insert_row_if_not_exists(self, table_name, table_columns, values, unique_column):
+        """
+        Inserts a row to the shard of its digest if its unique column value does not exist there,
+        see DB.insert_row_if_not_exists. The unique columns must include the digest, or be unique within shards.
+        """
+        return self.submit(self.routed_shard(table_columns, values), 'insert_row_if_not_exists',
+                           table_name, table_columns, values, unique_column).result()
+
+    def update_table(self, table_name, column_to_update, value, current_table_column, existing_value):
+        """
+        Updates the matching rows, on the digest shard or on every shard, see DB.update_table.
+        :return: The number of updated rows, None if every shard failed.
+        """
+        if column_to_update == self.ROUTING_COLUMN:
+            raise ValueError(f"The '{self.ROUTING_COLUMN}' routing column of a sharded database can not be updated.")
+        args = (table_name, column_to_update, value, current_table_column, existing_value)
+        if current_table_column == self.ROUTING_COLUMN:
+            return self.submit(self.shard_of(existing_value), 'update_table', *args).result()
+        counts = [count for count in self.broadcast('update_table', *args) if count is not None]
+        return sum(counts) if counts else None
+
+    def delete_value(self, table_name, table_column, value_to_delete):
+        """
+        Deletes the matching rows, on the digest shard or on every shard, see DB.delete_value.
+        """
+        if table_column == self.ROUTING_COLUMN:
+            self.submit(self.shard_of(value_to_delete), 'delete_value', table_name, table_column,
+                        value_to_delete).result()
+        else:
+            self.broadcast('delete_value', table_name, table_column, value_to_delete)
+
+    def delete_returning(self, table_name, table_column, value_to_delete, returning_columns):
+        """
+        Deletes the matching rows, on the digest shard or on every shard, see DB.delete_returning.
+        :return: List of the deleted rows of every shard.
+        """
+        args = (table_name, table_column, value_to_delete, returning_columns)
+        if table_column == self.ROUTING_COLUMN:
+            return self.submit(self.shard_of(value_to_delete), 'delete_returning', *args).result()
+        return list(itertools.chain.from_iterable(self.broadcast('delete_returning', *args)))
+
+    def select_rows(self, table_name, table_columns, condition_column, value):
+        """
+        Selects the matching rows, from the digest shard or from every shard, see DB.select_rows.
+        Reads do not go through the writers, they see every committed write.
+        """
+        if condition_column == self.ROUTING_COLUMN:
+            return self.shards[self.shard_of(value)].select_rows(table_name, table_columns, condition_column, value)
+        return list(itertools.chain.from_iterable(shard.select_rows(table_name, table_columns, condition_column,
+                                                                    value) for shard in self.shards))
+
+    def stream_rows(self, table_name, table_columns, condition=None, chunk_size=10000, parameters=()):
+        """
+        Streams the rows of every shard, one shard after the other, see DB.stream_rows.
+        """
+        for shard in self.shards:
+            yield from shard.stream_rows(table_name, table_columns, condition, chunk_size, parameters)
+
+    def print_all_database(self, table_name):
+        for shard in self.shards:
+            shard.print_all_database(table_name)
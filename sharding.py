@@ -0,0 +1,76 @@
+"""
+ShardRing Class for routing file events to shard queues by consistent hashing.
+Every shard owns many points on a hash ring, a key goes to the shard owning the first point after its hash,
+so changing the number of shards moves only about 1/N of the keys to other shards.
+Keys are hashed with blake2b, routing is the same on every node and across restarts.
+All the events of a path, or of a directory with route_by='directory', go to the same shard, keeping their order.
+"""
+import bisect
+import hashlib
+import os
+
+
+class ShardRing:
+
+    ROUTE_BY = ('path', 'directory')
+
+    def __init__(self, queue, shards=1, route_by='path', virtual_nodes=128):
+        """
+        Class Constructor.
+        :param queue: For the base queue name, shard queues are named '{queue}-{shard}'.
+        :param shards: For the number of shards, a single shard uses the base queue name.
+        :param route_by: For the routing key, the file 'path' or its parent 'directory'.
+        :param virtual_nodes: For the number of ring points of every shard.
+        """
+        if route_by not in self.ROUTE_BY:
+            raise ValueError(f"Unsupported routing '{route_by}'.")
+        self.queue = queue
+        self.shards = shards
+        self.route_by = route_by
+        self.points = sorted((self.hash_key(f"{queue}-{shard}#{node}"), shard)
+                             for shard in range(shards) for node in range(virtual_nodes))
+        self.hashes = [point for point, _ in self.points]
+
+    @staticmethod
+    def hash_key(key):
+        """
+        Auxiliary method for hashing a key to a ring position.
+        :param key: For the key to hash.
+        :return: The 64 bit ring position.
+        """
+        return int.from_bytes(hashlib.blake2b(os.fsencode(key), digest_size=8).digest(), 'little')
+
+    def queue_name(self, shard):
+        """
+        Returns the queue name of a shard.
+        :param shard: For the shard number.
+        :return: The shard queue name.
+        """
+        return self.queue if self.shards == 1 else f"{self.queue}-{shard}"
+
+    @property
+    def queue_names(self):
+        """
+        :return: List of all the shard queue names.
+        """
+        return [self.queue_name(shard) for shard in range(self.shards)]
+
+    def shard_for(self, path):
+        """
+        Returns the shard of a file path.
+        :param path: For the file path.
+        :return: The shard number.
+        """
+        if self.shards == 1:
+            return 0
+        key = os.path.dirname(path) if self.route_by == 'directory' else path
+        index = bisect.bisect(self.hashes, self.hash_key(key)) % len(self.points)
+        return self.points[index][1]
+
+    def route(self, path):
+        """
+        Returns the queue name of a file path.
+        :param path: For the file path.
+        :return: The shard queue name.
+        """
+        return self.queue_name(self.shard_for(path))
@@ -0,0 +1,140 @@
+"""
+Spool Class for keeping producer events on disk while RabbitMQ is unreachable.
+The spool is a single append only file of length prefixed records, written sequentially and
+fsynced in batches, and replayed in order from a read offset once the broker is back.
+"""
+import os
+import struct
+import threading
+import time
+from logger import Logger
+
+
+class Spool:
+
+    HEADER = struct.Struct('<I')
+
+    def __init__(self, path, sync_every=256, sync_interval=0.05):
+        """
+        Class Constructor.
+        An existing spool file, left by a previous run, is replayed from its start.
+        :param path: For the spool file path.
+        :param sync_every: For the number of appended records after which the file is fsynced.
+        :param sync_interval: For the seconds after which appended records are fsynced.
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.class_logger = Logger('Spool')
+        self.writer = open(path, 'ab')
+        self.size = self.recover()
+        self.offset = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def recover(self):
+        """
+        Auxiliary method for dropping a torn record left by a crash while appending, so new records stay aligned.
+        :return: The spool size in bytes, up to its last complete record.
+        """
+        size = os.fstat(self.writer.fileno()).st_size
+        offset = 0
+        with open(self.path, 'rb') as reader:
+            while offset + self.HEADER.size <= size:
+                length, = self.HEADER.unpack(reader.read(self.HEADER.size))
+                if offset + self.HEADER.size + length > size:
+                    break
+                offset += self.HEADER.size + length
+                reader.seek(offset)
+        if offset < size:
+            self.class_logger.logger.error(f"Dropped {size - offset} truncated bytes from '{self.path}'.")
+            self.writer.truncate(offset)
+        return offset
+
+    @property
+    def pending(self):
+        """
+        :return: True if the spool holds events that have not been replayed yet.
+        """
+        return self.offset < self.size
+
+    def append(self, body):
+        """
+        Appends an event to the spool, the file is fsynced every sync_every records or sync_interval seconds.
+        :param body: For the event message.
+        """
+        data = body.encode() if isinstance(body, str) else body
+        with self.lock:
+            self.writer.write(self.HEADER.pack(len(data)) + data)
+            self.size += self.HEADER.size + len(data)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self.sync_locked()
+
+    def sync(self):
+        """
+        Flushes and fsyncs the appended records.
+        """
+        with self.lock:
+            if self.unsynced:
+                self.sync_locked()
+
+    def sync_locked(self):
+        """
+        Auxiliary method for flushing and fsyncing the spool file, the lock must be held.
+        """
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def read_batch(self, max_count):
+        """
+        Reads the next events to replay, without consuming them.
+        :param max_count: For the maximal number of events to read.
+        :return: Tuple of the events list and the offset to commit once they have been published.
+        """
+        with self.lock:
+            self.writer.flush()
+            offset, size = self.offset, self.size
+        bodies = []
+        with open(self.path, 'rb') as reader:
+            reader.seek(offset)
+            while len(bodies) < max_count and offset < size:
+                length, = self.HEADER.unpack(reader.read(self.HEADER.size))
+                bodies.append(reader.read(length))
+                offset += self.HEADER.size + length
+        return bodies, offset
+
+    def commit(self, offset):
+        """
+        Consumes the events up to a given offset, the file is truncated once all events have been replayed.
+        :param offset: For the offset returned by read_batch.
+        """
+        with self.lock:
+            self.offset = max(self.offset, offset)
+            if self.offset >= self.size:
+                self.writer.truncate(0)
+                self.sync_locked()
+                self.size = 0
+                self.offset = 0
+
+    def close(self, head=()):
+        """
+        Fsyncs and closes the spool file, keeping only the events which have not been replayed yet.
+        :param head: For events older than the spooled ones, kept ahead of them.
+        """
+        with self.lock:
+            self.writer.flush()
+            if head or 0 < self.offset < self.size:
+                with open(self.path, 'rb') as reader:
+                    reader.seek(self.offset)
+                    remaining = reader.read()
+                self.writer.truncate(0)
+                for body in head:
+                    data = body.encode() if isinstance(body, str) else body
+                    self.writer.write(self.HEADER.pack(len(data)) + data)
+                self.writer.write(remaining)
+            self.sync_locked()
+            self.writer.close()
@@ -0,0 +1,327 @@
+"""
+Transport Classes for moving event messages from the Producer to the Consumer.
+A transport exposes the few broker operations the project needs: declare, publish, qos, consume, ack and run.
+1. RabbitMQTransport - the RabbitMQ broker, through a pika BlockingConnection.
+2. InProcessTransport - in process queues, messages are handed over by reference,
+   for single box deployments and for running the whole pipeline without RabbitMQ.
+Broker errors are raised as TransportError.
+"""
+import contextlib
+import functools
+import itertools
+import queue
+import threading
+from abc import ABC, abstractmethod
+from logger import Logger
+
+try:
+    import pika
+    import pika.exceptions
+except ImportError:
+    pika = None
+
+
+class TransportError(Exception):
+    """
+    Raised when the transport broker is unreachable or the connection has been lost.
+    """
+
+
+class Transport(ABC):
+
+    @abstractmethod
+    def connect(self):
+        """
+        Establish the connection to the broker.
+        """
+
+    @property
+    @abstractmethod
+    def is_open(self):
+        """
+        :return: True if the connection is usable.
+        """
+
+    @abstractmethod
+    def declare(self, queue_name):
+        """
+        Declares a queue, creating it if needed.
+        :param queue_name: For the queue name.
+        """
+
+    @abstractmethod
+    def publish(self, queue_name, body):
+        """
+        Publishes a message and waits for the broker to confirm it.
+        :param queue_name: For the queue name.
+        :param body: For the message.
+        :return: True if the message has been accepted, False if the broker returned it.
+        """
+
+    def publish_batch(self, messages):
+        """
+        Publishes messages in order and waits for the broker to confirm all of them.
+        :param messages: For the (queue name, message) tuples.
+        :return: True if every message has been accepted, False otherwise.
+        """
+        return all([self.publish(queue_name, body) for queue_name, body in messages])
+
+    @abstractmethod
+    def qos(self, prefetch_count):
+        """
+        Limits the number of delivered and not acked messages.
+        :param prefetch_count: For the unacked messages window.
+        """
+
+    @abstractmethod
+    def consume(self, queue_name, callback):
+        """
+        Registers a callback for the messages of a queue, the deliveries start with run.
+        :param queue_name: For the queue name.
+        :param callback: For the callback, called as callback(body, delivery_tag) on the run thread.
+        """
+
+    @abstractmethod
+    def ack(self, delivery_tag):
+        """
+        Acks a delivery, safe to call from any thread.
+        :param delivery_tag: For the delivery tag passed to the consume callback.
+        """
+
+    @abstractmethod
+    def run(self):
+        """
+        Delivers messages to the consume callbacks until the connection is closed.
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Closes the connection, errors of an already lost connection are ignored.
+        """
+
+
+class RabbitMQTransport(Transport):
+
+    def __init__(self, host):
+        """
+        Class Constructor.
+        :param host: For the RabbitMQ host.
+        """
+        if pika is None:
+            raise ImportError("RabbitMQ transport requires the 'pika' package.")
+        self.host = host
+        self.connection = None
+        self.channel = None
+        # Publishing channels are transactional, consuming ones are not, see publish_batch
+        self.transactional = False
+        self.class_logger = Logger('Transport')
+
+    @staticmethod
+    @contextlib.contextmanager
+    def errors():
+        """
+        Auxiliary context manager for raising pika errors as TransportError.
+        """
+        try:
+            yield
+        except (pika.exceptions.AMQPError, AttributeError) as err:
+            raise TransportError(err) from err
+
+    @property
+    def is_open(self):
+        return self.channel is not None and self.channel.is_open
+
+    def connect(self):
+        with self.errors():
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+            self.channel = self.connection.channel()
+            self.transactional = False
+
+    def declare(self, queue_name):
+        with self.errors():
+            self.channel.queue_declare(queue=queue_name)
+
+    def publish(self, queue_name, body):
+        return self.publish_batch([(queue_name, body)])
+
+    def publish_batch(self, messages):
+        with self.errors():
+            if not self.transactional:
+                # Blocking channels wait for the confirm of every publish, a transaction is committed once per batch.
+                # Acks of a transactional channel only apply on commit, so only publishing channels select it
+                self.channel.tx_select()
+                self.transactional = True
+            for queue_name, body in messages:
+                self.channel.basic_publish(exchange='', routing_key=queue_name, body=body)
+            # A single round trip, the whole batch is accepted by the broker or none of it
+            self.channel.tx_commit()
+        return True
+
+    def qos(self, prefetch_count):
+        with self.errors():
+            self.channel.basic_qos(prefetch_count=prefetch_count)
+
+    def consume(self, queue_name, callback):
+        with self.errors():
+            self.channel.basic_consume(queue=queue_name, on_message_callback=lambda channel, method, properties, body:
+                                       callback(body, method.delivery_tag))
+
+    def ack(self, delivery_tag):
+        # pika connections are not thread safe, the ack is sent from the connection thread
+        with self.errors():
+            self.connection.add_callback_threadsafe(functools.partial(self.ack_message, self.channel, delivery_tag))
+
+    def ack_message(self, channel, delivery_tag):
+        """
+        Acks a given delivery, runs on the connection thread.
+        :param channel: For the channel the message has been delivered on.
+        :param delivery_tag: For the RabbitMQ delivery tag to ack.
+        """
+        if channel.is_open:
+            channel.basic_ack(delivery_tag=delivery_tag)
+        else:
+            self.class_logger.logger.error(f"Channel closed, delivery '{delivery_tag}' will be redelivered.")
+
+    def run(self):
+        with self.errors():
+            self.channel.start_consuming()
+
+    def close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError as err:
+            self.class_logger.logger.error(f"Error closing RabbitMQ connection, Error: {err}")
+        self.channel = None
+
+
+class InProcessBroker:
+
+    def __init__(self):
+        """
+        Class Constructor.
+        Holds the named in process queues shared by the transports of a process.
+        """
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def get_queue(self, queue_name):
+        """
+        Returns a named queue, creating it if needed.
+        :param queue_name: For the queue name.
+        :return: The queue.
+        """
+        with self.lock:
+            return self.queues.setdefault(queue_name, queue.Queue())
+
+
+DEFAULT_BROKER = InProcessBroker()
+
+
+class InProcessTransport(Transport):
+
+    def __init__(self, broker=None):
+        """
+        Class Constructor.
+        :param broker: For the InProcessBroker holding the queues, the process wide broker by default.
+        """
+        self.broker = broker or DEFAULT_BROKER
+        self.opened = False
+        self.closed = threading.Event()
+        self.window = None
+        self.consumers = []
+        self.delivery_tags = itertools.count(1)
+        self.POLL_INTERVAL = 0.2
+
+    @property
+    def is_open(self):
+        return self.opened
+
+    def connect(self):
+        self.opened = True
+        self.closed.clear()
+
+    def check_open(self):
+        """
+        Auxiliary method for failing operations of a closed transport.
+        """
+        if not self.opened:
+            raise TransportError("In process transport is closed.")
+
+    def declare(self, queue_name):
+        self.check_open()
+        self.broker.get_queue(queue_name)
+
+    def publish(self, queue_name, body):
+        self.check_open()
+        # The message object itself is queued, it is never copied nor serialized again
+        self.broker.get_queue(queue_name).put(body)
+        return True
+
+    def qos(self, prefetch_count):
+        self.window = threading.BoundedSemaphore(prefetch_count)
+
+    def consume(self, queue_name, callback):
+        self.check_open()
+        self.consumers.append((self.broker.get_queue(queue_name), callback))
+
+    def ack(self, delivery_tag):
+        if self.window is not None:
+            self.window.release()
+
+    def run(self):
+        self.check_open()
+        turn = 0
+        while not self.closed.is_set():
+            if self.window is not None and not self.window.acquire(timeout=self.POLL_INTERVAL):
+                continue
+            delivered = False
+            # A single queue is waited on, several queues are polled in turns so none of them starves
+            for index in range(len(self.consumers)):
+                messages, callback = self.consumers[(turn + index) % len(self.consumers)]
+                try:
+                    if len(self.consumers) == 1:
+                        body = messages.get(timeout=self.POLL_INTERVAL)
+                    else:
+                        body = messages.get_nowait()
+                except queue.Empty:
+                    continue
+                turn += index + 1
+                callback(body, next(self.delivery_tags))
+                delivered = True
+                break
+            if not delivered:
+                if self.window is not None:
+                    self.window.release()
+                if len(self.consumers) != 1:
+                    self.closed.wait(self.POLL_INTERVAL / 20)
+
+    def close(self):
+        self.opened = False
+        self.closed.set()
+
+
+"""
+Auxiliary class for the transport kinds.
+"""
+
+
+class TransportKinds:
+    RABBITMQ = 'rabbitmq'
+    IN_PROCESS = 'inprocess'
+    ALL = (RABBITMQ, IN_PROCESS)
+
+
+def create_transport(kind, host=None):
+    """
+    Creates a transport of a given kind.
+    :param kind: For the transport kind, see TransportKinds.
+    :param host: For the RabbitMQ host.
+    :return: The new transport.
+    """
+    if kind == TransportKinds.RABBITMQ:
+        return RabbitMQTransport(host)
+    if kind == TransportKinds.IN_PROCESS:
+        return InProcessTransport()
+    raise ValueError(f"Unsupported transport '{kind}'.")
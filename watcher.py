@@ -1,22 +1,33 @@
 """
 File Change Handler Class for watch the wanted folder for file changes.
 """
-import pika
-import time
-import pika.exceptions
 from typing import Union
 from producer import Producer
+from messages import FileEvent, encode_events, event_from_stat, MAX_EVENTS
+from debouncer import EventDebouncer
+from metrics import REGISTRY, WATCHER_EVENTS
 from watchdog.events import FileSystemEventHandler, FileCreatedEvent
 
 
 class FileChangeWatcher(FileSystemEventHandler):
 
-    def __init__(self, host):
+    def __init__(self, host, quiet_period=2.0, backpressure='block', transport=None, shards=1, route_by='path'):
         """
         Class Constructor.
+        :param host: For the RabbitMQ host.
+        :param quiet_period: For the seconds a file must stay unchanged before its event is published,
+                             0 publishes every raw event right away.
+        :param backpressure: For the producer full queue policy, see producer.Backpressure.
+        :param transport: For the producer Transport, RabbitMQ on the given host by default.
+        :param shards: For the number of shard queues events are routed to.
+        :param route_by: For the shard routing key, the file 'path' or its parent 'directory'.
         """
-        self.producer = Producer(host)
+        self.producer = Producer(host, backpressure=backpressure, transport=transport, shards=shards, route_by=route_by)
         self.file_paths = []
+        self.debouncer = None
+        if quiet_period:
+            self.debouncer = EventDebouncer(self.publish_events, quiet_period)
+            self.debouncer.start()
 
     def on_any_event(self, event: Union[FileCreatedEvent]):
         """
@@ -26,17 +37,80 @@ class FileChangeWatcher(FileSystemEventHandler):
         # Avoid directory changes
         if event.is_directory:
             return None
+        if REGISTRY.enabled:
+            WATCHER_EVENTS.inc(1, event.event_type)
 
         # Add the file creation path to path lists
         if isinstance(event, FileCreatedEvent):
             self.file_paths.append(event.src_path)
 
-        # Send event type and file path to RabbitMQ queue for further processing
-        try:
-            msg = f"{event.event_type} {event.src_path}"
-            self.producer.channel.basic_publish(exchange='', routing_key=self.producer.queue, body=msg)
-        except (pika.exceptions.ConnectionClosed, pika.exceptions.StreamLostError, AttributeError) as err:
-            print(f"[!] Unable to send event to RabbitMQ, Error: {err}, Trying to reconnect...")
-            # In case connection will be terminated
-            time.sleep(self.producer.RECONNECTING_BUFFER)
-            self.producer.connect()
+        dest_path = getattr(event, 'dest_path', None)
+        if self.debouncer is not None:
+            self.debouncer.add(event.event_type, event.src_path, dest_path)
+        else:
+            self.publish(event.event_type, event.src_path, dest_path)
+
+    def on_events(self, events):
+        """
+        Method to send a batch of file events read at once to RabbitMQ queue, see InotifyObserver.
+        :param events: For the (event_type, src_path, dest_path) tuples, directory events excluded.
+        """
+        if REGISTRY.enabled:
+            for event_type, _, _ in events:
+                WATCHER_EVENTS.inc(1, event_type)
+        self.file_paths.extend(src_path for event_type, src_path, _ in events if event_type == 'created')
+        if self.debouncer is not None:
+            self.debouncer.add_events(events)
+        else:
+            self.publish_events(events)
+
+    def publish(self, event_type, src_path, dest_path=None):
+        """
+        Method to queue a single event for publishing to RabbitMQ queue, never waits for the broker.
+        :param event_type: For the event type.
+        :param src_path: For the event file path.
+        :param dest_path: For the event destination path, for 'moved' events.
+        """
+        self.publish_events([(event_type, src_path, dest_path)])
+
+    def publish_events(self, events):
+        """
+        Method to queue events for publishing to RabbitMQ queues, one message per shard, never waits for the broker.
+        The file size, mtime and inode are captured here, so the consumer does not need to stat the files again.
+        :param events: For the (event_type, src_path, dest_path) tuples to publish.
+        """
+        self.publish_file_events([event_from_stat(event_type, src_path, dest_path)
+                                  for event_type, src_path, dest_path in events])
+
+    def publish_file_events(self, file_events):
+        """
+        Method to queue events, with their file metadata already known, for publishing to RabbitMQ queues,
+        one message per shard, split in messages of up to MAX_EVENTS events.
+        Every event of a path goes to the shard of the path, so a move between paths of different shards is sent as
+        'deleted' to the source shard and 'created' to the destination one.
+        :param file_events: For the FileEvent list to publish.
+        """
+        shard_events = {}
+        for file_event in file_events:
+            queue_name = self.producer.ring.route(file_event.src_path)
+            if file_event.event_type == 'moved' and file_event.dest_path:
+                dest_queue_name = self.producer.ring.route(file_event.dest_path)
+                if dest_queue_name != queue_name:
+                    shard_events.setdefault(queue_name, []).append(FileEvent('deleted', file_event.src_path))
+                    # Moved events carry the destination file metadata
+                    shard_events.setdefault(dest_queue_name, []).append(
+                        file_event._replace(event_type='created', src_path=file_event.dest_path, dest_path=None))
+                    continue
+            shard_events.setdefault(queue_name, []).append(file_event)
+        # Send events with their file metadata to RabbitMQ queue for further processing
+        for queue_name, shard_file_events in shard_events.items():
+            for start in range(0, len(shard_file_events), MAX_EVENTS):
+                self.producer.publish(encode_events(shard_file_events[start:start + MAX_EVENTS]), queue_name)
+
+    def stop(self):
+        """
+        Stops the watcher, publishing the pending events.
+        """
+        if self.debouncer is not None:
+            self.debouncer.stop()
+        self.producer.close_connection()